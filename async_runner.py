@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Run commands with asyncio: many at once, each with a timeout. This is python 3 only (common.runParallel only
+# imports it on python 3). Results have the same shape as common.run(): (output, returncode), or
+# (stdout, stderr, returncode) with separate_std_out_err=True.
+# - At most max_children commands run at the same time in the whole process. The others wait for a slot.
+# - A command that runs past its timeout is killed, along with its children (it gets its own process group).
+#   Its returncode is then g_timeout_returncode.
+# - Output is read line by line as it comes. on_line(line) is called with each line (ie to show progress).
+# - Cancelling the task that awaits run() kills the command.
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from common import say, getCommandFamily
+from metrics import g_metrics
+from rate_limiter import g_rate_limiter, getBackoffSecs
+
+# What a command that timed out returns (like coreutils' timeout):
+g_timeout_returncode = 124
+# Longest line we read in one go (the asyncio default is 64KB):
+g_line_limit = 2 ** 20
+
+
+class AsyncRunner(object):
+    def __init__(self, max_children=16):
+        self.max_children = max_children
+        # Shared by all the threads (and their event loops):
+        self.slots = threading.BoundedSemaphore(max_children)
+
+    # Wait for a free slot, without blocking the event loop:
+    async def acquire(self):
+        delay = 0.01
+        while not self.slots.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    async def readLines(self, stream, lines, on_line):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', 'replace')
+            lines.append(line)
+            if on_line is not None:
+                on_line(line.rstrip('\n'))
+
+    # Kill the command and everything it started:
+    def kill(self, proc):
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    # Run a command once. Returns (stdout, stderr, returncode):
+    async def runOnce(self, cmd, timeout=None, separate_std_out_err=False, on_line=None):
+        await self.acquire()
+        start = time.time()
+        proc = None
+        stdout = []
+        stderr = []
+        returncode = None
+        try:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE,
+                                                         stderr=subprocess.PIPE if separate_std_out_err else subprocess.STDOUT,
+                                                         start_new_session=True, limit=g_line_limit)
+            readers = [self.readLines(proc.stdout, stdout, on_line)]
+            if separate_std_out_err:
+                readers.append(self.readLines(proc.stderr, stderr, on_line))
+            try:
+                await asyncio.wait_for(asyncio.gather(proc.wait(), *readers), timeout)
+                returncode = proc.returncode
+            except asyncio.TimeoutError:
+                say('***Error: Command did not finish in {}s, killing it: {}'.format(timeout, cmd))
+                g_metrics.inc('slave_manager_subprocess_timeouts_total', family=getCommandFamily(cmd))
+                self.kill(proc)
+                await proc.wait()
+                returncode = g_timeout_returncode
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            say('***Error in command: {0}\nException: {1}'.format(cmd, err))
+        finally:
+            if proc is not None:
+                self.kill(proc)
+            self.slots.release()
+            g_metrics.observe('slave_manager_subprocess_seconds', time.time() - start, family=getCommandFamily(cmd))
+        return ''.join(stdout), ''.join(stderr), returncode
+
+    # Same as common.run(), plus a timeout (seconds, per attempt) and on_line:
+    async def run(self, cmd, hide_command=True, raise_on_failure=True, separate_std_out_err=False, retry_count=0,
+                  retry_sleep_secs=None, timeout=None, on_line=None, debug=False):
+        for i_attempt in range(retry_count + 1):
+            if hide_command is False or debug is True:
+                say('cmd: {0}'.format(cmd))
+            stdout, stderr, returncode = await self.runOnce(cmd, timeout=timeout, separate_std_out_err=separate_std_out_err,
+                                                            on_line=on_line)
+            if returncode == 0:
+                break
+            if i_attempt != retry_count:
+                sleep_secs = retry_sleep_secs
+                if sleep_secs is None:
+                    sleep_secs = getBackoffSecs(i_attempt, base_secs=0.5, max_secs=30)
+                if debug is True:
+                    say('retrying command: {}, after sleeping: {:.3f}s'.format(cmd, sleep_secs))
+                g_rate_limiter.addStat('backoff_secs', sleep_secs)
+                g_metrics.inc('slave_manager_backoff_seconds_total', sleep_secs, service='command', operation=getCommandFamily(cmd))
+                await asyncio.sleep(sleep_secs)
+
+        if returncode != 0 and raise_on_failure is True:
+            say('***Error in command and raise_on_failure is True so exiting. CMD:\n{0}'.format(cmd))
+            say('This is the output from that command, if any:\n{0}'.format(stdout if not separate_std_out_err
+                                                                            else stdout + '\n' + stderr))
+            raise Exception('Command_Error')
+        if debug is True:
+            say('Debug Information:\noutput:\n{0}\nreturncode: {1}'.format(stdout, returncode))
+        if separate_std_out_err is True:
+            return stdout, stderr, returncode
+        return stdout, returncode
+
+    # Run commands at the same time, from blocking code. Returns their results, in order. If one of them raises
+    # (ie raise_on_failure), the others are killed and it is raised here:
+    def runAll(self, cmds, **kwargs):
+        async def runAll():
+            tasks = [asyncio.ensure_future(self.run(cmd, **kwargs)) for cmd in cmds]
+            try:
+                return await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(runAll())
+        finally:
+            loop.close()
+
+
+# The runner of this process:
+g_async_runner = AsyncRunner()
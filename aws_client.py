@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# In-process, pooled AWS clients.
+# Every 'aws ec2 ...' command pays for a python startup, credential resolution and a new TLS
+# handshake.  The clients here are created once per (service, region, environment) and kept
+# around, so the http connections underneath them stay alive between calls.
+import datetime
+import threading
+import boto3
+import botocore.config
+from botocore.exceptions import ClientError
+from metrics import g_metrics
+from rate_limiter import g_rate_limiter
+
+# Cached clients. Key is (service_name, region, env). Value is (aws_access_key_id, client):
+g_clients = {}
+g_clients_lock = threading.Lock()
+
+# A capture.TraceRecorder or TraceReplayer (--capture/--replay), that every call goes through. None when off:
+g_trace = None
+
+# Botocore keeps a pool of keep-alive connections per client. It does not retry: call() does, with the
+# rate limiter's backoff and the retry budget of the call site:
+g_client_config = botocore.config.Config(max_pool_connections=25,
+                                         retries={'max_attempts': 0})
+
+
+# The credentials of one environment (account). Passed around instead of swapping os.environ,
+# so that several environments can be worked on at the same time:
+class AwsCredentials(object):
+    def __init__(self, env=None, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None,
+                 expiration=None, account_id=None):
+        self.env = env
+        self.account_id = account_id
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.aws_session_token = aws_session_token
+        # When these (STS) credentials expire. A datetime, or None if they do not:
+        self.expiration = expiration
+
+    # Seconds until these credentials expire, or None if they do not:
+    def secondsLeft(self):
+        if self.expiration is None:
+            return None
+        return (self.expiration - datetime.datetime.now(self.expiration.tzinfo)).total_seconds()
+
+    # Get the pooled client of this environment:
+    def getClient(self, service_name, region):
+        return getClient(service_name, region, env=self.env,
+                         aws_access_key_id=self.aws_access_key_id,
+                         aws_secret_access_key=self.aws_secret_access_key,
+                         aws_session_token=self.aws_session_token,
+                         account_id=self.account_id)
+
+
+# Get a long lived client. env is only a name used to keep clients of different accounts apart. Calls are rate
+# limited per account_id (AWS limits are per account and region); envs of the same account share their limits:
+def getClient(service_name, region, env=None, aws_access_key_id=None,
+              aws_secret_access_key=None, aws_session_token=None, account_id=None):
+    key = (service_name, region, env)
+    with g_clients_lock:
+        cached = g_clients.get(key)
+        # Re-use the client, unless the credentials for this env have changed (new STS session):
+        if cached is not None and cached[0] == aws_access_key_id:
+            return cached[1]
+        # boto3 sessions are not thread safe, but the clients they create are:
+        session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key,
+                                        aws_session_token=aws_session_token)
+        client = session.client(service_name, region_name=region, config=g_client_config)
+        # So that call() does not have to look them up:
+        client.pool_env = env
+        client.pool_account = env if account_id is None else account_id
+        g_clients[key] = (aws_access_key_id, client)
+        return client
+
+
+# Convert a boto3 response to the same structure that 'aws ... --output json' prints:
+def toCliTypes(obj):
+    if isinstance(obj, dict):
+        return dict((k, toCliTypes(v)) for k, v in obj.items() if k != 'ResponseMetadata')
+    if isinstance(obj, list):
+        return [toCliTypes(v) for v in obj]
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return obj
+
+
+# The env a client was created for (None if it was not created by getClient, or has no env):
+def getClientEnv(client):
+    return getattr(client, 'pool_env', None)
+
+
+# The account whose rate limits a client's calls count against (its env if the account is not known):
+def getClientAccount(client):
+    return getattr(client, 'pool_account', None)
+
+
+# Call an operation. Just like the aws cli, paginated operations return the complete result.
+# Throttled and transient errors are retried, up to 'retries' times (None: the rate limiter's default):
+def call(client, operation, retries=None, **kwargs):
+    service_name = client.meta.service_model.service_name
+    env = getClientEnv(client)
+    key = (getClientAccount(client), client.meta.region_name, service_name, operation)
+    budget = g_rate_limiter.getBudget(retries)
+
+    def callClient():
+        if client.can_paginate(operation):
+            return toCliTypes(client.get_paginator(operation).paginate(**kwargs).build_full_result())
+        return toCliTypes(getattr(client, operation)(**kwargs))
+
+    while True:
+        g_rate_limiter.acquire(key)
+        try:
+            with g_metrics.timer('slave_manager_aws_call_seconds', service=service_name, operation=operation):
+                if g_trace is None:
+                    response = callClient()
+                else:
+                    response = g_trace.call('aws', [service_name, client.meta.region_name, env, operation],
+                                            kwargs, callClient)
+        except ClientError as err:
+            g_metrics.inc('slave_manager_aws_call_errors_total', service=service_name, operation=operation, code=getErrorCode(err))
+            if g_rate_limiter.retry(key, getErrorCode(err), budget):
+                continue
+            raise
+        except (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError):
+            g_metrics.inc('slave_manager_aws_call_errors_total', service=service_name, operation=operation, code='ConnectionError')
+            if g_rate_limiter.retry(key, 'ConnectionError', budget):
+                continue
+            raise
+        g_rate_limiter.succeeded(key)
+        return response
+
+
+# Helper to get the error code (ie 'InvalidInstanceID.NotFound') out of a ClientError:
+def getErrorCode(err):
+    return err.response.get('Error', {}).get('Code')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Record and replay what the slave manager sees: every AWS response (aws_client.call), and every
+# get_queue_jobs.groovy payload (getJenkinsQueues). A trace is a gzipped file with one json record per line:
+#   {"t": epoch secs, "tick": N, "kind": "aws"|"jenkins"|"tick", "key": [...], "request": {...},
+#    "response": ..., "error": {"Code": ..., "Message": ...}}
+# For aws, the key is [service, region, env, operation]. For jenkins, it is [script name] and the response is the
+# list of lines the script printed. STS secrets are left out of the trace.
+# Replaying hands the recorded responses back in the order they were recorded, per key. A request that is not the
+# same as the recorded one still gets the next response of its key (it is counted as a mismatch).
+import gzip
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Values of these keys are never written to a trace:
+g_secret_keys = frozenset(['SecretAccessKey', 'SessionToken'])
+
+
+# The request/response, with the secrets left out, in a form that can be compared and written as json:
+def toTraceTypes(obj):
+    if isinstance(obj, dict):
+        return dict((str(k), 'REDACTED' if k in g_secret_keys else toTraceTypes(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [toTraceTypes(v) for v in obj]
+    if obj is None or isinstance(obj, (bool, int, float)):
+        return obj
+    return str(obj)
+
+
+class TraceRecorder(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = gzip.open(path, 'wb')
+        self.tick = 0
+        self.stats = {'aws_records': 0, 'jenkins_records': 0, 'errors': 0, 'bytes': 0}
+
+    def write(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            self.fd.write(line)
+            self.stats['bytes'] += len(line)
+            if record['kind'] != 'tick':
+                self.stats[record['kind'] + '_records'] += 1
+
+    # A new queue pass. Everything recorded after this is part of it:
+    def markTick(self, tick):
+        self.tick = tick
+        self.write({'t': time.time(), 'tick': tick, 'kind': 'tick'})
+        with self.lock:
+            self.fd.flush()
+
+    # Call func() and record what it returned, or the ClientError it raised:
+    def call(self, kind, key, request, func):
+        record = {'t': time.time(), 'tick': self.tick, 'kind': kind, 'key': list(key), 'request': toTraceTypes(request)}
+        try:
+            response = func()
+        except ClientError as err:
+            record['error'] = {'Code': err.response.get('Error', {}).get('Code'),
+                               'Message': err.response.get('Error', {}).get('Message'),
+                               'operation': err.operation_name}
+            with self.lock:
+                self.stats['errors'] += 1
+            self.write(record)
+            raise
+        record['response'] = toTraceTypes(response)
+        self.write(record)
+        return response
+
+    # Yield the lines of func() (a generator), and record them once they are all read:
+    def lines(self, kind, key, request, func):
+        record = {'t': time.time(), 'tick': self.tick, 'kind': kind, 'key': list(key), 'request': toTraceTypes(request)}
+        lines = []
+        try:
+            for line in func():
+                lines.append(line)
+                yield line
+        finally:
+            record['response'] = lines
+            self.write(record)
+
+    def isExhausted(self):
+        return False
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+
+class TraceReplayer(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Key is the json of [kind] + the record key. Value is the list of records not replayed yet, in order:
+        self.records = {}
+        with gzip.open(path, 'rb') as fd:
+            for line in fd:
+                record = json.loads(line.decode('utf-8'))
+                if record['kind'] != 'tick':
+                    self.records.setdefault(json.dumps([record['kind']] + record['key']), []).append(record)
+        self.stats = {'replayed': 0, 'mismatches': 0, 'missing': 0}
+
+    # Hand back the next recorded response of this key (func is not called):
+    def call(self, kind, key, request, func):
+        with self.lock:
+            records = self.records.get(json.dumps([kind] + list(key)), [])
+            if len(records) == 0:
+                self.stats['missing'] += 1
+                raise ClientError({'Error': {'Code': 'NotInTrace', 'Message': 'Nothing left in the trace for {}'.format(key)}},
+                                  str(key[-1]))
+            record = records.pop(0)
+            self.stats['replayed'] += 1
+            if record['request'] != toTraceTypes(request):
+                self.stats['mismatches'] += 1
+        if 'error' in record:
+            raise ClientError({'Error': {'Code': record['error']['Code'], 'Message': record['error']['Message']}},
+                              record['error']['operation'])
+        return record['response']
+
+    def lines(self, kind, key, request, func):
+        for line in self.call(kind, key, request, func):
+            yield line
+
+    def markTick(self, tick):
+        pass
+
+    # True once all the jenkins payloads were replayed (there is nothing left to drive a queue pass with):
+    def isExhausted(self):
+        with self.lock:
+            return all([len(records) == 0 for key, records in self.records.items() if json.loads(key)[0] == 'jenkins'])
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats, left=sum([len(records) for records in self.records.values()]))
+
+    def close(self):
+        pass
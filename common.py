@@ -10,9 +10,12 @@ try:
 except:
     pass
 import unicodedata
-import random
 import json
 import traceback
+import aws_client
+from metrics import g_metrics
+from rate_limiter import g_rate_limiter, getBackoffSecs
+from subnet_scorer import g_subnet_scorer
 try:
     btermcolor = True
     import termcolor
@@ -96,10 +99,21 @@ def strip_unicode(s):
         return s.decode('unicode_escape').encode('ascii', 'ignore')
 
 
-# General purpose run command:
+# Helper function to get the family of a command, to break down where the time goes:
+# 'aws ec2 describe-instances ...' -> 'aws ec2', 'java -jar jenkins-cli.jar ...' -> 'java -jar', 'dig +short ...' -> 'dig'
+def getCommandFamily(cmd):
+    words = str(cmd).split()
+    if len(words) == 0:
+        return ''
+    if os.path.basename(words[0]) in ['aws', 'java'] and len(words) > 1:
+        return '{} {}'.format(os.path.basename(words[0]), words[1])
+    return os.path.basename(words[0])
+
+
+# General purpose run command. Without retry_sleep_secs, retries back off exponentially (with jitter) from half a second:
 def run(cmd, hide_command=True, raise_on_failure=True,
         separate_std_out_err=False, retry_count=0,
-        retry_sleep_secs=30, debug=False):
+        retry_sleep_secs=None, debug=False):
     try:
         xrange
     except NameError:
@@ -111,6 +125,7 @@ def run(cmd, hide_command=True, raise_on_failure=True,
         stdout = None
         stderr = None
         returncode = None
+        start = time.time()
         try:
             if separate_std_out_err is False:
                 p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, shell=True)
@@ -128,13 +143,17 @@ def run(cmd, hide_command=True, raise_on_failure=True,
             say('Exception:----------------')
             say(traceback.format_exc())
             say('--------------------------')
+        g_metrics.observe('slave_manager_subprocess_seconds', time.time() - start, family=getCommandFamily(cmd))
         if returncode != 0:
             # There was an error, lets retry, if possible:
             if i_attempt != retry_count:
                 # Only sleep if not end of the loop:
+                sleep_secs = retry_sleep_secs
+                if sleep_secs is None:
+                    sleep_secs = getBackoffSecs(i_attempt, base_secs=0.5, max_secs=30)
                 if debug is True:
-                    say('retrying command: {}, after sleeping: {}s'.format(cmd, retry_sleep_secs))
-                time.sleep(retry_sleep_secs)
+                    say('retrying command: {}, after sleeping: {:.3f}s'.format(cmd, sleep_secs))
+                g_rate_limiter.sleep('command', getCommandFamily(cmd), sleep_secs)
             continue
         else:
             # Command was success, let's not retry:
@@ -159,6 +178,16 @@ def run(cmd, hide_command=True, raise_on_failure=True,
         return output, returncode
 
 
+# Run independent commands at the same time (python 3, see async_runner.py). Takes the same arguments as run(), plus
+# a timeout (seconds) per command. Returns a list of what run() returns, in the order of cmds.
+# On python 2, they run one after the other, without the timeout:
+def runParallel(cmds, timeout=None, **kwargs):
+    if sys.version_info >= (3, 6):
+        from async_runner import g_async_runner
+        return g_async_runner.runAll(cmds, timeout=timeout, **kwargs)
+    return [run(cmd, **kwargs) for cmd in cmds]
+
+
 # Helper function to extract info from g_env_map:
 def getAzFromSubnet(target_env, subnet_id):
     for subnet in g_env_map['environments'][target_env]['vpcsubnet']:
@@ -209,44 +238,97 @@ def connect(func=None, *args, **kwargs):
 def createInstance(ami_id=None, instance_type=None, target_env=None,
                    ssh_user='ec2-user', id_rsa=None, key_name=None,
                    tags_dict={}, security_group_ids=None, instance_profile=None,
-                   debug=False, subnet_id=None):
+                   debug=False, subnet_id=None, credentials=None):
+    ec2, instance_id, subnet_id = launchInstance(ami_id=ami_id, instance_type=instance_type, target_env=target_env,
+                                                 key_name=key_name, tags_dict=tags_dict,
+                                                 security_group_ids=security_group_ids,
+                                                 instance_profile=instance_profile, debug=debug, subnet_id=subnet_id,
+                                                 credentials=credentials)
+    instance = waitUntilInstancesReady(ec2, {instance_id: subnet_id}, instance_type, ssh_user=ssh_user, id_rsa=id_rsa,
+                                       debug=debug)[instance_id]
+    say('Instance is ready!')
+    # return the complete instance json:
+    return instance
+
+
+# Run (and tag) an instance, without waiting for it. credentials is the aws_client.AwsCredentials of target_env
+# (None: the default credentials of this host). Returns (ec2 client, instance id, subnet id):
+def launchInstance(ami_id=None, instance_type=None, target_env=None, key_name=None,
+                   tags_dict={}, security_group_ids=None, instance_profile=None,
+                   debug=False, subnet_id=None, credentials=None):
     say('Creating Instance in ENV: {0}'.format(target_env), banner="*")
 
     if subnet_id is None:
-        subnet_id = random.choice(g_env_map['environments'][target_env]['vpcsubnet'])['id']
-    cmd = 'aws ec2 run-instances --region ' + g_env_map['environments'][target_env]['region'] + \
-          ' --image-id ' + ami_id + \
-          ' --key-name ' + key_name + \
-          ' --placement Tenancy=default' + \
-          ' --instance-type ' + instance_type + \
-          ' --subnet-id ' + subnet_id + \
-          ' --security-group-ids ' + security_group_ids + \
-          ' --iam-instance-profile ' + instance_profile
-
-    output, returncode = run(cmd, debug=debug, retry_count=3)
-    instance_id = json.loads(output)['Instances'][0]['InstanceId']
+        # The subnet our last launches came up the fastest in:
+        subnet_id = g_subnet_scorer.choose([subnet['id'] for subnet in g_env_map['environments'][target_env]['vpcsubnet']],
+                                           instance_type, reason='createInstance in {}'.format(target_env))
+    if credentials is None:
+        credentials = aws_client.AwsCredentials(env=str(target_env),
+                                                account_id=g_env_map['environments'][target_env]['account-id'])
+    ec2 = credentials.getClient('ec2', g_env_map['environments'][target_env]['region'])
+
+    # The instance profile can be the cli json form ('{"Arn": "..."}') or just a profile name:
+    try:
+        iam_instance_profile = json.loads(instance_profile.strip('\''))
+    except ValueError:
+        iam_instance_profile = {'Name': instance_profile}
+    if debug is True:
+        say('run-instances: ami: {}, type: {}, subnet: {}'.format(ami_id, instance_type, subnet_id))
+    try:
+        output = aws_client.call(ec2, 'run_instances',
+                                 ImageId=ami_id,
+                                 KeyName=key_name,
+                                 Placement={'Tenancy': 'default'},
+                                 InstanceType=instance_type,
+                                 SubnetId=subnet_id,
+                                 SecurityGroupIds=security_group_ids.split(),
+                                 IamInstanceProfile=iam_instance_profile,
+                                 MinCount=1, MaxCount=1)
+    except aws_client.ClientError as err:
+        g_subnet_scorer.recordLaunchError(subnet_id, instance_type, aws_client.getErrorCode(err))
+        raise
+    instance_id = str(output['Instances'][0]['InstanceId'])
+    g_subnet_scorer.recordLaunch(subnet_id, instance_type)
     say('Instance is being created: ' + instance_id)
 
-    tags_option = ''
+    # Add Tags to instance
     if len(tags_dict) != 0:
-        tags_option = ' --tags'
-        for k, v in tags_dict.items():
-            tags_option += ' Key={0},Value={1}'.format(k, v)
+        aws_client.call(ec2, 'create_tags', Resources=[instance_id],
+                        Tags=[{'Key': k, 'Value': v} for k, v in tags_dict.items()])
+    return ec2, instance_id, subnet_id
+
+
+# Wait for instances we just launched (dict of instance id -> subnet id), all at once. Returns a dict of instance
+# id -> instance json. If any of them is not ready, CreateInstanceException is raised once all were waited on:
+def waitUntilInstancesReady(ec2, subnet_ids, instance_type, ssh_user='ec2-user', id_rsa=None, debug=False):
+    if sys.version_info < (3, 6):
+        return dict([(instance_id, waitUntilReadySerial(ec2, instance_id, ssh_user=ssh_user, id_rsa=id_rsa, debug=debug))
+                     for instance_id in sorted(subnet_ids)])
+    # One describe-instance-status call per round covers all of them (see instance_readiness.py):
+    from instance_readiness import waitUntilReady
+    events = waitUntilReady(ec2, sorted(subnet_ids), ssh_user=ssh_user, id_rsa=id_rsa, debug=debug)
+    instances = {}
+    failed = None
+    for instance_id, event in sorted(events.items()):
+        if event.error is not None:
+            g_subnet_scorer.recordFailure(subnet_ids[instance_id], instance_type, error_code=event.error)
+            failed = failed or event
+            continue
+        g_subnet_scorer.recordRunning(subnet_ids[instance_id], instance_type, event.seconds)
+        instances[instance_id] = event.instance
+    if failed is not None:
+        raise CreateInstanceException(failed.error, instance_id=failed.instance_id)
+    return instances
 
-    # Add Tags to instance
-    cmd = 'aws ec2 create-tags --region ' + g_env_map['environments'][target_env]['region'] + \
-          ' --resources ' + str(instance_id) + tags_option
-    output, returncode = run(cmd, debug=debug, retry_count=3)
 
+# Wait for an instance to be running, pass its status checks and be ssh-able, one check at a time (python 2):
+def waitUntilReadySerial(ec2, instance_id, ssh_user='ec2-user', id_rsa=None, debug=False):
     # Wait up to 5 min for instance to be ready:
-    cmd = 'aws ec2 describe-instance-status --region ' + g_env_map['environments'][target_env]['region'] + \
-          ' --instance-ids ' + str(instance_id)
     bInstanceReady = False
     loop_counter = 120
     say('Waiting for instance to be ready...')
     for i in range(loop_counter):
-        output, returncode = run(cmd, debug=debug, retry_count=3)
-        j = json.loads(output)
+        j = aws_client.call(ec2, 'describe_instance_status', InstanceIds=[str(instance_id)])
         if len(j['InstanceStatuses']) == 0:
             current_state = 'UNKNOWN'
             current_system_status = 'UNKNOWN'
@@ -267,12 +349,10 @@ def createInstance(ami_id=None, instance_type=None, target_env=None,
         raise CreateInstanceException("Instance_Not_Started", instance_id=str(instance_id))
 
     # Wait for ssh. First get the IP address:
-    cmd = 'aws ec2 describe-instances --region ' + g_env_map['environments'][target_env]['region'] +\
-          ' --instance-ids ' + str(instance_id)
-    output, returncode = run(cmd, debug=debug, retry_count=3)
+    output = aws_client.call(ec2, 'describe_instances', InstanceIds=[str(instance_id)])
     # Now that the instance is up and runing and has a public-ip, that is what
     # we want to return:
-    instance = json.loads(output)['Reservations'][0]['Instances'][0]
+    instance = output['Reservations'][0]['Instances'][0]
     ip_addresses = []
     ip_address_used = None
     if 'PrivateIpAddress' in instance:
@@ -302,7 +382,4 @@ def createInstance(ami_id=None, instance_type=None, target_env=None,
     if bInstanceSshReady is False:
         say('***Error: We waited 5 min for instance to be ssh-able and its not.')
         raise CreateInstanceException("Instance_not_ssh_able", instance_id=str(instance_id))
-
-    say('Instance is ready!')
-    # return the complete instance json:
     return instance
@@ -7,7 +7,8 @@ import time
 import uuid
 import random
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from common import run, say, getAzFromSubnet, createInstance, g_env_map
+from common import run, runParallel, say, getAzFromSubnet, createInstance, g_env_map
+from subnet_scorer import g_subnet_scorer
 
 try:
     input = raw_input
@@ -168,12 +169,13 @@ def run_ssh(cmd, raise_on_failure=True):
     return output, returncode
 
 
-# Generic scp command:
-def run_scp(local_file, destination):
+# Generic scp command. Copies local files to the same destination, all at once:
+def run_scp(local_files, destination):
     scp_cmd = 'scp {} '.format(g_id_rsa_option)
-    output, returncode = run(scp_cmd + ' {} {}@{}:{}'.format(local_file, g_args.ssh_user, g_new_instance_ip_address, destination),
-                             hide_command=g_hide_command, debug=g_args.debug)
-    say(output)
+    results = runParallel([scp_cmd + ' {} {}@{}:{}'.format(local_file, g_args.ssh_user, g_new_instance_ip_address, destination)
+                           for local_file in local_files], timeout=600, hide_command=g_hide_command, debug=g_args.debug)
+    for output, returncode in results:
+        say(output)
 
 
 # Run some post scripts to setup the instance:
@@ -209,13 +211,21 @@ def configureInstance(volume_size=None, default_rpm=None, is_new_instance=True):
     # Make sure /etc/fstab is OK:
     run_ssh('sudo mount -a')
 
+    # The downloads and copies do not depend on each other (or on the packages), so they all go at once:
+    pre_cmd = '{} -t {}@{} '.format(g_ssh_cmd, g_args.ssh_user, g_new_instance_ip_address)
+    for output, returncode in runParallel([pre_cmd + '\'cd /tmp && wget --quiet {}\''.format(default_rpm),
+                                           pre_cmd + '\'sudo wget --quiet https://bootstrap.pypa.io/get-pip.py\''],
+                                          timeout=900, hide_command=g_hide_command, debug=g_args.debug):
+        say(output)
+    run_scp([os.path.abspath(os.path.join(os.path.dirname(__file__), name))
+                 for name in ['logrotate_jenkins', 'install_nginx.sh', 'nginx.conf', 'etc.init.d.nginx']], '/tmp')
+
     # Install some packages:
     run_ssh('sudo yum -y install git')
     run_ssh('sudo yum -y install java-1.8.0-openjdk-devel')
     run_ssh('sudo alternatives --set java /usr/lib/jvm/jre-1.8.0-openjdk.x86_64/bin/java')
 
-    # Install Jenkins:
-    run_ssh('cd /tmp && wget --quiet {}'.format(default_rpm))
+    # Install Jenkins (downloaded above):
     run_ssh('cd /tmp && sudo yum -y install {}'.format(default_rpm))
 
     if is_new_instance is True:
@@ -227,22 +237,17 @@ def configureInstance(volume_size=None, default_rpm=None, is_new_instance=True):
     run_ssh('sudo rm -rf /var/lib/jenkins')
     run_ssh('sudo ln -s /var/build/jenkins/ /var/lib/jenkins')
 
-    # Install pip and virtualenv:
-    run_ssh('sudo wget --quiet https://bootstrap.pypa.io/get-pip.py')
+    # Install pip and virtualenv (get-pip.py was downloaded above):
     run_ssh('sudo python get-pip.py')
     run_ssh('sudo pip install virtualenv')
     run_ssh('sudo pip install termcolor')
     run_ssh('sudo pip install requests==2.18.4')
 
-    # Install logrotate:
-    run_scp(os.path.abspath(os.path.join(os.path.dirname(__file__), 'logrotate_jenkins')), '/tmp')
+    # Install logrotate (copied above):
     run_ssh('sudo mv /tmp/logrotate_jenkins /etc/logrotate.d/')
     run_ssh('sudo chown root:root /etc/logrotate.d/logrotate_jenkins')
 
-    # Install and run nginx:
-    run_scp(os.path.abspath(os.path.join(os.path.dirname(__file__), 'install_nginx.sh')), '/tmp')
-    run_scp(os.path.abspath(os.path.join(os.path.dirname(__file__), 'nginx.conf')), '/tmp')
-    run_scp(os.path.abspath(os.path.join(os.path.dirname(__file__), 'etc.init.d.nginx')), '/tmp')
+    # Install and run nginx (copied above):
     run_ssh('sudo mv /tmp/nginx.conf /var/build/jenkins/')
     run_ssh('sudo mv /tmp/etc.init.d.nginx /var/build/jenkins/')
     run_ssh('sudo bash /tmp/install_nginx.sh')
@@ -333,7 +338,8 @@ if __name__ == "__main__":
         sys.exit(1)
 
     snapshot_id = None
-    subnet_id = random.choice(g_env_map['environments'][g_args.target_env]['vpcsubnet'])['id']
+    subnet_id = g_subnet_scorer.choose([subnet['id'] for subnet in g_env_map['environments'][g_args.target_env]['vpcsubnet']],
+                                       g_args.instance_type, reason='new jenkins master')
     az = getAzFromSubnet(target_env=g_args.target_env, subnet_id=subnet_id)
     if b_new_instance is False:
         say('Cloning existing jenkins master from: '.format(g_args.current_master_ip))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Wait for new instances to be running, pass their status checks and be ssh-able. Many instances at once.
+# This is python 3 only (asyncio). common.waitUntilInstancesReady only imports it on python 3.
+# - Every round, one describe-instance-status call covers all the instances that are still booting.
+# - Once an instance passes its status checks, ssh is tried on its private and public ip at the same time.
+# - Rounds start short apart and back off while nothing changes. They go back to short when something does.
+# - Each instance is reported (ReadyEvent) as soon as it is ready or has failed, not when all of them are.
+import asyncio
+import collections
+import random
+import shlex
+import time
+
+from botocore.exceptions import ClientError
+
+import aws_client
+from async_runner import g_async_runner
+from common import say
+
+# What happened to an instance. error is None if it is ready, else why it is not (ie 'Instance_Not_Started'):
+ReadyEvent = collections.namedtuple('ReadyEvent', ['instance_id', 'instance', 'ip_address', 'error', 'seconds'])
+
+
+# Jittered, growing delay between polls:
+class Backoff(object):
+    def __init__(self, min_delay, max_delay, factor=1.5):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.delay = min_delay
+
+    def reset(self):
+        self.delay = self.min_delay
+
+    def next(self):
+        delay = self.delay * random.uniform(0.8, 1.2)
+        self.delay = min(self.delay * self.factor, self.max_delay)
+        return delay
+
+
+class ReadinessWaiter(object):
+    def __init__(self, ec2, ssh_user='ec2-user', id_rsa=None, status_timeout=600, ssh_timeout=300,
+                 min_delay=2, max_delay=20, debug=False):
+        self.ec2 = ec2
+        self.ssh_user = ssh_user
+        self.status_timeout = status_timeout
+        self.ssh_timeout = ssh_timeout
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.debug = debug
+        self.ssh_cmd = ['ssh', '-o', 'ControlMaster=no', '-o', 'ConnectTimeout=30', '-n', '-o', 'BatchMode=yes',
+                        '-o', 'PreferredAuthentications=publickey', '-o', 'StrictHostKeyChecking=no',
+                        '-o', 'UserKnownHostsFile=/dev/null']
+        if id_rsa is not None:
+            self.ssh_cmd += ['-i', id_rsa]
+        # Key is instance id, value is when we started waiting for it:
+        self.started = {}
+        # The instances that have not passed their status checks yet:
+        self.booting = set()
+        self.ssh_tasks = set()
+        self.queue = None
+
+    def add(self, instance_id):
+        self.started[str(instance_id)] = time.time()
+
+    def report(self, instance_id, instance=None, ip_address=None, error=None):
+        event = ReadyEvent(instance_id=instance_id, instance=instance, ip_address=ip_address, error=error,
+                           seconds=round(time.time() - self.started[instance_id], 1))
+        if error is None:
+            say('Instance {} is ready after {}s (ssh on {}).'.format(instance_id, event.seconds, ip_address))
+        else:
+            say('***Error: Instance {} is not ready after {}s: {}'.format(instance_id, event.seconds, error))
+        self.queue.put_nowait(event)
+
+    # boto3 blocks, so the calls run in the default thread pool (get_running_loop is python 3.7+):
+    async def call(self, operation, **kwargs):
+        loop = asyncio.get_running_loop() if hasattr(asyncio, 'get_running_loop') else asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: aws_client.call(self.ec2, operation, **kwargs))
+
+    async def waitForStatus(self):
+        backoff = Backoff(self.min_delay, self.max_delay)
+        last_status = {}
+        while len(self.booting) != 0:
+            instance_ids = sorted(self.booting)
+            try:
+                j = await self.call('describe_instance_status', InstanceIds=instance_ids, IncludeAllInstances=True)
+                statuses = dict([(str(s['InstanceId']), s) for s in j['InstanceStatuses']])
+            except ClientError as err:
+                # A new instance can take a few seconds to show up:
+                if aws_client.getErrorCode(err) != 'InvalidInstanceID.NotFound':
+                    raise
+                statuses = {}
+            ready_ids = []
+            for instance_id in instance_ids:
+                s = statuses.get(instance_id)
+                status = ('UNKNOWN', 'UNKNOWN', 'UNKNOWN') if s is None else (str(s['InstanceState']['Name']),
+                                                                              str(s['SystemStatus']['Status']),
+                                                                              str(s['InstanceStatus']['Status']))
+                if status != last_status.get(instance_id):
+                    last_status[instance_id] = status
+                    backoff.reset()
+                    say('Instance {}: state: {}, system status: {}, instance status: {}'.format(instance_id, *status),
+                        do_print=self.debug)
+                if status == ('running', 'ok', 'ok'):
+                    ready_ids.append(instance_id)
+                elif status[0] in ['shutting-down', 'terminated', 'stopping', 'stopped']:
+                    self.booting.discard(instance_id)
+                    self.report(instance_id, error='Instance_Not_Started')
+                elif time.time() - self.started[instance_id] > self.status_timeout:
+                    self.booting.discard(instance_id)
+                    self.report(instance_id, error='Instance_Not_Started')
+            if len(ready_ids) != 0:
+                # Get the ip addresses of all the instances that just passed:
+                j = await self.call('describe_instances', InstanceIds=ready_ids)
+                for r in j['Reservations']:
+                    for instance in r['Instances']:
+                        self.booting.discard(str(instance['InstanceId']))
+                        self.ssh_tasks.add(asyncio.ensure_future(self.waitForSsh(instance)))
+            if len(self.booting) != 0:
+                await asyncio.sleep(backoff.next())
+
+    # Returns ip if we can ssh into it. The probe that loses the race is cancelled, which kills its ssh:
+    async def ssh(self, ip):
+        cmd = ' '.join([shlex.quote(arg) for arg in self.ssh_cmd + ['{}@{}'.format(self.ssh_user, ip), 'echo hello world']])
+        output, returncode = await g_async_runner.run(cmd, raise_on_failure=False, timeout=45)
+        return ip if returncode == 0 else None
+
+    async def waitForSsh(self, instance):
+        instance_id = str(instance['InstanceId'])
+        ip_addresses = [instance[k] for k in ['PrivateIpAddress', 'PublicIpAddress'] if k in instance]
+        backoff = Backoff(self.min_delay, self.max_delay)
+        start = time.time()
+        while True:
+            # Whichever ip answers first:
+            probes = [asyncio.ensure_future(self.ssh(ip)) for ip in ip_addresses]
+            ip_address = None
+            try:
+                for probe in asyncio.as_completed(probes):
+                    ip_address = await probe
+                    if ip_address is not None:
+                        break
+            finally:
+                for probe in probes:
+                    probe.cancel()
+            if ip_address is not None:
+                self.report(instance_id, instance=instance, ip_address=ip_address)
+                return
+            if time.time() - start > self.ssh_timeout:
+                self.report(instance_id, instance=instance, error='Instance_not_ssh_able')
+                return
+            say('Instance {}: waiting for ssh to work on {}.'.format(instance_id, ip_addresses), do_print=self.debug)
+            await asyncio.sleep(backoff.next())
+
+    async def runStatus(self):
+        try:
+            await self.waitForStatus()
+        except Exception as err:
+            for instance_id in sorted(self.booting):
+                self.report(instance_id, error='Instance_Status_Error: {}'.format(err))
+            self.booting = set()
+
+    # Yields a ReadyEvent per instance, in the order they get ready (or fail):
+    async def events(self):
+        self.queue = asyncio.Queue()
+        self.booting = set(self.started.keys())
+        status_task = asyncio.ensure_future(self.runStatus())
+        try:
+            for i in range(len(self.started)):
+                yield await self.queue.get()
+        finally:
+            status_task.cancel()
+            for task in self.ssh_tasks:
+                task.cancel()
+
+
+# Wait for instances from blocking code. on_event(event) is called as each one gets ready.
+# Returns a dict of instance id -> ReadyEvent:
+def waitUntilReady(ec2, instance_ids, on_event=None, **kwargs):
+    async def collect():
+        waiter = ReadinessWaiter(ec2, **kwargs)
+        for instance_id in instance_ids:
+            waiter.add(instance_id)
+        events = {}
+        async for event in waiter.events():
+            events[event.instance_id] = event
+            if on_event is not None:
+                on_event(event)
+        return events
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(collect())
+    finally:
+        loop.close()
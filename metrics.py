@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Counters, gauges and latency histograms of the slave manager, in the Prometheus text format.
+# - Counters only go up (ie aws errors by operation and code).
+# - Gauges are set to what they are right now (ie instances per label), every tick.
+# - Histograms count observations (seconds) into fixed buckets, so percentiles can be worked out later, and
+#   keep their sum. Phases are timed with 'with g_metrics.timer(name, phase=...):'.
+# The text is written to a file (for the node exporter textfile collector) and/or served on a local port.
+import contextlib
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds (seconds) of the latency buckets. +Inf is added when rendering:
+g_default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+# Helper function to render a label set ({'operation': 'describe_instances'}) the way prometheus wants it:
+def formatLabels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                           for k, v in labels]) + '}'
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    def __init__(self, name, kind, help_text, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.buckets = tuple(buckets or g_default_buckets)
+        # Key is the sorted tuple of (label, value). Value is a number, or for histograms [bucket counts, sum, count]:
+        self.series = {}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Key is the metric name:
+        self.metrics = {}
+        self.server = None
+
+    # Give a metric its type and help text. Metrics that are used without this get the type of their first use:
+    def describe(self, name, kind, help_text, buckets=None):
+        with self.lock:
+            self.metrics[name] = Metric(name, kind, help_text, buckets=buckets)
+
+    def getMetric(self, name, kind):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Metric(name, kind, name)
+        return metric
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.getMetric(name, 'counter').series
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.getMetric(name, 'gauge').series[tuple(sorted(labels.items()))] = value
+
+    # Replace all the series of a gauge that have 'labels' with values, a list of (dict of labels, value).
+    # So what is gone (ie a label with no instances left) does not stick around at its last value:
+    def setAll(self, name, values, **labels):
+        with self.lock:
+            metric = self.getMetric(name, 'gauge')
+            for key in [key for key in metric.series.keys() if set(labels.items()) <= set(key)]:
+                del metric.series[key]
+            for series_labels, value in values:
+                metric.series[tuple(sorted(dict(series_labels, **labels).items()))] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            metric = self.getMetric(name, 'histogram')
+            key = tuple(sorted(labels.items()))
+            series = metric.series.get(key)
+            if series is None:
+                series = metric.series[key] = [[0] * len(metric.buckets), 0.0, 0]
+            for i, bound in enumerate(metric.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    # Returns a dict of label tuple -> (count, sum) of a histogram, ie to see how much of it happened in between:
+    def getTotals(self, name):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                return {}
+            return dict([(key, (value[2], value[1])) for key, value in metric.series.items()])
+
+    # Time the body of a 'with' block into a histogram (also when it raises):
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    # The numbers of a stats dict (the ones written to the properties_*.csv files), as one gauge:
+    def setStats(self, group, stats_dict):
+        self.setAll('slave_manager_stat', [({'stat': key}, value) for key, value in dict(stats_dict).items()
+                                           if isinstance(value, (int, float)) and not isinstance(value, bool)],
+                    group=group)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics.keys()):
+                metric = self.metrics[name]
+                lines.append('# HELP {} {}'.format(name, metric.help_text))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+                for key in sorted(metric.series.keys()):
+                    value = metric.series[key]
+                    if metric.kind != 'histogram':
+                        lines.append('{}{} {}'.format(name, formatLabels(key), formatValue(value)))
+                        continue
+                    # The bucket counts are cumulative already:
+                    for bound, count in zip(metric.buckets + (float('inf'),), value[0] + [value[2]]):
+                        lines.append('{}_bucket{} {}'.format(name, formatLabels(key + (('le', formatValue(bound)),)), count))
+                    lines.append('{}_sum{} {}'.format(name, formatLabels(key), formatValue(value[1])))
+                    lines.append('{}_count{} {}'.format(name, formatLabels(key), value[2]))
+        return '\n'.join(lines) + '\n'
+
+    # Write the text file in one go, so a scrape never reads half of it:
+    def writeTextFile(self, path):
+        with open(path + '.tmp', 'wt') as fd:
+            fd.write(self.render())
+        os.rename(path + '.tmp', path)
+
+    # Serve the metrics on http://host:port/metrics from a daemon thread:
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a log line each:
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+
+# The metrics of this process:
+g_metrics = Metrics()
+g_metrics.describe('slave_manager_aws_call_seconds', 'histogram', 'Seconds per AWS api call, by service and operation.')
+g_metrics.describe('slave_manager_aws_call_errors_total', 'counter', 'AWS api calls that failed, by service, operation and error code.')
+g_metrics.describe('slave_manager_jenkins_call_seconds', 'histogram', 'Seconds per call to the jenkins master, by call.')
+g_metrics.describe('slave_manager_subprocess_seconds', 'histogram', 'Seconds per command run by common.run(), by command family.')
+g_metrics.describe('slave_manager_subprocess_timeouts_total', 'counter', 'Commands that were killed because they ran past their timeout, by command family.')
+g_metrics.describe('slave_manager_throttles_total', 'counter', 'Calls that were throttled, by service and operation.')
+g_metrics.describe('slave_manager_backoff_seconds_total', 'counter', 'Seconds spent backing off before a retry, by service and operation.')
+g_metrics.describe('slave_manager_rate_limit_wait_seconds_total', 'counter', 'Seconds spent waiting on the client side rate limit, by service and operation.')
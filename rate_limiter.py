@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Client side rate limiting and retries of the AWS and jenkins calls.
+# - Every (account, region, service, operation) has a token bucket. A call waits for a token, so a burst of calls
+#   is spread out before AWS has to throttle it.
+# - When a call is throttled, the rate of its bucket is halved. Every call that goes through adds a little back,
+#   up to the rate it started with.
+# - Failed calls are retried after an exponential backoff with full jitter, that starts at a few milliseconds.
+#   A throttled describe-instances costs a fraction of a second, not the 30s that common.run() used to sleep.
+# - Each call site has a retry budget: a number of retries, and a max total backoff time. Once it is spent, the
+#   error goes to the caller (ie the queue pass tries again next tick).
+# Throttles, retries, backoff and rate limit waits are counted in the stats and the metrics.
+import random
+import threading
+import time
+
+from metrics import g_metrics
+
+# Error codes that mean 'slow down'. The bucket rate is cut, and the call is retried:
+g_throttle_codes = frozenset(['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                              'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                              'TooManyRequests', 'ProvisionedThroughputExceededException', 'SlowDown',
+                              'EC2ThrottledException', 'BandwidthLimitExceeded', 'PriorRequestNotComplete'])
+# Error codes that are worth another try, as is:
+g_transient_codes = frozenset(['InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable',
+                               'RequestTimeout', 'RequestTimeoutException', 'ConnectionError'])
+# These create something every time (an instance, a jenkins build). They are only retried when throttled (the
+# server did not run them at all):
+g_not_idempotent = frozenset(['run_instances', 'request_spot_instances', 'build'])
+
+
+# Seconds to back off before retry number 'attempt' (0 is the first retry). Full jitter:
+def getBackoffSecs(attempt, base_secs=0.05, max_secs=5.0):
+    return random.uniform(0, min(max_secs, base_secs * 2 ** attempt))
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, min_rate=0.2):
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_rate = min_rate
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token. Returns the seconds to wait until it is ours (0 if one was there):
+    def take(self):
+        with self.lock:
+            self.refill(time.time())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # AWS throttled us. Halve the rate, and start with an empty bucket:
+    def throttled(self):
+        with self.lock:
+            self.refill(time.time())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    # A call went through. Win back some of the rate:
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.base_rate:
+                self.refill(time.time())
+                self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+# The retries left to one call:
+class RetryBudget(object):
+    def __init__(self, retries, backoff_secs):
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.attempt = 0
+
+
+class RateLimiter(object):
+    def __init__(self, max_retries=4, max_backoff_secs=10.0, base_secs=0.05, max_sleep_secs=5.0):
+        self.max_retries = max_retries
+        self.max_backoff_secs = max_backoff_secs
+        self.base_secs = base_secs
+        self.max_sleep_secs = max_sleep_secs
+        self.lock = threading.Lock()
+        # Key is (account, region, service, operation):
+        self.buckets = {}
+        self.stats = {'calls': 0, 'throttles': 0, 'retries': 0, 'budget_exhausted': 0, 'backoff_secs': 0.0,
+                      'wait_secs': 0.0}
+
+    def addStat(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    # Calls per second (and burst) of a bucket. Below what AWS allows per account, which other callers share:
+    def getRate(self, service, operation):
+        if service == 'jenkins':
+            return 5, 20
+        if operation.split('_')[0] in ['describe', 'get', 'list', 'receive']:
+            return 20, 50
+        return 5, 50
+
+    def getBucket(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                rate, burst = self.getRate(key[2], key[3])
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    # A budget with the defaults, unless the call site asks for fewer (or more) retries:
+    def getBudget(self, retries=None):
+        return RetryBudget(self.max_retries if retries is None else retries, self.max_backoff_secs)
+
+    # Wait for a token of the bucket of key = (account, region, service, operation):
+    def acquire(self, key):
+        self.addStat('calls')
+        wait_secs = self.getBucket(key).take()
+        if wait_secs > 0:
+            self.addStat('wait_secs', wait_secs)
+            g_metrics.inc('slave_manager_rate_limit_wait_seconds_total', wait_secs, service=key[2], operation=key[3])
+            time.sleep(wait_secs)
+
+    def succeeded(self, key):
+        self.getBucket(key).succeeded()
+
+    # Sleep, and count it as backoff:
+    def sleep(self, service, operation, secs):
+        self.addStat('backoff_secs', secs)
+        g_metrics.inc('slave_manager_backoff_seconds_total', secs, service=service, operation=operation)
+        time.sleep(secs)
+
+    # A call failed with error code 'code'. Returns True after backing off if it should be tried again, False if
+    # it should not (not retryable, or its budget is spent):
+    def retry(self, key, code, budget):
+        if code in g_throttle_codes:
+            self.addStat('throttles')
+            g_metrics.inc('slave_manager_throttles_total', service=key[2], operation=key[3])
+            self.getBucket(key).throttled()
+        elif code not in g_transient_codes or key[3] in g_not_idempotent:
+            return False
+        if budget.attempt >= budget.retries or budget.backoff_secs <= 0:
+            self.addStat('budget_exhausted')
+            return False
+        secs = min(getBackoffSecs(budget.attempt, self.base_secs, self.max_sleep_secs), budget.backoff_secs)
+        budget.attempt += 1
+        budget.backoff_secs -= secs
+        self.addStat('retries')
+        self.sleep(key[2], key[3], secs)
+        return True
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats, backoff_secs=round(self.stats['backoff_secs'], 3),
+                         wait_secs=round(self.stats['wait_secs'], 3))
+            stats['throttled_buckets'] = len([bucket for bucket in self.buckets.values() if bucket.rate < bucket.base_rate])
+        return stats
+
+
+# The limiter of this process:
+g_rate_limiter = RateLimiter()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Forecast of how many queue items will show up for each label in the next few minutes.
+# Two views of the arrival history of a label are kept:
+# - A short term rate: an exponentially weighted moving average (EWMA) of the arrivals per bucket (ie a minute).
+# - A seasonal profile: per time-of-week slot (ie Monday 09:00-09:15), an EWMA of the arrivals in that slot over
+#   the past weeks. This is what sees the morning push coming before it starts. It is saved in the state store,
+#   so it survives a restart.
+# The forecast is the larger of the two. The slave manager uses it to start stopped instances ahead of a burst,
+# and we keep score of how much queue wait that saved.
+import math
+import threading
+import time
+
+# Seconds in a week. Slots are counted from the epoch, so they line up from one week to the next:
+g_week_secs = 7 * 24 * 3600
+
+
+class ArrivalForecaster(object):
+    def __init__(self, bucket_secs=60, half_life_secs=900, slot_secs=900, season_alpha=0.3, cold_start_secs=180,
+                 store=None):
+        self.bucket_secs = bucket_secs
+        # How much of the rate is kept from one bucket to the next:
+        self.decay = 0.5 ** (float(bucket_secs) / half_life_secs)
+        self.slot_secs = slot_secs
+        self.season_alpha = season_alpha
+        # How long a queue item waits for a stopped instance to start and connect (what a pre-warm saves at most):
+        self.cold_start_secs = cold_start_secs
+        self.store = store
+        self.lock = threading.Lock()
+        # Key is label. Value is the EWMA of arrivals per second:
+        self.rates = {}
+        # Key is label. Value is the number of arrivals in the current bucket / current slot:
+        self.bucket_counts = {}
+        self.slot_counts = {}
+        self.bucket_start = None
+        self.slot_start = None
+        # Key is (label, slot of the week). Value is the EWMA of the arrivals in that slot:
+        self.seasonal = store.getArrivalHistory() if store is not None else {}
+        # Key is the instance id we pre-warmed. Value is [label, when it was started, was it used]:
+        self.prewarmed = {}
+        self.stats = {'arrivals': 0, 'prewarm_starts': 0, 'prewarm_hits': 0, 'prewarm_misses': 0,
+                      'saved_wait_secs': 0.0}
+
+    def getSlot(self, when):
+        return int((when % g_week_secs) // self.slot_secs)
+
+    # Close the buckets and slots that ended before 'now':
+    def advance(self, now):
+        if self.bucket_start is None:
+            self.bucket_start = now - now % self.bucket_secs
+            self.slot_start = now - now % self.slot_secs
+        num_buckets = int((now - self.bucket_start) // self.bucket_secs)
+        if num_buckets > 0:
+            labels = set(self.rates.keys()) | set(self.bucket_counts.keys())
+            for label in labels:
+                rate = self.rates.get(label, 0.0)
+                # Only the first closed bucket has arrivals. The rest were empty:
+                rate = rate * self.decay + (1 - self.decay) * self.bucket_counts.get(label, 0) / float(self.bucket_secs)
+                rate *= self.decay ** (num_buckets - 1)
+                self.rates[label] = rate
+            self.bucket_counts = {}
+            self.bucket_start += num_buckets * self.bucket_secs
+        while now - self.slot_start >= self.slot_secs:
+            slot = self.getSlot(self.slot_start)
+            for label in set([l for l, _ in self.seasonal.keys()]) | set(self.slot_counts.keys()):
+                count = self.slot_counts.get(label, 0)
+                previous = self.seasonal.get((label, slot))
+                if previous is None and count == 0:
+                    continue
+                value = count if previous is None else (1 - self.season_alpha) * previous + self.season_alpha * count
+                self.seasonal[(label, slot)] = value
+                if self.store is not None:
+                    self.store.setArrivalHistory(label, slot, value)
+            self.slot_counts = {}
+            self.slot_start += self.slot_secs
+            if now - self.slot_start > g_week_secs:
+                # We were not running for over a week. Skip ahead rather than decaying every slot:
+                self.slot_start = now - now % self.slot_secs
+
+    # Record queue items that just showed up. labels is a list with one label per item:
+    def recordArrivals(self, labels, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.advance(now)
+            for label in labels:
+                self.stats['arrivals'] += 1
+                self.bucket_counts[label] = self.bucket_counts.get(label, 0) + 1
+                self.slot_counts[label] = self.slot_counts.get(label, 0) + 1
+                self.creditPrewarm(label, now)
+            self.expirePrewarms(now)
+
+    # Expected number of arrivals for a label in the next 'horizon' seconds:
+    def forecast(self, label, horizon, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.advance(now)
+            ewma = self.rates.get(label, 0.0) * horizon
+            seasonal = 0.0
+            t = now
+            while t < now + horizon:
+                slot_end = t - t % self.slot_secs + self.slot_secs
+                overlap = min(slot_end, now + horizon) - t
+                seasonal += self.seasonal.get((label, self.getSlot(t)), 0.0) * overlap / self.slot_secs
+                t = slot_end
+            return max(ewma, seasonal)
+
+    # The forecast of every label we have seen:
+    def forecastAll(self, horizon, now=None):
+        with self.lock:
+            labels = set(self.rates.keys()) | set([label for label, _ in self.seasonal.keys()])
+        return dict([(label, self.forecast(label, horizon, now=now)) for label in labels])
+
+    # Remember that we started an instance ahead of demand:
+    def recordPrewarm(self, label, instance_id, now=None):
+        with self.lock:
+            self.prewarmed[str(instance_id)] = [label, time.time() if now is None else now, False]
+            self.stats['prewarm_starts'] += 1
+
+    def forgetPrewarm(self, instance_id):
+        with self.lock:
+            if self.prewarmed.pop(str(instance_id), None) is not None:
+                self.stats['prewarm_starts'] -= 1
+
+    # An item showed up for a label we pre-warmed an instance for. It waits that much less (up to a cold start):
+    def creditPrewarm(self, label, now):
+        for instance_id, prewarm in sorted(self.prewarmed.items(), key=lambda p: p[1][1]):
+            if prewarm[0] == label and prewarm[2] is False:
+                prewarm[2] = True
+                self.stats['prewarm_hits'] += 1
+                self.stats['saved_wait_secs'] += min(now - prewarm[1], self.cold_start_secs)
+                return
+
+    # Pre-warmed instances that nothing showed up for (within a few cold starts) were a miss:
+    def expirePrewarms(self, now):
+        for instance_id, (label, started, used) in list(self.prewarmed.items()):
+            if now - started > 4 * self.cold_start_secs:
+                del self.prewarmed[instance_id]
+                if used is False:
+                    self.stats['prewarm_misses'] += 1
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['saved_wait_secs'] = int(math.ceil(stats['saved_wait_secs']))
+        return stats
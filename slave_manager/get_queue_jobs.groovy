@@ -1,215 +1,375 @@
-import groovy.json.*;
-
-// The only args to the script are valid amis.
-// We need a try/catch because running this in Jenkins causes an exception:
-valid_ami_list = ["UNKNOWN"];
-try {
-    valid_ami_list = valid_ami_list + (java.util.ArrayList)(args);
-} catch (groovy.lang.MissingPropertyException e) {
-    // An ami-id that is UNKNOWN (ie the script can't figure out what the AMI ID is)
-}
-
-return_queue = ["build_queue": [], "slave_queue": [], "messages":[]]
-
-// Read the build queue:.
-for (anItem in hudson.model.Hudson.instance.getQueue().getItems()) {
-    if (anItem.isBlocked() == true){
-        continue;
-    }
-    // Matrix projects that are restricted to run on a node are "unBuildable".
-    if (anItem.isBuildable() == true || anItem.toString().contains("hudson.matrix.MatrixProject")) {
-        // println anItem.metaClass.methods*.name.sort().unique();
-        return_queue["messages"].add('============ Item in Queue Needs a Slave ===================');
-
-        jobName = anItem.toString().substring(anItem.toString().lastIndexOf('[') + 1, anItem.toString().lastIndexOf(']'));
-        job = hudson.model.Hudson.instance.getItem(jobName);
-        if (job == null){
-            return_queue["messages"].add('Item on queue is from multiconfiguration or promotion job: ' + jobName);
-            parentName = jobName.toString().substring(0,jobName.toString().indexOf("/"));
-            parent_job = hudson.model.Hudson.instance.getItem(parentName);
-            // Initialize the variables:
-            lastBuildOn = "UNKNOWN";
-            parameters = "NONE";
-            labels = anItem.getAssignedLabel();
-            throttleEnabled = false;
-
-            for (child in parent_job.getAllJobs()){
-                if (child.isInQueue() == true){
-                    childName = child.toString().substring(child.toString().lastIndexOf('[') + 1, child.toString().lastIndexOf(']'));
-                    if (childName == jobName){
-                        // We need a slave for this child:
-                        return_queue["messages"].add('We need a slave for this child: ' + childName.toString());
-                        labels = child.getAssignedLabel();
-                        parameters = "NONE";
-                        if (child.isParameterized() == true){
-                            parameters = child.getParams();
-                            if (parameters == ""){
-                                parameters = "NONE";
-                            }
-                        }
-                        lastBuildOn = "UNKNOWN";
-                        if (child.getLastBuild() != null) {
-                            lastBuildOn = child.getLastBuild().getBuiltOnStr();
-                        }
-                        throttleProperty = null;
-                        try {
-                            throttleProperty = child.getProperty(hudson.plugins.throttleconcurrents.ThrottleJobProperty);
-                        } catch (groovy.lang.MissingPropertyException e) {
-                            return_queue["messages"].add('Throttle plugin not installed.');
-                        }
-                        if (throttleProperty != null){
-                            throttleEnabled = throttleProperty.getThrottleEnabled();
-                        } else {
-                            throttleEnabled = false;
-                        }
-                        break;
-                    }
-                }
-            }
-        } else {
-
-            labels = anItem.getAssignedLabel();
-            parameters = anItem.getParams();
-            if (parameters == ""){
-                parameters = "NONE";
-            }
-            lastBuildOn = "UNKNOWN";
-            if (job.getLastBuild() != null) {
-                lastBuildOn = job.getLastBuild().getBuiltOnStr();
-            }
-            throttleProperty = null;
-            try {
-                throttleProperty = job.getProperty(hudson.plugins.throttleconcurrents.ThrottleJobProperty);
-            } catch (groovy.lang.MissingPropertyException e) {
-                return_queue["messages"].add('Throttle plugin not installed.');
-            }
-            if (throttleProperty != null){
-                throttleEnabled = throttleProperty.getThrottleEnabled();
-            } else {
-                throttleEnabled = false;
-            }
-        }
-        return_queue["messages"].add(jobName + ' needs a Slave with Attributes: ' + labels);
-        return_queue["build_queue"].add(["jobName":jobName.toString(),
-                                         "labels":labels.toString(),
-                                         "lastBuiltOn": lastBuildOn.toString(),
-                                         "throttleEnabled": throttleEnabled.toString(),
-                                         "parameters":parameters.toString()])
-    }
-}
-
-// Read the slave queue:
-g_TimeOutValue = 60 * 45; // Value in seconds.
-
-g_SlaveDescriptionString = "Created by the Slave Creator Job"; // Will only delete nodes that have this text in the description.
-
-// Get the current time in milliseconds from epoch:
-timeInMillis = System.currentTimeMillis();
-return_queue["messages"].add('Current Time: ' + new Date((long) timeInMillis));
-
-for (aSlave in hudson.model.Hudson.instance.slaves) {
-    return_queue["messages"].add('==========================================================');
-    return_queue["messages"].add('Name: ' + aSlave.name);
-    return_queue["messages"].add('getLabelString: ' + aSlave.getLabelString());
-    return_queue["messages"].add('getAssignedLabels: ' + aSlave.getAssignedLabels());
-    return_queue["messages"].add('getNodeDescription: ' + aSlave.getNodeDescription());
-    return_queue["messages"].add('getNumExectutors: ' + aSlave.getNumExecutors());
-    return_queue["messages"].add('getRemoteFS: ' + aSlave.getRemoteFS());
-    return_queue["messages"].add('getMode: ' + aSlave.getMode());
-    return_queue["messages"].add('getRootPath: ' + aSlave.getRootPath());
-    return_queue["messages"].add('getDescriptor: ' + aSlave.getDescriptor());
-    return_queue["messages"].add('getComputer: ' + aSlave.getComputer());
-    return_queue["messages"].add('    computer.isAcceptingTasks: ' + aSlave.getComputer().isAcceptingTasks());
-    return_queue["messages"].add('    computer.isLaunchSupported: ' + aSlave.getComputer().isLaunchSupported());
-
-    connectTime = aSlave.getComputer().getConnectTime();
-    demandTime = aSlave.getComputer().getDemandStartMilliseconds();
-    idleTime = aSlave.getComputer().getIdleStartMilliseconds();
-    ope_idle_count = aSlave.getComputer().countIdle();
-
-    return_queue["messages"].add('    computer.getConnectTime: ' + connectTime);
-    return_queue["messages"].add('    computer.getDemandStartMilliseconds: ' + demandTime);
-    return_queue["messages"].add('    computer.getIdleStartMilliseconds: ' + idleTime);
-    return_queue["messages"].add('    computer.isOffline: ' + aSlave.getComputer().isOffline());
-    return_queue["messages"].add('    computer.countBusy: ' + aSlave.getComputer().countBusy());
-    return_queue["messages"].add('    computer.isJnlpAgent: ' + aSlave.getComputer().isJnlpAgent());
-
-    // If the *online* slave has been idle for over an hour, kill it:
-    diff = (int)((timeInMillis - idleTime) / 1000);
-    connect_time_minutes = (int)((timeInMillis - connectTime) / 1000 / 60);
-    countBusy = aSlave.getComputer().countBusy();
-    isOffLine = aSlave.getComputer().isOffline();
-
-    terminate_me = "false";
-    locCreated = aSlave.getNodeDescription().indexOf("Created by Swarm");
-    return_queue["messages"].add("Current diff in seconds: " + diff);
-    return_queue["messages"].add("Current timeout value (seconds): " + g_TimeOutValue);
-    return_queue["messages"].add("Current connect time (minutes): " + connect_time_minutes);
-    return_queue["messages"].add("IsOffLine: " + isOffLine);
-    return_queue["messages"].add("countBusy: " + countBusy);
-    return_queue["messages"].add("Does contain '" + g_SlaveDescriptionString + "' in description: " + locCreated);
-
-    ami_id = "UNKNOWN";
-    ami_id_loc = aSlave.getNodeDescription().indexOf("AmiId=");
-    if ( ami_id_loc >= 0 ) {
-      if (ami_id_loc + 6 + 12 > aSlave.getNodeDescription().length() ) {
-        return_queue["messages"].add("AmiId was found, but it is not right length.");
-      } else {
-        ami_id = aSlave.getNodeDescription().substring(ami_id_loc + 6, ami_id_loc + 6 + 12);
-      }
-    }
-
-    // Terminate check: If Idle (and it's a slave we created), mark it to die:
-    g_idle_minutes_before_billing_cycle = 60 * 5
-    if (countBusy == 0 && isOffLine == false && locCreated >= 0 && ami_id != "UNKNOWN") {
-      b_terminate_me = false;
-      // OK. This machine is idling. Let see if it's time to stop this instance:
-      if (diff > g_idle_minutes_before_billing_cycle && connect_time_minutes > 50) {
-        return_queue["messages"].add("***********************************************************************************");
-        return_queue["messages"].add("This machine has been idle for: " + diff + " and we are within billing time");
-        return_queue["messages"].add("***********************************************************************************");
-        b_terminate_me = true;
-      }
-      if (diff > g_TimeOutValue) {
-          return_queue["messages"].add("***********************************************************************************");
-          return_queue["messages"].add("This machine has been idle for: " + diff + " seconds and will be turned off.");
-          return_queue["messages"].add("Which is over the default: " + g_TimeOutValue + " seconds, and it is not doing anything right now!");
-          return_queue["messages"].add("***********************************************************************************");
-          b_terminate_me = true;
-      }
-      if (b_terminate_me == true){
-        // mark temporarily offline, because that call is instant, and it will prevent other jobs from jumping on it:
-        aSlave.getComputer().setTemporarilyOffline(true, new hudson.slaves.OfflineCause.ByCLI("groovy_script_killed_me"));
-        // "terminate" in this sense is termination of the jenkins slave, not the underlying instance.
-        // The slave manager will determine when to start/stop/terminate/create.
-        terminate_me = "true";
-      }
-    }
-    // Terminate check: If the computer is offLine and it was already set to die, mark it to die:
-    offline_cause = aSlave.getComputer().getOfflineCauseReason();
-    if( isOffLine == true && offline_cause == "groovy_script_killed_me" ) {
-        terminate_me = "true";
-    }
-    // Terminate check: If the slave is offLine, and there is nothing running on it, mark it to die:
-    if( isOffLine == true && countBusy == 0 && locCreated >= 0 &&
-        (offline_cause == "groovy_script_killed_me" || offline_cause == "groovy_script_says_old_ami")) {
-        terminate_me = "true";
-    }
-    // Terminate check: If the AMI does not match, set it offline. When the running job is done, it will be marked to die:
-    if ( isOffLine == false && valid_ami_list.size() > 0 && valid_ami_list.contains(ami_id) == false && locCreated >= 0) {
-        return_queue["messages"].add("***********************************************************************************");
-        return_queue["messages"].add("Running slave is using old ami. Mark offline. It will eventually be killed.");
-        return_queue["messages"].add("***********************************************************************************");
-        aSlave.getComputer().setTemporarilyOffline(true, new hudson.slaves.OfflineCause.ByCLI("groovy_script_says_old_ami"));
-    }
-    return_queue["slave_queue"].add(["slaveName":aSlave.name.toString(),
-                                     "labels":aSlave.getAssignedLabels().toString(),
-                                     "isOffLine": aSlave.getComputer().isOffline().toString(),
-                                     "description": aSlave.getNodeDescription().toString(),
-                                     "ami_id": ami_id,
-                                     "ope_idle_count": ope_idle_count.toString(),
-                                     "connectTime": connectTime.toString(),
-                                     "idle_seconds": diff.toString(),
-                                     "terminate_me": terminate_me])
-}
-println new JsonBuilder( return_queue ).toPrettyString();
+import groovy.json.*;
+
+// The args to the script are valid amis, and these options:
+//   --session=NAME : Name of the caller. The script remembers what it last returned to each session.
+//   --since=REV    : Only return the queue items and slaves that were added, changed or removed since revision REV
+//                    of this session. If REV is not the last revision of the session, everything is returned.
+//   --compact      : Print one minified json array per line (see printCompact below), with numbers as numbers,
+//                    and without the diagnostic messages.
+//   --verbose      : Collect the diagnostic messages, even with --compact.
+//   --pool=LABEL:MIN : Warm pool. The idle-kill rules below leave at least MIN idle slaves with LABEL alone.
+// We need a try/catch because running this in Jenkins causes an exception:
+valid_ami_list = ["UNKNOWN"];
+session = null;
+since = null;
+compact = false;
+verbose = false;
+pool_floors = [:];
+try {
+    for (arg in (java.util.ArrayList)(args)) {
+        if (arg.startsWith("--session=")) {
+            session = arg.substring("--session=".length());
+        } else if (arg.startsWith("--since=")) {
+            since = arg.substring("--since=".length());
+        } else if (arg == "--compact") {
+            compact = true;
+        } else if (arg == "--verbose") {
+            verbose = true;
+        } else if (arg.startsWith("--pool=")) {
+            pool = arg.substring("--pool=".length());
+            pool_floors[pool.substring(0, pool.lastIndexOf(":"))] = pool.substring(pool.lastIndexOf(":") + 1).toInteger();
+        } else {
+            valid_ami_list.add(arg);
+        }
+    }
+} catch (groovy.lang.MissingPropertyException e) {
+    // An ami-id that is UNKNOWN (ie the script can't figure out what the AMI ID is)
+}
+if (compact == false) {
+    verbose = true;
+}
+
+return_queue = ["build_queue": [], "slave_queue": [], "messages":[]]
+
+// Add a diagnostic message. The closure is only called (and the string only built) with --verbose:
+void message(Closure msg) {
+    if (verbose) {
+        return_queue["messages"].add(msg().toString());
+    }
+}
+
+// Numbers stay numbers with --compact. Otherwise they are strings, like they always were:
+def number(value) {
+    return compact ? value : value.toString();
+}
+
+// Read the build queue:.
+for (anItem in hudson.model.Hudson.instance.getQueue().getItems()) {
+    if (anItem.isBlocked() == true){
+        continue;
+    }
+    // Matrix projects that are restricted to run on a node are "unBuildable".
+    if (anItem.isBuildable() == true || anItem.toString().contains("hudson.matrix.MatrixProject")) {
+        // println anItem.metaClass.methods*.name.sort().unique();
+        message { '============ Item in Queue Needs a Slave ===================' };
+
+        jobName = anItem.toString().substring(anItem.toString().lastIndexOf('[') + 1, anItem.toString().lastIndexOf(']'));
+        job = hudson.model.Hudson.instance.getItem(jobName);
+        if (job == null){
+            message { 'Item on queue is from multiconfiguration or promotion job: ' + jobName };
+            parentName = jobName.toString().substring(0,jobName.toString().indexOf("/"));
+            parent_job = hudson.model.Hudson.instance.getItem(parentName);
+            // Initialize the variables:
+            lastBuildOn = "UNKNOWN";
+            parameters = "NONE";
+            labels = anItem.getAssignedLabel();
+            throttleEnabled = false;
+
+            for (child in parent_job.getAllJobs()){
+                if (child.isInQueue() == true){
+                    childName = child.toString().substring(child.toString().lastIndexOf('[') + 1, child.toString().lastIndexOf(']'));
+                    if (childName == jobName){
+                        // We need a slave for this child:
+                        message { 'We need a slave for this child: ' + childName.toString() };
+                        labels = child.getAssignedLabel();
+                        parameters = "NONE";
+                        if (child.isParameterized() == true){
+                            parameters = child.getParams();
+                            if (parameters == ""){
+                                parameters = "NONE";
+                            }
+                        }
+                        lastBuildOn = "UNKNOWN";
+                        if (child.getLastBuild() != null) {
+                            lastBuildOn = child.getLastBuild().getBuiltOnStr();
+                        }
+                        throttleProperty = null;
+                        try {
+                            throttleProperty = child.getProperty(hudson.plugins.throttleconcurrents.ThrottleJobProperty);
+                        } catch (groovy.lang.MissingPropertyException e) {
+                            message { 'Throttle plugin not installed.' };
+                        }
+                        if (throttleProperty != null){
+                            throttleEnabled = throttleProperty.getThrottleEnabled();
+                        } else {
+                            throttleEnabled = false;
+                        }
+                        break;
+                    }
+                }
+            }
+        } else {
+
+            labels = anItem.getAssignedLabel();
+            parameters = anItem.getParams();
+            if (parameters == ""){
+                parameters = "NONE";
+            }
+            lastBuildOn = "UNKNOWN";
+            if (job.getLastBuild() != null) {
+                lastBuildOn = job.getLastBuild().getBuiltOnStr();
+            }
+            throttleProperty = null;
+            try {
+                throttleProperty = job.getProperty(hudson.plugins.throttleconcurrents.ThrottleJobProperty);
+            } catch (groovy.lang.MissingPropertyException e) {
+                message { 'Throttle plugin not installed.' };
+            }
+            if (throttleProperty != null){
+                throttleEnabled = throttleProperty.getThrottleEnabled();
+            } else {
+                throttleEnabled = false;
+            }
+        }
+        message { jobName + ' needs a Slave with Attributes: ' + labels };
+        return_queue["build_queue"].add(["queueId":anItem.getId().toString(),
+                                         "jobName":jobName.toString(),
+                                         "labels":labels.toString(),
+                                         "lastBuiltOn": lastBuildOn.toString(),
+                                         "throttleEnabled": throttleEnabled.toString(),
+                                         "parameters":parameters.toString()])
+    }
+}
+
+// Read the slave queue:
+g_TimeOutValue = 60 * 45; // Value in seconds.
+
+g_SlaveDescriptionString = "Created by the Slave Creator Job"; // Will only delete nodes that have this text in the description.
+
+// Get the current time in milliseconds from epoch:
+timeInMillis = System.currentTimeMillis();
+message { 'Current Time: ' + new Date((long) timeInMillis) };
+
+// Get the ami id out of the node description of a slave (it has "AmiId=ami-xxxxxxxx" in it):
+def getAmiId(aSlave) {
+    def ami_id = "UNKNOWN";
+    def ami_id_loc = aSlave.getNodeDescription().indexOf("AmiId=");
+    if ( ami_id_loc >= 0 ) {
+      if (ami_id_loc + 6 + 12 > aSlave.getNodeDescription().length() ) {
+        message { "AmiId was found, but it is not right length." };
+      } else {
+        ami_id = aSlave.getNodeDescription().substring(ami_id_loc + 6, ami_id_loc + 6 + 12);
+      }
+    }
+    return ami_id;
+}
+
+// Warm pool: count the idle, online slaves (that we created, from a current ami) of each pool label:
+pool_idle = [:];
+for (label in pool_floors.keySet()) {
+    pool_idle[label] = 0;
+}
+if (pool_floors.size() > 0) {
+    for (aSlave in hudson.model.Hudson.instance.slaves) {
+        if (aSlave.getComputer().countBusy() == 0 && aSlave.getComputer().isOffline() == false &&
+            aSlave.getNodeDescription().indexOf("Created by Swarm") >= 0 && valid_ami_list.contains(getAmiId(aSlave))) {
+            for (label in aSlave.getLabelString().split()) {
+                if (pool_idle.containsKey(label)) {
+                    pool_idle[label] += 1;
+                }
+            }
+        }
+    }
+}
+
+for (aSlave in hudson.model.Hudson.instance.slaves) {
+    message { '==========================================================' };
+    message { 'Name: ' + aSlave.name };
+    message { 'getLabelString: ' + aSlave.getLabelString() };
+    message { 'getAssignedLabels: ' + aSlave.getAssignedLabels() };
+    message { 'getNodeDescription: ' + aSlave.getNodeDescription() };
+    message { 'getNumExectutors: ' + aSlave.getNumExecutors() };
+    message { 'getRemoteFS: ' + aSlave.getRemoteFS() };
+    message { 'getMode: ' + aSlave.getMode() };
+    message { 'getRootPath: ' + aSlave.getRootPath() };
+    message { 'getDescriptor: ' + aSlave.getDescriptor() };
+    message { 'getComputer: ' + aSlave.getComputer() };
+    message { '    computer.isAcceptingTasks: ' + aSlave.getComputer().isAcceptingTasks() };
+    message { '    computer.isLaunchSupported: ' + aSlave.getComputer().isLaunchSupported() };
+
+    connectTime = aSlave.getComputer().getConnectTime();
+    demandTime = aSlave.getComputer().getDemandStartMilliseconds();
+    idleTime = aSlave.getComputer().getIdleStartMilliseconds();
+    ope_idle_count = aSlave.getComputer().countIdle();
+
+    message { '    computer.getConnectTime: ' + connectTime };
+    message { '    computer.getDemandStartMilliseconds: ' + demandTime };
+    message { '    computer.getIdleStartMilliseconds: ' + idleTime };
+    message { '    computer.isOffline: ' + aSlave.getComputer().isOffline() };
+    message { '    computer.countBusy: ' + aSlave.getComputer().countBusy() };
+    message { '    computer.isJnlpAgent: ' + aSlave.getComputer().isJnlpAgent() };
+
+    // If the *online* slave has been idle for over an hour, kill it:
+    diff = (int)((timeInMillis - idleTime) / 1000);
+    connect_time_minutes = (int)((timeInMillis - connectTime) / 1000 / 60);
+    countBusy = aSlave.getComputer().countBusy();
+    isOffLine = aSlave.getComputer().isOffline();
+
+    terminate_me = "false";
+    locCreated = aSlave.getNodeDescription().indexOf("Created by Swarm");
+    message { "Current diff in seconds: " + diff };
+    message { "Current timeout value (seconds): " + g_TimeOutValue };
+    message { "Current connect time (minutes): " + connect_time_minutes };
+    message { "IsOffLine: " + isOffLine };
+    message { "countBusy: " + countBusy };
+    message { "Does contain '" + g_SlaveDescriptionString + "' in description: " + locCreated };
+
+    ami_id = getAmiId(aSlave);
+
+    // Terminate check: If Idle (and it's a slave we created), mark it to die:
+    g_idle_minutes_before_billing_cycle = 60 * 5
+    if (countBusy == 0 && isOffLine == false && locCreated >= 0 && ami_id != "UNKNOWN") {
+      b_terminate_me = false;
+      // OK. This machine is idling. Let see if it's time to stop this instance:
+      if (diff > g_idle_minutes_before_billing_cycle && connect_time_minutes > 50) {
+        message { "***********************************************************************************" };
+        message { "This machine has been idle for: " + diff + " and we are within billing time" };
+        message { "***********************************************************************************" };
+        b_terminate_me = true;
+      }
+      if (diff > g_TimeOutValue) {
+          message { "***********************************************************************************" };
+          message { "This machine has been idle for: " + diff + " seconds and will be turned off." };
+          message { "Which is over the default: " + g_TimeOutValue + " seconds, and it is not doing anything right now!" };
+          message { "***********************************************************************************" };
+          b_terminate_me = true;
+      }
+      // Warm pool: do not let the number of idle slaves of a pool label drop below its floor:
+      pool_labels = aSlave.getLabelString().split().findAll { pool_idle.containsKey(it) };
+      if (b_terminate_me == true && pool_labels.size() > 0 && valid_ami_list.contains(ami_id)) {
+        if (pool_labels.any { pool_idle[it] <= pool_floors[it] }) {
+          message { "Keeping this idle slave for the warm pool of: " + pool_labels };
+          b_terminate_me = false;
+        } else {
+          pool_labels.each { pool_idle[it] -= 1 };
+        }
+      }
+      if (b_terminate_me == true){
+        // mark temporarily offline, because that call is instant, and it will prevent other jobs from jumping on it:
+        aSlave.getComputer().setTemporarilyOffline(true, new hudson.slaves.OfflineCause.ByCLI("groovy_script_killed_me"));
+        // "terminate" in this sense is termination of the jenkins slave, not the underlying instance.
+        // The slave manager will determine when to start/stop/terminate/create.
+        terminate_me = "true";
+      }
+    }
+    // Terminate check: If the computer is offLine and it was already set to die, mark it to die:
+    offline_cause = aSlave.getComputer().getOfflineCauseReason();
+    if( isOffLine == true && offline_cause == "groovy_script_killed_me" ) {
+        terminate_me = "true";
+    }
+    // Terminate check: If the slave is offLine, and there is nothing running on it, mark it to die:
+    if( isOffLine == true && countBusy == 0 && locCreated >= 0 &&
+        (offline_cause == "groovy_script_killed_me" || offline_cause == "groovy_script_says_old_ami")) {
+        terminate_me = "true";
+    }
+    // Terminate check: If the AMI does not match, set it offline. When the running job is done, it will be marked to die:
+    if ( isOffLine == false && valid_ami_list.size() > 0 && valid_ami_list.contains(ami_id) == false && locCreated >= 0) {
+        message { "***********************************************************************************" };
+        message { "Running slave is using old ami. Mark offline. It will eventually be killed." };
+        message { "***********************************************************************************" };
+        aSlave.getComputer().setTemporarilyOffline(true, new hudson.slaves.OfflineCause.ByCLI("groovy_script_says_old_ami"));
+    }
+    return_queue["slave_queue"].add(["slaveName":aSlave.name.toString(),
+                                     "labels":aSlave.getAssignedLabels().toString(),
+                                     "isOffLine": aSlave.getComputer().isOffline().toString(),
+                                     "description": aSlave.getNodeDescription().toString(),
+                                     "ami_id": ami_id,
+                                     "ope_idle_count": number(ope_idle_count),
+                                     "connectTime": number(connectTime),
+                                     "idle_seconds": number(diff),
+                                     "idle_start_millis": number(idleTime),
+                                     "terminate_me": terminate_me])
+}
+
+// Hash of a record, leaving out the fields that change on every run (ie idle_seconds):
+def hashRecord(record, volatile_keys) {
+    return JsonOutput.toJson(record.findAll { k, v -> !volatile_keys.contains(k) }).hashCode();
+}
+
+// Work out what was added, changed or removed since the last revision this session got.
+// The hashes of what we returned are kept in the JVM (System properties), one snapshot per session:
+return_queue["revision"] = java.util.UUID.randomUUID().toString();
+return_queue["now_millis"] = timeInMillis;
+return_queue["full"] = true;
+if (session != null) {
+    snapshots_key = "slave_manager.get_queue_jobs.snapshots";
+    snapshots = System.getProperties().get(snapshots_key);
+    if (snapshots == null) {
+        snapshots = new java.util.concurrent.ConcurrentHashMap();
+        System.getProperties().put(snapshots_key, snapshots);
+    }
+    record_keys = ["build_queue": "queueId", "slave_queue": "slaveName"];
+    volatile_keys = ["build_queue": [], "slave_queue": ["idle_seconds"]];
+    current = ["revision": return_queue["revision"], "build_queue": [:], "slave_queue": [:]];
+    for (queue_name in record_keys.keySet()) {
+        for (record in return_queue[queue_name]) {
+            current[queue_name][record[record_keys[queue_name]]] = hashRecord(record, volatile_keys[queue_name]);
+        }
+    }
+    previous = snapshots.get(session);
+    if (since != null && previous != null && previous["revision"] == since) {
+        return_queue["full"] = false;
+        for (queue_name in record_keys.keySet()) {
+            delta = ["added": [], "changed": [], "removed": []];
+            for (record in return_queue[queue_name]) {
+                key = record[record_keys[queue_name]];
+                if (!previous[queue_name].containsKey(key)) {
+                    delta["added"].add(record);
+                } else if (previous[queue_name][key] != current[queue_name][key]) {
+                    delta["changed"].add(record);
+                }
+            }
+            for (key in previous[queue_name].keySet()) {
+                if (!current[queue_name].containsKey(key)) {
+                    delta["removed"].add(key);
+                }
+            }
+            return_queue[queue_name] = delta;
+        }
+    }
+    snapshots.put(session, current);
+}
+
+// Compact output is one json array per line, so that it can be parsed as it streams in:
+//   ["build_queue"|"slave_queue", "full"|"added"|"changed", record]
+//   ["build_queue"|"slave_queue", "removed", key]
+//   ["messages", "add", message]
+//   ["end", "end", {"revision": ..., "full": ..., "now_millis": ...}]   <- always the last line
+def printCompact(return_queue) {
+    def out = new StringBuilder();
+    for (queue_name in ["build_queue", "slave_queue"]) {
+        if (return_queue["full"]) {
+            for (record in return_queue[queue_name]) {
+                out.append(JsonOutput.toJson([queue_name, "full", record])).append("\n");
+            }
+        } else {
+            for (op in ["added", "changed", "removed"]) {
+                for (record in return_queue[queue_name][op]) {
+                    out.append(JsonOutput.toJson([queue_name, op, record])).append("\n");
+                }
+            }
+        }
+    }
+    for (msg in return_queue["messages"]) {
+        out.append(JsonOutput.toJson(["messages", "add", msg])).append("\n");
+    }
+    out.append(JsonOutput.toJson(["end", "end", ["revision": return_queue["revision"], "full": return_queue["full"],
+                                                 "now_millis": return_queue["now_millis"]]]));
+    println out.toString();
+}
+
+if (compact) {
+    printCompact(return_queue);
+} else {
+    println new JsonBuilder( return_queue ).toPrettyString();
+}
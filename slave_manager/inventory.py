@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Snapshot of all the instances in one environment.
+# It is loaded with one describe-instances per loop iteration (tick), and then kept up to date in place
+# when the slave manager starts, stops, creates or terminates an instance, so nothing needs to re-list.
+import json
+import threading
+
+
+# Helper function to return a dict of instance's keys:
+def getTags(instance):
+    tags = {}
+    if 'Tags' in instance.keys():
+        for tag in instance['Tags']:
+            tags[tag['Key']] = tag['Value']
+    return tags
+
+
+# Helper function to get the slave labels out of the slave_data tag. Returns None if there are none:
+def getSlaveLabels(instance):
+    try:
+        j = json.loads(getTags(instance).get('slave_data'))
+        return frozenset(map(str, j['slave_labels'].split(' ')))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class Inventory(object):
+    def __init__(self, target_env):
+        self.target_env = target_env
+        # The tick this snapshot was loaded in:
+        self.tick = None
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        # Key is instance id, value is the instance json (as returned by describe-instances):
+        self.instances = {}
+        # Key is the Name tag, the state or a slave label. Value is a set of instance ids:
+        self.by_name = {}
+        self.by_state = {}
+        self.by_label = {}
+        # Key is instance id, value is the frozenset of slave labels (or None):
+        self.labels = {}
+
+    # Replace the snapshot with the output of describe-instances:
+    def load(self, describe_instances_json, tick):
+        with self.lock:
+            self.clear()
+            for r in describe_instances_json['Reservations']:
+                for i in r['Instances']:
+                    self.add(i)
+            self.tick = tick
+
+    def add(self, instance):
+        with self.lock:
+            instance_id = str(instance['InstanceId'])
+            if instance_id in self.instances:
+                self.remove(instance_id)
+            self.instances[instance_id] = instance
+            self.labels[instance_id] = getSlaveLabels(instance)
+            self.by_name.setdefault(getTags(instance).get('Name'), set()).add(instance_id)
+            self.by_state.setdefault(instance['State']['Name'], set()).add(instance_id)
+            for label in self.labels[instance_id] or []:
+                self.by_label.setdefault(label, set()).add(instance_id)
+
+    def remove(self, instance_id):
+        with self.lock:
+            instance = self.instances.pop(str(instance_id), None)
+            if instance is None:
+                return
+            self.by_name.get(getTags(instance).get('Name'), set()).discard(instance_id)
+            self.by_state.get(instance['State']['Name'], set()).discard(instance_id)
+            for label in self.labels.pop(instance_id, None) or []:
+                self.by_label.get(label, set()).discard(instance_id)
+
+    # Record a state change that we caused (ie 'stopped' -> 'pending' when we start an instance):
+    def setState(self, instance_id, state):
+        with self.lock:
+            instance = self.instances.get(str(instance_id))
+            if instance is None:
+                return
+            self.by_state.get(instance['State']['Name'], set()).discard(instance['InstanceId'])
+            instance['State']['Name'] = state
+            self.by_state.setdefault(state, set()).add(instance['InstanceId'])
+
+    def get(self, instance_id):
+        return self.instances.get(str(instance_id))
+
+    def getLabels(self, instance_id):
+        return self.labels.get(str(instance_id))
+
+    # Find instances by Name tag, states and slave labels. Any argument left as None matches everything:
+    def find(self, name=None, states=None, label_set=None):
+        with self.lock:
+            ids = set(self.instances.keys())
+            if name is not None:
+                ids &= self.by_name.get(name, set())
+            if states is not None:
+                ids &= set().union(*[self.by_state.get(state, set()) for state in states])
+            for label in label_set or []:
+                ids &= self.by_label.get(label, set())
+            return [self.instances[instance_id] for instance_id in sorted(ids)]
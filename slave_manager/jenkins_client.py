@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# Long lived control channel to the Jenkins master.
+# Running 'java -jar jenkins-cli.jar -remoting' starts a new JVM and does the remoting handshake every time.
+# When a user and API token are given, the client below keeps a pooled https session to the master and
+# runs groovy through the script console (/scriptText) and builds through the REST api instead.
+# Without them, it falls back to the jenkins-cli.jar + id_rsa way of doing things.
+import os
+import sys
+import time
+import requests
+import requests.adapters
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import run, say
+from metrics import g_metrics
+from rate_limiter import g_rate_limiter
+
+# Jenkins prints this on stdout when -noCertificateCheck is used:
+g_cli_ignore_warning = 'Skipping HTTPS certificate checks altogether. Note that this is not secure at all.'
+
+
+# Quote a python string so it can be used as a groovy string literal:
+def toGroovyString(s):
+    return "'" + str(s).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+class JenkinsClient(object):
+    def __init__(self, url, user=None, api_token=None, id_rsa=None, verify_ssl=False, retry_count=3, debug=False):
+        self.url = url if url.endswith('/') else url + '/'
+        self.id_rsa = id_rsa
+        self.retry_count = retry_count
+        self.debug = debug
+        self.session = None
+        self.crumb_header = None
+        # Latency of the calls. Key is the call name, value is a dict of count/total/max/last seconds:
+        self.latency = {}
+        # Contents of the groovy files we send to the script console. Key is (path, mtime):
+        self.scripts = {}
+        if user is not None and api_token is not None:
+            self.session = requests.Session()
+            self.session.auth = (user, api_token)
+            self.session.verify = verify_ssl
+            if verify_ssl is False:
+                requests.packages.urllib3.disable_warnings()
+            # One host, so a small pool of keep-alive connections is all we need:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    # Are we talking to the master over http, or with jenkins-cli.jar:
+    def usesHttp(self):
+        return self.session is not None
+
+    # Keep track of how long each call takes. observe=False keeps it out of the metrics, when the time is already
+    # counted elsewhere (ie as a 'java -jar' command):
+    def recordLatency(self, name, seconds, observe=True):
+        stats = self.latency.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        stats['last'] = seconds
+        if observe is True:
+            g_metrics.observe('slave_manager_jenkins_call_seconds', seconds, call=name)
+        say('Jenkins call {} took {:.3f}s (avg: {:.3f}s, max: {:.3f}s)'.format(name, seconds,
+                                                                              stats['total'] / stats['count'],
+                                                                              stats['max']), do_print=self.debug)
+
+    # Flatten the latency stats so they can be written with writeStats:
+    def getLatencyStats(self):
+        stats = {}
+        for name, s in self.latency.items():
+            stats[name + '_count'] = s['count']
+            stats[name + '_avg_secs'] = round(s['total'] / s['count'], 3)
+            stats[name + '_max_secs'] = round(s['max'], 3)
+        return stats
+
+    # Get a CSRF crumb, if the master wants one:
+    def getCrumbHeader(self):
+        if self.crumb_header is None:
+            r = self.session.get(self.url + 'crumbIssuer/api/json', timeout=30)
+            if r.status_code == 200:
+                j = r.json()
+                self.crumb_header = {j['crumbRequestField']: j['crumb']}
+            else:
+                self.crumb_header = {}
+        return self.crumb_header
+
+    # POST to the master, re-using the pooled session. With stream=True, the body is read by the caller.
+    # Goes through the rate limiter, like the AWS calls. A 429 is a throttle. 5xx and connection errors are retried,
+    # unless name is in rate_limiter.g_not_idempotent (ie 'build': the master may have queued it already).
+    # An expired crumb (403) is retried once with a new one. Other 4xx are not retried:
+    def post(self, path, name, data=None, params=None, stream=False):
+        response = None
+        key = (None, self.url, 'jenkins', name)
+        budget = g_rate_limiter.getBudget(self.retry_count)
+        crumb_retried = False
+        while True:
+            g_rate_limiter.acquire(key)
+            start = time.time()
+            try:
+                response = self.session.post(self.url + path, data=data, params=params,
+                                             headers=self.getCrumbHeader(), timeout=120, stream=stream)
+                if response.status_code < 400:
+                    g_rate_limiter.succeeded(key)
+                    break
+                say('***Error: Jenkins returned {} for {}'.format(response.status_code, path))
+                if response.status_code == 403 and self.crumb_header and crumb_retried is False:
+                    # The crumb expired (ie the master restarted). The request was turned down, so try once more
+                    # with a new one:
+                    self.crumb_header = None
+                    crumb_retried = True
+                    continue
+                code = None
+                if response.status_code == 429:
+                    code = 'TooManyRequests'
+                elif response.status_code >= 500:
+                    code = 'ServiceUnavailable'
+            except requests.exceptions.RequestException as err:
+                say('***Error talking to Jenkins: {}'.format(err))
+                code = 'ConnectionError'
+            finally:
+                # A streamed response is counted once its body is read:
+                self.recordLatency(name, time.time() - start, observe=stream is False)
+            if not g_rate_limiter.retry(key, code, budget):
+                break
+        if response is None or response.status_code >= 400:
+            raise Exception('Jenkins_Error')
+        return response
+
+    # Run jenkins-cli.jar. The old (slow) way:
+    def runCli(self, name, cli_args, hide_command=True, separate_std_out_err=False):
+        if self.id_rsa is None:
+            raise Exception('No id_rsa file to run jenkins-cli.jar with. Cannot run: {}'.format(cli_args))
+        cmd = 'java -jar jenkins-cli.jar -remoting -noCertificateCheck -i {} -s {} {}'.format(self.id_rsa, self.url, cli_args)
+        start = time.time()
+        try:
+            return run(cmd=cmd, hide_command=hide_command, separate_std_out_err=separate_std_out_err, retry_count=self.retry_count)
+        finally:
+            self.recordLatency(name, time.time() - start, observe=False)
+
+    # Read a groovy file (only once, unless it changes on disk):
+    def readScript(self, script_file):
+        key = (script_file, os.path.getmtime(script_file))
+        if key not in self.scripts:
+            with open(script_file, 'r') as fd:
+                self.scripts[key] = fd.read()
+        return self.scripts[key]
+
+    # The script console does not take args, so pass them in the same way jenkins-cli.jar does.
+    # Imports have to stay at the top of the script:
+    def getScriptWithArgs(self, script_file, script_args):
+        lines = self.readScript(script_file).split('\n')
+        after_imports = max([i + 1 for i, l in enumerate(lines) if l.startswith('import ')] + [0])
+        lines.insert(after_imports, 'args = [{}] as String[];'.format(', '.join(map(toGroovyString, script_args))))
+        return '\n'.join(lines)
+
+    # Run a groovy script on the master with jenkins-cli.jar:
+    def runGroovyCli(self, script_file, script_args, name, hide_command):
+        stdout, stderr, returncode = self.runCli(name, 'groovy {} {}'.format(script_file, ' '.join(script_args)),
+                                                 hide_command=hide_command, separate_std_out_err=True)
+        return stdout.replace(g_cli_ignore_warning, ''), stderr, returncode
+
+    # Run a groovy script on the master. Returns (stdout, stderr, returncode) just like run():
+    def runGroovy(self, script_file, script_args=[], name='groovy', hide_command=True):
+        if self.usesHttp() is False:
+            return self.runGroovyCli(script_file, script_args, name, hide_command)
+        if hide_command is False:
+            say('Running {} through {}scriptText'.format(script_file, self.url))
+        response = self.post('scriptText', name, data={'script': self.getScriptWithArgs(script_file, script_args)})
+        return response.text, '', 0
+
+    # Run a groovy script on the master, and yield the lines it prints as they arrive (rather than once it is all read):
+    def runGroovyLines(self, script_file, script_args=[], name='groovy', hide_command=True):
+        if self.usesHttp() is False:
+            stdout, stderr, returncode = self.runGroovyCli(script_file, script_args, name, hide_command)
+            for line in stdout.splitlines():
+                yield line
+            return
+        if hide_command is False:
+            say('Running {} through {}scriptText'.format(script_file, self.url))
+        start = time.time()
+        response = self.post('scriptText', name + '_headers',
+                             data={'script': self.getScriptWithArgs(script_file, script_args)}, stream=True)
+        try:
+            for line in response.iter_lines():
+                yield line.decode('utf-8')
+        finally:
+            response.close()
+            self.recordLatency(name, time.time() - start)
+
+    # Build a job. job_parameters is a dict:
+    def build(self, job_name, job_parameters={}):
+        if self.usesHttp() is False:
+            params = ' '.join(['-p {}={}'.format(k, v) for k, v in job_parameters.items()])
+            output, returncode = self.runCli('build', 'build {} {}'.format(job_name, params), hide_command=False)
+            return output
+        # Jobs in folders live under job/FOLDER/job/NAME:
+        path = ''.join(['job/{}/'.format(quote(part)) for part in job_name.strip('/').split('/')])
+        if len(job_parameters) == 0:
+            response = self.post(path + 'build', 'build')
+        else:
+            response = self.post(path + 'buildWithParameters', 'build', params=job_parameters)
+        return 'Queued build of {}: {}'.format(job_name, response.headers.get('Location', response.status_code))
+
+    # Run any other cli command (ie 'enable-job'). There is no REST equivalent for these, so use the jar:
+    def runCommand(self, action, job_name, job_parameters={}):
+        if action == 'build':
+            return self.build(job_name, job_parameters)
+        params = ' '.join(['-p {}={}'.format(k, v) for k, v in job_parameters.items()])
+        output, returncode = self.runCli(action, '{} {} {}'.format(action, job_name, params), hide_command=False)
+        return output
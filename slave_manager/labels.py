@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Parser for the node labels that the slave manager knows how to launch.
+# Grammar (ENV is a key of environments in environment.json):
+#   label  := ENV [ '_' KIND ] [ '_' INSTANCE_TYPE ]
+#   KIND   := a key of the label map (ie 'shared', 'spot')
+# A label is parsed once into an immutable LabelProfile, and the profile is cached, so looking up the same
+# label again (every queue item, every tick) is a single dict lookup.
+import collections
+import threading
+
+# What a label asks for:
+LabelProfile = collections.namedtuple('LabelProfile', ['label', 'env', 'kind', 'is_spot', 'is_shared',
+                                                       'instance_type', 'num_of_executors'])
+
+
+class LabelParser(object):
+    def __init__(self, env_names, instance_types, label_map, default_instance_type='t2.small',
+                 default_num_of_executors=1, max_cache_size=10000):
+        # Longest first, so that an env that is a prefix of another env does not match first:
+        self.env_names = sorted(set(map(str, env_names)), key=len, reverse=True)
+        self.instance_types = frozenset(map(str, instance_types))
+        self.label_map = label_map
+        self.default_instance_type = default_instance_type
+        self.default_num_of_executors = default_num_of_executors
+        self.max_cache_size = max_cache_size
+        self.lock = threading.Lock()
+        # Key is the label string. Value is its LabelProfile, or None if it is not a label we can launch:
+        self.cache = {}
+
+    # Get the profile of a label. Returns None if the label does not follow the grammar:
+    def parse(self, label):
+        try:
+            return self.cache[label]
+        except KeyError:
+            pass
+        profile = self.compile(str(label).strip())
+        with self.lock:
+            if len(self.cache) >= self.max_cache_size:
+                # Labels come from the jenkins queue, so do not let junk grow the cache forever:
+                self.cache.clear()
+            self.cache[label] = profile
+        return profile
+
+    # Parse a label without the cache:
+    def compile(self, label):
+        for env in self.env_names:
+            if label == env or label.startswith(env + '_'):
+                break
+        else:
+            return None
+        parts = label[len(env) + 1:].split('_') if label != env else []
+        kind = None
+        if len(parts) != 0 and parts[0] in self.label_map:
+            kind = parts.pop(0)
+        instance_type = self.default_instance_type
+        if len(parts) != 0 and parts[0] in self.instance_types:
+            instance_type = parts.pop(0)
+        if len(parts) != 0:
+            return None
+        num_of_executors = self.label_map.get(kind, {}).get('num_of_executors', self.default_num_of_executors)
+        return LabelProfile(label=label, env=env, kind=kind, is_spot=(kind == 'spot'), is_shared=(kind == 'shared'),
+                            instance_type=instance_type, num_of_executors=num_of_executors)
+
+    # Get the profiles of all the valid labels in a list/set of labels:
+    def parseAll(self, labels):
+        return [profile for profile in map(self.parse, labels) if profile is not None]
+
+    # Get the env of a set of labels. Returns None if there is no valid label, or they are for more than one env:
+    def getEnv(self, labels):
+        envs = set([profile.env for profile in self.parseAll(labels)])
+        if len(envs) == 1:
+            return envs.pop()
+        return None
+
+    # Human readable summary of what labels are valid:
+    def describe(self):
+        kinds = sorted(self.label_map.keys())
+        return '\n'.join(['Labels: ENV[_{}][_INSTANCE_TYPE] (default instance type: {})'.format('|'.join(kinds),
+                                                                                          self.default_instance_type),
+                          'ENV          : {}'.format(', '.join(sorted(self.env_names))),
+                          'INSTANCE_TYPE: {}'.format(', '.join(sorted(self.instance_types)))])
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of a label lookup, against splitting the label by hand like we used to:
+    import timeit
+    env_names = ['{}-{}'.format(env, region) for env in ['dev', 'qa', 'stage', 'prod', 'eod', 'perf']
+                 for region in ['us-east-1', 'us-west-2', 'eu-west-1']]
+    instance_types = ['t2.small', 't2.medium', 't2.large', 'm3.medium', 'm3.large', 'm3.xlarge',
+                      'm4.large', 'c3.large', 'c4.large', 'c4.xlarge', 'c4.2xlarge', 'c3.2xlarge',
+                      'm4.2xlarge', 'm3.2xlarge']
+    label_map = {'shared': {'num_of_executors': 5}, 'spot': {'num_of_executors': 1}}
+    parser = LabelParser(env_names, instance_types, label_map)
+    labels = ['eod-us-west-2', 'prod-eu-west-1_shared', 'qa-us-east-1_spot_c4.xlarge', 'dev-us-west-2_m3.2xlarge']
+
+    def splitByHand(label):
+        instance_type = 't2.small'
+        num_of_executors = 1
+        env = None
+        for sub_label in label.split('_'):
+            if sub_label in instance_types:
+                instance_type = sub_label
+            if sub_label in label_map:
+                num_of_executors = label_map[sub_label]['num_of_executors']
+            if sub_label in env_names:
+                env = sub_label
+        return env, instance_type, num_of_executors
+
+    number = 100000
+    for name, func in [('split by hand', splitByHand), ('parse, no cache', parser.compile), ('parse, cached', parser.parse)]:
+        secs = min(timeit.repeat(lambda: [func(label) for label in labels], number=number, repeat=3))
+        print('{:<16}: {:.3f} us/label'.format(name, secs / (number * len(labels)) * 1e6))
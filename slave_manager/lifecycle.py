@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Batches instance start/stop/terminate requests.
+# EC2 takes many instance ids in one start-instances, stop-instances or terminate-instances call.  Rather than
+# one call per instance, the slave manager adds its requests here during a tick, and flush() sends one call per
+# env and action.  The outcome of each instance is handed back to whoever asked for it through a callback.
+import os
+import sys
+import threading
+import traceback
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import say
+import aws_client
+
+# The ec2 operation, and the key of the list of instances in its response, for each action:
+g_actions = {'start': ('start_instances', 'StartingInstances'),
+             'stop': ('stop_instances', 'StoppingInstances'),
+             'terminate': ('terminate_instances', 'TerminatingInstances')}
+
+# Max number of instance ids in one call:
+g_max_batch_size = 500
+
+
+class LifecycleBatch(object):
+    # ec2_call is called like ec2_call(target_env, operation, **kwargs) and returns the response json:
+    def __init__(self, ec2_call):
+        self.ec2_call = ec2_call
+        self.lock = threading.Lock()
+        # Key is (env, action). Value is a dict of instance id -> list of callbacks:
+        self.pending = {}
+        # Number of ec2 calls and instances sent, so we can see how well we batch:
+        self.stats = {'calls': 0, 'instances': 0, 'errors': 0}
+
+    # Ask for an action on an instance. on_done(instance_id, error) is called by flush(). error is None on success:
+    def add(self, target_env, action, instance_id, on_done=None):
+        if action not in g_actions:
+            raise ValueError('Unknown action: {}'.format(action))
+        with self.lock:
+            callbacks = self.pending.setdefault((str(target_env), action), {}).setdefault(str(instance_id), [])
+            if on_done is not None:
+                callbacks.append(on_done)
+
+    def hasPending(self):
+        with self.lock:
+            return len(self.pending) != 0
+
+    # Send one call for a list of ids. Returns a dict of instance_id -> error (None on success):
+    def send(self, target_env, action, instance_ids):
+        operation, response_key = g_actions[action]
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['instances'] += len(instance_ids)
+        try:
+            output = self.ec2_call(target_env, operation, InstanceIds=instance_ids)
+        except aws_client.ClientError as err:
+            if len(instance_ids) == 1:
+                return {instance_ids[0]: err}
+            # One bad instance (ie IncorrectInstanceState) fails the whole call. Find out which one:
+            say('Batched {} of {} instances in {} failed ({}). Retrying them one at a time.'.format(action, len(instance_ids),
+                                                                                                 target_env, err))
+            results = {}
+            for instance_id in instance_ids:
+                results.update(self.send(target_env, action, [instance_id]))
+            return results
+        say('{} {} instance(s) in {}: {}'.format(action, len(instance_ids), target_env,
+                                                 ', '.join(['{} ({} -> {})'.format(i['InstanceId'],
+                                                                                   i['PreviousState']['Name'],
+                                                                                   i['CurrentState']['Name'])
+                                                            for i in output.get(response_key, [])])))
+        done = set([str(i['InstanceId']) for i in output.get(response_key, [])])
+        return dict([(instance_id, None if instance_id in done else Exception('Instance not in response'))
+                     for instance_id in instance_ids])
+
+    # Send everything that was added, one call per env and action. Returns the number of failed instances:
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        num_errors = 0
+        for (target_env, action), instances in sorted(pending.items()):
+            instance_ids = sorted(instances.keys())
+            results = {}
+            for i in range(0, len(instance_ids), g_max_batch_size):
+                results.update(self.send(target_env, action, instance_ids[i:i + g_max_batch_size]))
+            for instance_id, error in results.items():
+                if error is not None:
+                    num_errors += 1
+                    say('***Error: Could not {} instance {} in {}: {}'.format(action, instance_id, target_env, error))
+                for on_done in instances[instance_id]:
+                    try:
+                        on_done(instance_id, error)
+                    except Exception:
+                        say(traceback.format_exc())
+        with self.lock:
+            self.stats['errors'] += num_errors
+        return num_errors
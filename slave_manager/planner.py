@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Placement of queue items onto executors we already have, or will have soon, before launching anything new.
+# A shared slave has 5 executors, so one instance that is still booting can take 5 queue items. The planner
+# keeps the free executors of each label: the idle executors of online slaves, plus all the executors of the
+# instances that are still booting, less the queue items that already wait for them. Queue items are packed
+# onto those first. Only the items that do not fit need an instance started or created, and what is left over
+# on that new instance goes back into the plan for the next items.
+
+
+class PlacementPlanner(object):
+    def __init__(self):
+        # Key is label. Value is a dict of instance id -> free executors:
+        self.free = {}
+        self.stats = {'items': 0, 'placed': 0, 'launches': 0}
+
+    # Add the free executors of an instance (booting, or an online slave) that has this label:
+    def addInstance(self, label, instance_id, free_executors):
+        if free_executors > 0:
+            slots = self.free.setdefault(label, {})
+            slots[str(instance_id)] = slots.get(str(instance_id), 0) + free_executors
+
+    # Take 'count' executors of a label for the queue items that already wait for them (ie we already
+    # started an instance for them on a previous pass). The instances with the fewest free executors go first:
+    def reserve(self, label, count):
+        for i in range(count):
+            if self.place(label, count_stats=False) is None:
+                return
+
+    # Place one queue item. Returns the id of the instance it will run on, or None if it needs a new one.
+    # Best fit: the instance with the fewest free executors left, so the others stay free for bigger bursts:
+    def place(self, label, count_stats=True):
+        if count_stats is True:
+            self.stats['items'] += 1
+        slots = self.free.get(label, {})
+        if len(slots) == 0:
+            return None
+        instance_id = min(slots.keys(), key=lambda k: (slots[k], k))
+        slots[instance_id] -= 1
+        if slots[instance_id] == 0:
+            del slots[instance_id]
+        if count_stats is True:
+            self.stats['placed'] += 1
+        return instance_id
+
+    # We started or created an instance for a queue item. The rest of its executors are up for grabs:
+    def addLaunch(self, label, instance_id, num_of_executors):
+        self.stats['launches'] += 1
+        self.addInstance(label, instance_id, num_of_executors - 1)
+
+    def freeExecutors(self, label):
+        return sum(self.free.get(label, {}).values())
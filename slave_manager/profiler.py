@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Profiling of the queue passes (--profile). For every --profile_every-th pass, one text file in --profile_dir with:
+# - the wall time of the pass, and the cpu time of the process,
+# - the time spent in commands run by common.run() (by family: 'aws ec2', 'java -jar', 'dig'...), AWS api calls
+#   and jenkins calls. These come from the metrics histograms, so they are summed over all the threads (the pass, its
+#   pool workers and the background tasks), and can add up to more than the wall time,
+# - the elapsed and cpu time of the pool workers, summed over their threads,
+# - the top functions by cumulative time: cProfile of the thread that runs the pass, merged with the profiles of
+#   the work it hands to the env thread pool (see wrap()).
+# The raw profile is saved next to it (.prof, for pstats/snakeviz). Only the last --profile_keep passes are kept.
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import say
+from metrics import g_metrics
+
+# The histograms of the time spent in calls. Value is the label that names the kind of call:
+g_breakdown = [('subprocess', 'slave_manager_subprocess_seconds', 'family'),
+               ('aws', 'slave_manager_aws_call_seconds', 'operation'),
+               ('jenkins', 'slave_manager_jenkins_call_seconds', 'call')]
+
+
+# Cpu seconds of the calling thread, or None if this python cannot tell (it is 3.7+ only):
+def getThreadCpuSecs():
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    return None
+
+
+class TickProfiler(object):
+    def __init__(self, directory, keep=100, top=30, every=20):
+        self.directory = directory
+        self.keep = keep
+        self.top = top
+        self.every = max(1, every)
+        self.runs = 0
+        self.lock = threading.Lock()
+        # The thread of the pass being profiled (None when no pass is), and the profiles of its pool workers:
+        self.thread = None
+        self.worker_profiles = []
+        self.worker_stats = self.newWorkerStats()
+        # We only say once that worker profiles are lost (see wrap()):
+        self.warned = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def newWorkerStats(self):
+        return {'calls': 0, 'secs': 0.0, 'cpu_secs': 0.0, 'not_profiled': 0}
+
+    def getTotals(self):
+        return dict([(kind, g_metrics.getTotals(name)) for kind, name, _ in g_breakdown])
+
+    # cProfile only sees the thread it was enabled in. Wrap the functions that are run on a thread pool with this, so
+    # that while a pass is profiled, each call gets its own profile, merged into the pass's when it is written:
+    def wrap(self, func):
+        def profiled(*args, **kwargs):
+            # The profiled thread itself is covered already (and can only have one profiler):
+            if self.thread is None or threading.current_thread() is self.thread:
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler at a time, in the whole process. This call is only timed:
+                profile = None
+                with self.lock:
+                    warn, self.warned = self.warned is False, True
+                if warn is True:
+                    say('***Warning: This python can not profile the pool workers of a pass. Only their time is reported.')
+            start = time.time()
+            cpu_start = getThreadCpuSecs()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                cpu_end = getThreadCpuSecs()
+                with self.lock:
+                    self.worker_stats['calls'] += 1
+                    self.worker_stats['secs'] += time.time() - start
+                    if cpu_start is not None and cpu_end is not None:
+                        self.worker_stats['cpu_secs'] += cpu_end - cpu_start
+                    if profile is None:
+                        self.worker_stats['not_profiled'] += 1
+                    else:
+                        self.worker_profiles.append(profile)
+        return profiled
+
+    # Run func (one pass). get_name() is called after it, ie to name the file after the tick it ran:
+    def run(self, func, get_name):
+        self.runs += 1
+        if (self.runs - 1) % self.every != 0:
+            return func()
+        totals_before = self.getTotals()
+        cpu_before = sum(os.times()[:2])
+        start = time.time()
+        with self.lock:
+            self.worker_profiles = []
+            self.worker_stats = self.newWorkerStats()
+        self.thread = threading.current_thread()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            self.thread = None
+            wall_secs = time.time() - start
+            cpu_secs = sum(os.times()[:2]) - cpu_before
+            with self.lock:
+                worker_profiles, self.worker_profiles = self.worker_profiles, []
+                worker_stats, self.worker_stats = self.worker_stats, self.newWorkerStats()
+            try:
+                stats = pstats.Stats(profile)
+                for worker_profile in worker_profiles:
+                    stats.add(worker_profile)
+                self.write(get_name(), stats, wall_secs, cpu_secs, totals_before, self.getTotals(), worker_stats)
+            except Exception as err:
+                say('***Error: Could not write the profile of this pass: {}'.format(err))
+
+    # stats is the pstats.Stats of the pass (all threads). worker_stats is what its pool workers did (see wrap()):
+    def write(self, name, stats, wall_secs, cpu_secs, totals_before, totals_after, worker_stats):
+        lines = ['{}: {:.3f}s wall, {:.3f}s cpu (process).'.format(name, wall_secs, cpu_secs), '',
+                 'Time in calls, summed over all the threads (the pass, its pool workers and the background tasks).',
+                 'Calls run at the same time all count, so this can add up to more than the wall time:']
+        for kind, _, label in g_breakdown:
+            for key, (count, secs) in sorted(totals_after[kind].items()):
+                before_count, before_secs = totals_before[kind].get(key, (0, 0.0))
+                if count == before_count:
+                    continue
+                lines.append('  {:<10} {:<40} {:>5} call(s) {:>9.3f}s'.format(kind, dict(key).get(label, ''),
+                                                                            count - before_count, secs - before_secs))
+        lines += ['', 'Pool workers, summed over their threads (not a part of the wall time):',
+                  '  {} call(s), {:.3f}s elapsed, {:.3f}s cpu.'.format(worker_stats['calls'], worker_stats['secs'],
+                                                                       worker_stats['cpu_secs'])]
+        if worker_stats['not_profiled'] != 0:
+            lines.append('  {} of them could not be profiled, and are not in the functions below.'.format(
+                worker_stats['not_profiled']))
+        lines += ['', 'Top {} functions by cumulative time (the pass, and its pool workers):'.format(self.top)]
+        stream = StringIO()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(self.top)
+        lines.append(stream.getvalue())
+        path = os.path.join(self.directory, name)
+        stats.dump_stats(path + '.prof')
+        with open(path + '.txt', 'wt') as fd:
+            fd.write('\n'.join(lines))
+        say('Profile of {} ({:.3f}s wall, {:.3f}s cpu) written to {}.txt'.format(name, wall_secs, cpu_secs, path))
+        self.rotate()
+
+    # Only keep the last 'keep' profiles:
+    def rotate(self):
+        for ext in ['.txt', '.prof']:
+            paths = sorted(glob.glob(os.path.join(self.directory, '*' + ext)), key=os.path.getmtime)
+            for path in paths[:max(0, len(paths) - self.keep)]:
+                os.remove(path)
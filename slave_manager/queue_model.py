@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# In-memory copy of the build queue and the slaves of the Jenkins master.
+# get_queue_jobs.groovy can return either everything ("full": true), or only the queue items and slaves that were
+# added, changed or removed since the revision we last got. Either way, apply() brings this model up to date,
+# and tells the caller what changed, so it only has to look at that.
+import collections
+import hashlib
+import json
+import time
+
+
+# Get the key of a queue item (job name + hash of its parameters), so that we know if we are already working on it:
+def getJobKey(item):
+    p = item['parameters'].encode('ascii', 'replace').strip().replace(b' ', b'_')
+    return str(item['jobName']).replace('/', '_CHILD_') + '___' + hashlib.md5(p).hexdigest()
+
+
+# Read the --compact output of get_queue_jobs.groovy (one json array per line), as it streams in.
+# Returns (jenkins_json, stats), where jenkins_json is in the same format as the non compact output,
+# and stats has the payload size and the time spent parsing:
+def parseCompactLines(lines):
+    full = {'build_queue': [], 'slave_queue': []}
+    delta = {'build_queue': {'added': [], 'changed': [], 'removed': []},
+             'slave_queue': {'added': [], 'changed': [], 'removed': []}}
+    messages = []
+    end = None
+    stats = {'bytes': 0, 'lines': 0, 'parse_secs': 0.0}
+    for line in lines:
+        if not line:
+            continue
+        stats['bytes'] += len(line) + 1
+        stats['lines'] += 1
+        start = time.time()
+        section, op, value = json.loads(line)
+        stats['parse_secs'] += time.time() - start
+        if section == 'end':
+            end = value
+        elif section == 'messages':
+            messages.append(value)
+        elif op == 'full':
+            full[section].append(value)
+        else:
+            delta[section][op].append(value)
+    if end is None:
+        # The script died half way (or the connection did):
+        raise ValueError('get_queue_jobs.groovy output has no end line ({} lines read)'.format(stats['lines']))
+    jenkins_json = dict(full if end['full'] is True else delta)
+    jenkins_json.update(end)
+    jenkins_json['messages'] = messages
+    return jenkins_json, stats
+
+
+class JenkinsQueueModel(object):
+    def __init__(self):
+        # The revision of the last output we applied. Sent back to the groovy script as --since:
+        self.revision = None
+        # Key is the queue item id, value is the item (plus its 'job_key'):
+        self.build_queue = collections.OrderedDict()
+        # Key is the slave name, value is the slave:
+        self.slave_queue = collections.OrderedDict()
+        self.messages = []
+        # The keys of the items that were not on the queue before the last update (nothing is new on the first one):
+        self.added_items = set()
+        # Slaves to look at again on the next update, even if they did not change (ie stopping them failed):
+        self.retry_slaves = set()
+        self.stats = {'full_updates': 0, 'delta_updates': 0, 'items_changed': 0, 'items_removed': 0,
+                      'slaves_changed': 0, 'slaves_removed': 0}
+
+    def getItemKey(self, item):
+        # Output of an older get_queue_jobs.groovy does not have queue ids:
+        return str(item.get('queueId') or getJobKey(item))
+
+    def setItem(self, item):
+        try:
+            item['job_key'] = getJobKey(item)
+        except UnicodeEncodeError:
+            item['job_key'] = None
+        self.build_queue[self.getItemKey(item)] = item
+
+    # Apply the output of get_queue_jobs.groovy. Returns the keys of the items, and the names of the slaves,
+    # that were added or changed (plus the slaves marked for a retry):
+    def apply(self, jenkins_json):
+        changed_items = set()
+        changed_slaves = set(self.retry_slaves)
+        is_first_update = self.revision is None and len(self.build_queue) == 0
+        previous_items = set(self.build_queue.keys())
+        self.retry_slaves = set()
+        if jenkins_json.get('full', True) is True:
+            self.stats['full_updates'] += 1
+            self.build_queue = collections.OrderedDict()
+            for item in jenkins_json['build_queue']:
+                self.setItem(item)
+            changed_items.update(self.build_queue.keys())
+            self.slave_queue = collections.OrderedDict([(str(slave['slaveName']), slave)
+                                                        for slave in jenkins_json['slave_queue']])
+            changed_slaves.update(self.slave_queue.keys())
+        else:
+            self.stats['delta_updates'] += 1
+            delta = jenkins_json['build_queue']
+            for key in delta['removed']:
+                self.build_queue.pop(str(key), None)
+            for item in delta['added'] + delta['changed']:
+                self.setItem(item)
+                changed_items.add(self.getItemKey(item))
+            self.stats['items_removed'] += len(delta['removed'])
+            delta = jenkins_json['slave_queue']
+            for name in delta['removed']:
+                self.slave_queue.pop(str(name), None)
+                changed_slaves.discard(str(name))
+            for slave in delta['added'] + delta['changed']:
+                self.slave_queue[str(slave['slaveName'])] = slave
+                changed_slaves.add(str(slave['slaveName']))
+            self.stats['slaves_removed'] += len(delta['removed'])
+        self.added_items = set() if is_first_update else changed_items - previous_items
+        self.stats['items_changed'] += len(changed_items)
+        self.stats['slaves_changed'] += len(changed_slaves)
+        # The idle time of a slave is left out of the deltas. Work it out from the time on the master:
+        if 'now_millis' in jenkins_json:
+            for slave in self.slave_queue.values():
+                if 'idle_start_millis' in slave:
+                    slave['idle_seconds'] = (int(jenkins_json['now_millis']) - int(slave['idle_start_millis'])) // 1000
+        self.messages = jenkins_json.get('messages', [])
+        self.revision = jenkins_json.get('revision')
+        return changed_items, changed_slaves
+
+    # Look at this slave again on the next update:
+    def retrySlave(self, slave_name):
+        self.retry_slaves.add(str(slave_name))
+
+    # The whole queue, in the same format as the full output of get_queue_jobs.groovy:
+    def toJson(self):
+        return {'build_queue': list(self.build_queue.values()),
+                'slave_queue': list(self.slave_queue.values()),
+                'messages': self.messages}
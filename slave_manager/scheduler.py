@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Deadline based scheduler for the periodic tasks of the slave manager.
+# Each task has its own interval. The next deadline is computed from the previous deadline (not from when the
+# task finished), so intervals do not drift with how long a tick took.  Background tasks run on their own thread,
+# so a slow task (ie updating security groups) does not hold up the queue handling. If a background task is
+# still running when it is due again, that run is skipped.
+import os
+import sys
+import random
+import threading
+import time
+import traceback
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import say
+
+
+class Task(object):
+    def __init__(self, name, func, interval, jitter=0.0, background=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.background = background
+        self.next_deadline = None
+        self.running = False
+        self.thread = None
+        self.stats = {'runs': 0, 'skipped': 0, 'errors': 0,
+                      'runtime_total': 0.0, 'runtime_max': 0.0, 'runtime_last': 0.0,
+                      'lateness_total': 0.0, 'lateness_max': 0.0, 'lateness_last': 0.0}
+
+    # Work out the next deadline from the one we just ran for:
+    def reschedule(self, now):
+        self.next_deadline += self.interval + random.uniform(0, self.jitter)
+        if self.next_deadline < now:
+            # We fell more than one interval behind. Do not try to catch up with a burst of runs:
+            self.next_deadline = now
+
+
+class Scheduler(object):
+    # metrics (optional) is a metrics.Metrics, that gets the runtime and lateness of every run:
+    def __init__(self, debug=False, metrics=None):
+        self.tasks = []
+        self.debug = debug
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    # Add a task. It first runs after 'delay' seconds:
+    def addTask(self, name, func, interval, jitter=0.0, background=False, delay=0.0):
+        task = Task(name, func, interval, jitter=jitter, background=background)
+        task.next_deadline = time.time() + delay
+        self.tasks.append(task)
+        return task
+
+    # Run a task and record its lateness and runtime:
+    def runTask(self, task, deadline):
+        start = time.time()
+        lateness = max(0.0, start - deadline)
+        try:
+            task.func()
+        except Exception:
+            say('***Error in scheduled task {}:\n{}'.format(task.name, traceback.format_exc()))
+            with self.lock:
+                task.stats['errors'] += 1
+            if self.metrics is not None:
+                self.metrics.inc('slave_manager_task_errors_total', task=task.name)
+        finally:
+            runtime = time.time() - start
+            with self.lock:
+                task.running = False
+                task.stats['runs'] += 1
+                task.stats['runtime_total'] += runtime
+                task.stats['runtime_max'] = max(task.stats['runtime_max'], runtime)
+                task.stats['runtime_last'] = runtime
+                task.stats['lateness_total'] += lateness
+                task.stats['lateness_max'] = max(task.stats['lateness_max'], lateness)
+                task.stats['lateness_last'] = lateness
+            if self.metrics is not None:
+                self.metrics.observe('slave_manager_task_seconds', runtime, task=task.name)
+                self.metrics.observe('slave_manager_task_lateness_seconds', lateness, task=task.name)
+            say('Task {} ran for {:.2f}s, {:.2f}s late.'.format(task.name, runtime, lateness), do_print=self.debug)
+
+    # Run (or start) every task whose deadline has passed:
+    def runPending(self):
+        for task in sorted(self.tasks, key=lambda t: t.next_deadline):
+            now = time.time()
+            if task.next_deadline > now:
+                continue
+            deadline = task.next_deadline
+            task.reschedule(now)
+            with self.lock:
+                if task.running is True:
+                    say('Task {} is still running. Skipping this run.'.format(task.name), do_print=self.debug)
+                    task.stats['skipped'] += 1
+                    continue
+                task.running = True
+            if task.background is True:
+                task.thread = threading.Thread(target=self.runTask, args=(task, deadline), name=task.name)
+                task.thread.daemon = True
+                task.thread.start()
+            else:
+                self.runTask(task, deadline)
+
+    # Run the tasks until should_stop() returns True:
+    def run(self, should_stop):
+        while should_stop() is False:
+            self.runPending()
+            next_deadline = min([task.next_deadline for task in self.tasks])
+            time.sleep(max(0.0, min(next_deadline - time.time(), 1.0)))
+
+    # Wait up to 'timeout' seconds in all for any background task that is still running. Returns the names of the
+    # tasks that are still running after that:
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for task in self.tasks:
+            if task.thread is not None:
+                task.thread.join(None if deadline is None else max(0.0, deadline - time.time()))
+        return [task.name for task in self.tasks if task.thread is not None and task.thread.is_alive()]
+
+    # Flatten the task stats so they can be written with writeStats:
+    def getStats(self):
+        stats = {}
+        with self.lock:
+            for task in self.tasks:
+                for key, value in task.stats.items():
+                    stats['{}_{}'.format(task.name, key)] = round(value, 3) if isinstance(value, float) else value
+        return stats
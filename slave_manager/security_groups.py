@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# The ingress rules of the security group of the master, kept as desired vs actual (port, cidr) sets.
+# Desired rules come from:
+# - the --required_ip_list,
+# - the public ips of the running prod slaves (updated when an env's instances are loaded, and when we stop or
+#   terminate a slave),
+# - the /24s of github.com (looked up again when the DNS TTL runs out).
+# Actual rules are what describe-security-groups said, plus what we changed since. Only the difference is sent,
+# with all the ip ranges of a change in one authorize (and one revoke) call. A pass with no difference makes
+# no API calls at all. The actual rules are described again every resync_secs, or after an error.
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import say, runParallel
+import aws_client
+
+# Max ip ranges in one authorize/revoke request:
+g_max_ranges_per_call = 100
+
+
+class SecurityGroupReconciler(object):
+    def __init__(self, ec2, group_id, required_ip_list=None, slave_port=30001, dns_names=None, dns_port=443,
+                 resync_secs=900, min_dns_ttl=60, debug=False):
+        self.ec2 = ec2
+        self.group_id = group_id
+        # The required_ip_list is a list of PORT:IP/CIDR:
+        self.static_rules = set([(int(rule.split(':')[0]), str(rule.split(':')[1])) for rule in required_ip_list or []])
+        self.slave_port = slave_port
+        self.dns_names = dns_names if dns_names is not None else ['github.com']
+        self.dns_port = dns_port
+        self.resync_secs = resync_secs
+        self.min_dns_ttl = min_dns_ttl
+        self.debug = debug
+        self.lock = threading.Lock()
+        # Key is env, value is a dict of instance id -> public ip of its running slaves:
+        self.slaves = {}
+        # Key is env, value is the set of instances we started, that do not have a public ip yet:
+        self.expected = {}
+        self.dns_rules = set()
+        self.dns_expires = 0
+        # Until the dns names resolved once, we do not know which of their rules to keep:
+        self.dns_resolved = len(self.dns_names) == 0
+        # None until described:
+        self.actual = None
+        self.described_at = 0
+        self.stats = {'passes': 0, 'no_op_passes': 0, 'describes': 0, 'authorize_calls': 0, 'revoke_calls': 0,
+                      'rules_added': 0, 'rules_removed': 0, 'dns_lookups': 0, 'dns_errors': 0, 'errors': 0}
+
+    # The running slaves of an env (instance id -> public ip), as just loaded:
+    def setSlaves(self, env, slave_ips, pending_ids=()):
+        with self.lock:
+            self.slaves[env] = dict(slave_ips)
+            # Keep waiting for the ones that are still pending:
+            self.expected[env] = set([instance_id for instance_id in self.expected.get(env, set())
+                                      if instance_id in pending_ids])
+
+    # We just started/created a slave in an env. Its public ip shows up once it is running:
+    def expectSlave(self, env, instance_id):
+        with self.lock:
+            self.expected.setdefault(env, set()).add(str(instance_id))
+
+    # The envs we are waiting on a new slave in:
+    def getExpectedEnvs(self):
+        with self.lock:
+            return [env for env, instance_ids in self.expected.items() if len(instance_ids) != 0]
+
+    # We stopped or terminated a slave:
+    def removeSlave(self, env, instance_id):
+        with self.lock:
+            self.slaves.get(env, {}).pop(str(instance_id), None)
+            self.expected.get(env, set()).discard(str(instance_id))
+
+    def needsResync(self, now=None):
+        now = time.time() if now is None else now
+        return self.actual is None or now - self.described_at > self.resync_secs
+
+    # Look up the /24s of the dns names, if their TTL ran out:
+    def refreshDns(self, now):
+        if now < self.dns_expires:
+            return
+        rules = set()
+        ttl = None
+        # All the names at once. A dig that hangs does not hold up the security group pass:
+        results = runParallel(['dig +noall +answer {}'.format(name) for name in self.dns_names], timeout=15,
+                              retry_count=3, raise_on_failure=False)
+        for output, returncode in results:
+            for line in (output or '').split('\n'):
+                # github.com.		60	IN	A	140.82.114.4
+                fields = line.split()
+                if len(fields) == 5 and fields[3] == 'A':
+                    rules.add((self.dns_port, fields[4][:fields[4].rfind('.')] + '.0/24'))
+                    ttl = int(fields[1]) if ttl is None else min(ttl, int(fields[1]))
+        self.stats['dns_lookups'] += 1
+        if len(rules) == 0:
+            # Keep what we had, and try again soon:
+            say('***Error: Could not look up the ip addresses of {}.'.format(self.dns_names))
+            self.stats['dns_errors'] += 1
+            self.dns_expires = now + self.min_dns_ttl
+            return
+        self.dns_rules = rules
+        self.dns_resolved = True
+        self.dns_expires = now + max(ttl, self.min_dns_ttl)
+
+    def getDesired(self):
+        with self.lock:
+            slave_rules = set([(self.slave_port, ip + '/32') for env_slaves in self.slaves.values()
+                               for ip in env_slaves.values()])
+        return self.static_rules | slave_rules | self.dns_rules
+
+    def describe(self, now):
+        j = aws_client.call(self.ec2, 'describe_security_groups', GroupIds=[self.group_id])
+        self.stats['describes'] += 1
+        actual = set()
+        for perm in j['SecurityGroups'][0]['IpPermissions']:
+            # We only manage single port tcp rules:
+            if perm.get('IpProtocol') != 'tcp' or 'ToPort' not in perm:
+                continue
+            for ip_range in perm['IpRanges']:
+                actual.add((int(perm['ToPort']), str(ip_range['CidrIp'])))
+        self.actual = actual
+        self.described_at = now
+
+    # Group rules into IpPermissions, one per port, chunked to g_max_ranges_per_call ranges per call:
+    def getIpPermissionChunks(self, rules):
+        by_port = {}
+        for port, cidr in sorted(rules):
+            by_port.setdefault(port, []).append(cidr)
+        permissions = []
+        for port, cidrs in sorted(by_port.items()):
+            for i in range(0, len(cidrs), g_max_ranges_per_call):
+                permissions.append({'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port,
+                                    'IpRanges': [{'CidrIp': cidr} for cidr in cidrs[i:i + g_max_ranges_per_call]]})
+        chunks = []
+        chunk = []
+        for permission in permissions:
+            if len(chunk) != 0 and sum([len(p['IpRanges']) for p in chunk]) + len(permission['IpRanges']) > g_max_ranges_per_call:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(permission)
+        if len(chunk) != 0:
+            chunks.append(chunk)
+        return chunks
+
+    # Apply the difference between the desired and the actual rules:
+    def reconcile(self, now=None):
+        now = time.time() if now is None else now
+        self.stats['passes'] += 1
+        self.refreshDns(now)
+        if self.needsResync(now):
+            self.describe(now)
+        desired = self.getDesired()
+        to_add = desired - self.actual
+        to_remove = self.actual - desired
+        if self.dns_resolved is False:
+            # The dns names never resolved (ie dig failed since we started). Do not revoke what may be their rules:
+            to_remove = set([rule for rule in to_remove if rule[0] != self.dns_port])
+        if len(to_add) == 0 and len(to_remove) == 0:
+            self.stats['no_op_passes'] += 1
+            return False
+        try:
+            for chunk in self.getIpPermissionChunks(to_add):
+                say('We need to add these ingress rules: {}'.format(
+                    ['{}:{}'.format(p['ToPort'], r['CidrIp']) for p in chunk for r in p['IpRanges']]))
+                aws_client.call(self.ec2, 'authorize_security_group_ingress', GroupId=self.group_id, IpPermissions=chunk)
+                self.stats['authorize_calls'] += 1
+            self.actual |= to_add
+            self.stats['rules_added'] += len(to_add)
+            for chunk in self.getIpPermissionChunks(to_remove):
+                say('We need to remove these ingress rules: {}'.format(
+                    ['{}:{}'.format(p['ToPort'], r['CidrIp']) for p in chunk for r in p['IpRanges']]))
+                aws_client.call(self.ec2, 'revoke_security_group_ingress', GroupId=self.group_id, IpPermissions=chunk)
+                self.stats['revoke_calls'] += 1
+            self.actual -= to_remove
+            self.stats['rules_removed'] += len(to_remove)
+        except aws_client.ClientError as err:
+            # ie InvalidPermission.Duplicate: someone else changed the group. Describe it again next pass:
+            say('***Error: Could not update security group {}: {}'.format(self.group_id, err))
+            self.stats['errors'] += 1
+            self.actual = None
+            raise
+        return True
+
+    def getStats(self):
+        return dict(self.stats)
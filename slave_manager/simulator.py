@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+# Discrete-event simulator of the provisioning logic of the slave manager. No AWS, no Jenkins, no network.
+# Each tick (--queue_interval seconds of simulated time), the fake Jenkins builds the queue/slave json, and it goes
+# through the same pass as in reconcileQueue (applyQueuePass): g_queue_model.apply() -> createOrStartSlaves()
+#   -> stopSlaves() -> g_lifecycle.flush()
+# The slave manager code runs unchanged. Only its ec2 calls go to FakeEc2, and its clock (time.time and
+# time.sleep, and the now of the pass) is the simulated one, so a spot wait or a tagging retry just moves the clock on.
+# - FakeEc2 keeps instances in memory: pending -> running after --boot_secs, stopping/shutting-down take
+#   --stop_secs. Spot requests are fulfilled after ~--spot_fulfill_secs, or never (1 - --spot_capacity of them).
+# - FakeJenkins: a running instance with slave_data tags connects as a swarm slave after --connect_secs. Queue
+#   items run on free executors of their label, first in first out. Idle slaves are marked to die with the rules
+#   of get_queue_jobs.groovy (--idle_timeout_secs, and --billing_idle_secs once connected for
+#   --billing_connect_secs).
+# Jobs come from a trace (--trace, one json per line: {"time": secs, "label": "...", "duration": secs}), or are made
+# up: Poisson arrivals (--arrivals_per_hour), spread over --label LABEL:WEIGHT, with exponential durations
+# (--job_secs). --write_trace saves the made up trace, so it can be replayed against other settings.
+# Everything after '--' is passed to the slave manager (ie -- --max_num_of_slaves_in_env 20 --spot_wait_secs 30).
+# Run it from the directory with environment.json:
+#   python slave_manager/simulator.py --hours 8 --arrivals_per_hour 120 -- --max_num_of_slaves_in_env 20
+import argparse
+import copy
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import dateutil.tz
+from botocore.exceptions import ClientError
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import slave_manager as sm
+from forecast import ArrivalForecaster
+from lifecycle import LifecycleBatch
+from queue_model import JenkinsQueueModel
+from state_store import StateStore
+
+# The real clocks, before the simulation swaps time.time and time.sleep:
+g_real_time = time.time
+g_real_sleep = time.sleep
+g_cpu_time = time.process_time if hasattr(time, 'process_time') else time.clock
+
+
+# The simulated clock. It only moves when the simulation (or a time.sleep in the slave manager) moves it:
+class SimClock(object):
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += max(0.0, secs)
+
+
+# Helper function to raise the ClientError that boto3 would:
+def clientError(operation, code, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+# Nearest rank percentile of a list of numbers (None if it is empty):
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class FakeEc2(object):
+    def __init__(self, clock, boot_secs=45, stop_secs=30, spot_fulfill_secs=20, spot_capacity=0.9):
+        self.clock = clock
+        self.boot_secs = boot_secs
+        self.stop_secs = stop_secs
+        self.spot_fulfill_secs = spot_fulfill_secs
+        self.spot_capacity = spot_capacity
+        # Key is env, value is a dict of instance id -> instance json:
+        self.instances = {}
+        # Key is instance id, value is when its current state ends (pending, stopping, shutting-down):
+        self.transitions = {}
+        # Key is spot request id, value is (env, request json, when it is fulfilled or None):
+        self.spot_requests = {}
+        self.next_id = 0
+        # Key is operation, value is the number of calls:
+        self.calls = {}
+        # Seconds each instance was pending/running/stopping, by 'on_demand' and 'spot':
+        self.billed_secs = {'on_demand': 0.0, 'spot': 0.0}
+        self.billed_until = clock.time()
+        # Key is instance id, value is when it was last created or started:
+        self.launched = {}
+
+    def newId(self, prefix):
+        self.next_id += 1
+        return '{}-{:08x}'.format(prefix, self.next_id)
+
+    def getLaunchTime(self):
+        return datetime.datetime.fromtimestamp(self.clock.time(), dateutil.tz.tzutc()).isoformat()
+
+    def addInstance(self, target_env, image_id, instance_type, subnet_id, state='pending', tags=None, is_spot=False):
+        instance_id = self.newId('i')
+        ip = '10.{}.{}.{}'.format((self.next_id >> 16) & 255, (self.next_id >> 8) & 255, self.next_id & 255)
+        instance = {'InstanceId': instance_id, 'ImageId': image_id, 'InstanceType': instance_type, 'SubnetId': subnet_id,
+                    'State': {'Name': state}, 'LaunchTime': self.getLaunchTime(), 'PrivateIpAddress': ip,
+                    'Tags': tags or [],
+                    'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'DeleteOnTermination': True}}]}
+        if is_spot is True:
+            instance['InstanceLifecycle'] = 'spot'
+        self.instances.setdefault(str(target_env), {})[instance_id] = instance
+        self.launched[instance_id] = self.clock.time()
+        if state == 'pending':
+            self.transitions[instance_id] = self.clock.time() + self.boot_secs
+        return instance
+
+    def setState(self, instance, state, secs=None):
+        instance['State']['Name'] = state
+        if secs is None:
+            self.transitions.pop(instance['InstanceId'], None)
+        else:
+            self.transitions[instance['InstanceId']] = self.clock.time() + secs
+
+    # Move the instances and spot requests on to the current time:
+    def advance(self):
+        now = self.clock.time()
+        for target_env, instances in self.instances.items():
+            for instance_id, instance in list(instances.items()):
+                state = instance['State']['Name']
+                if state in ['pending', 'running', 'stopping']:
+                    start = max(self.billed_until, self.launched.get(instance_id, self.billed_until))
+                    self.billed_secs['spot' if 'InstanceLifecycle' in instance else 'on_demand'] += now - start
+                if state == 'terminated':
+                    # Terminated instances show up for an hour:
+                    if now - self.launched[instance_id] > 3600:
+                        del instances[instance_id]
+                        del self.launched[instance_id]
+                elif instance_id in self.transitions and self.transitions[instance_id] <= now:
+                    next_state = {'pending': 'running', 'stopping': 'stopped', 'shutting-down': 'terminated'}[state]
+                    self.setState(instance, next_state)
+                    if next_state == 'terminated':
+                        self.launched[instance_id] = now
+        self.billed_until = now
+        for request_id, (target_env, request, fulfilled_at) in self.spot_requests.items():
+            if request['State'] == 'open' and fulfilled_at is not None and fulfilled_at <= now:
+                spec = request['LaunchSpecification']
+                instance = self.addInstance(target_env, spec['ImageId'], spec['InstanceType'],
+                                            spec['NetworkInterfaces'][0]['SubnetId'], is_spot=True)
+                request.update({'State': 'active', 'InstanceId': instance['InstanceId'], 'Status': {'Code': 'fulfilled'}})
+
+    def getInstances(self, target_env, instance_ids):
+        instances = self.instances.get(str(target_env), {})
+        for instance_id in instance_ids:
+            if str(instance_id) not in instances:
+                raise clientError('DescribeInstances', 'InvalidInstanceID.NotFound', instance_id)
+        return [instances[str(instance_id)] for instance_id in instance_ids]
+
+    # Same interface as slave_manager.ec2Call():
+    def call(self, target_env, operation, **kwargs):
+        # There is no throttling here:
+        kwargs.pop('retries', None)
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.advance()
+        func = getattr(self, operation, None)
+        if func is None:
+            raise NotImplementedError('The simulator has no fake for ec2 {}'.format(operation))
+        # The caller gets its own copy, just like it would from AWS:
+        return copy.deepcopy(func(str(target_env), **kwargs))
+
+    def describe_instances(self, target_env, InstanceIds=None):
+        if InstanceIds is None:
+            instances = list(self.instances.get(target_env, {}).values())
+        else:
+            instances = self.getInstances(target_env, InstanceIds)
+        return {'Reservations': [{'Instances': instances}]}
+
+    def run_instances(self, target_env, ImageId, InstanceType, SubnetId, **kwargs):
+        return {'Instances': [self.addInstance(target_env, ImageId, InstanceType, SubnetId)]}
+
+    def create_tags(self, target_env, Resources, Tags):
+        for instance in self.getInstances(target_env, Resources):
+            keys = set([tag['Key'] for tag in Tags])
+            instance['Tags'] = [tag for tag in instance['Tags'] if tag['Key'] not in keys] + list(Tags)
+        return {}
+
+    def changeStates(self, target_env, instance_ids, operation, from_states, to_state, secs):
+        changes = []
+        for instance in self.getInstances(target_env, instance_ids):
+            if instance['State']['Name'] not in from_states:
+                raise clientError(operation, 'IncorrectInstanceState',
+                                  '{} is {}'.format(instance['InstanceId'], instance['State']['Name']))
+        for instance in self.getInstances(target_env, instance_ids):
+            previous_state = instance['State']['Name']
+            self.setState(instance, to_state, secs)
+            if to_state == 'pending':
+                instance['LaunchTime'] = self.getLaunchTime()
+                self.launched[instance['InstanceId']] = self.clock.time()
+            changes.append({'InstanceId': instance['InstanceId'], 'PreviousState': {'Name': previous_state},
+                            'CurrentState': {'Name': to_state}})
+        return changes
+
+    def start_instances(self, target_env, InstanceIds):
+        return {'StartingInstances': self.changeStates(target_env, InstanceIds, 'StartInstances', ['stopped'], 'pending',
+                                                       self.boot_secs)}
+
+    def stop_instances(self, target_env, InstanceIds):
+        return {'StoppingInstances': self.changeStates(target_env, InstanceIds, 'StopInstances', ['pending', 'running'],
+                                                       'stopping', self.stop_secs)}
+
+    def terminate_instances(self, target_env, InstanceIds):
+        return {'TerminatingInstances': self.changeStates(target_env, InstanceIds, 'TerminateInstances',
+                                                          ['pending', 'running', 'stopping', 'stopped', 'shutting-down'],
+                                                          'shutting-down', self.stop_secs)}
+
+    def modify_instance_attribute(self, target_env, InstanceId, BlockDeviceMappings=None, **kwargs):
+        instance = self.getInstances(target_env, [InstanceId])[0]
+        for mapping in BlockDeviceMappings or []:
+            for device in instance['BlockDeviceMappings']:
+                if device['DeviceName'] == mapping['DeviceName']:
+                    device['Ebs'].update(mapping['Ebs'])
+        return {}
+
+    def request_spot_instances(self, target_env, LaunchSpecification, **kwargs):
+        request_id = self.newId('sir')
+        fulfilled_at = None
+        if random.random() < self.spot_capacity:
+            fulfilled_at = self.clock.time() + random.expovariate(1.0 / self.spot_fulfill_secs)
+        request = {'SpotInstanceRequestId': request_id, 'State': 'open', 'Status': {'Code': 'pending-evaluation'},
+                   'LaunchSpecification': LaunchSpecification}
+        if fulfilled_at is None:
+            request['Status'] = {'Code': 'capacity-not-available'}
+        self.spot_requests[request_id] = (target_env, request, fulfilled_at)
+        return {'SpotInstanceRequests': [request]}
+
+    def describe_spot_instance_requests(self, target_env, SpotInstanceRequestIds):
+        for request_id in SpotInstanceRequestIds:
+            if request_id not in self.spot_requests:
+                raise clientError('DescribeSpotInstanceRequests', 'InvalidSpotInstanceRequestID.NotFound', request_id)
+        return {'SpotInstanceRequests': [self.spot_requests[request_id][1] for request_id in SpotInstanceRequestIds]}
+
+    def cancel_spot_instance_requests(self, target_env, SpotInstanceRequestIds):
+        for request_id in SpotInstanceRequestIds:
+            request = self.spot_requests[request_id][1]
+            # Cancelling a fulfilled request leaves its instance running:
+            request['State'] = 'cancelled'
+            request['Status'] = {'Code': 'request-canceled-and-instance-running' if 'InstanceId' in request else 'canceled'}
+        return {'CancelledSpotInstanceRequests': [{'SpotInstanceRequestId': request_id, 'State': 'cancelled'}
+                                                  for request_id in SpotInstanceRequestIds]}
+
+
+class FakeJenkins(object):
+    def __init__(self, clock, ec2, connect_secs=60, idle_timeout_secs=2700, billing_idle_secs=300,
+                 billing_connect_secs=3000):
+        self.clock = clock
+        self.ec2 = ec2
+        self.connect_secs = connect_secs
+        self.idle_timeout_secs = idle_timeout_secs
+        self.billing_idle_secs = billing_idle_secs
+        self.billing_connect_secs = billing_connect_secs
+        # Queue items, in arrival order. Each is a dict with id, label, arrived, duration:
+        self.queue = []
+        # Key is instance id. Value is a dict with env, ip, labels, executors, busy (list of job end times),
+        # connected, idle_start, offline:
+        self.slaves = {}
+        # Key is instance id, value is when it was first seen running:
+        self.running_since = {}
+        # Seconds from arrival to start of every job that started:
+        self.waits = []
+        self.jobs_done = 0
+        self.next_id = 0
+
+    def addJob(self, label, duration):
+        self.next_id += 1
+        self.queue.append({'id': self.next_id, 'label': label, 'arrived': self.clock.time(), 'duration': duration})
+
+    # Connect and disconnect slaves, finish and start jobs, and mark idle slaves to die:
+    def advance(self):
+        now = self.clock.time()
+        running = {}
+        for target_env, instances in self.ec2.instances.items():
+            for instance_id, instance in instances.items():
+                if instance['State']['Name'] == 'running':
+                    running[instance_id] = (target_env, instance)
+        for instance_id in list(self.slaves.keys()):
+            if instance_id not in running:
+                # Stopped or terminated. Jobs that were running on it are lost with it:
+                del self.slaves[instance_id]
+        for instance_id in list(self.running_since.keys()):
+            if instance_id not in running:
+                del self.running_since[instance_id]
+        for instance_id, (target_env, instance) in running.items():
+            self.running_since.setdefault(instance_id, now)
+            if instance_id in self.slaves or now - self.running_since[instance_id] < self.connect_secs:
+                continue
+            try:
+                slave_data = json.loads(sm.getTags(instance)['slave_data'])
+            except (KeyError, ValueError):
+                continue
+            self.slaves[instance_id] = {'env': target_env, 'ip': instance['PrivateIpAddress'],
+                                        'image_id': instance['ImageId'],
+                                        'labels': slave_data['slave_labels'].split(' '),
+                                        'executors': int(slave_data['num_of_executors']), 'busy': [],
+                                        'connected': now, 'idle_start': now, 'offline': False}
+        for slave in self.slaves.values():
+            done = [end for end in slave['busy'] if end <= now]
+            if len(done) != 0:
+                self.jobs_done += len(done)
+                slave['busy'] = [end for end in slave['busy'] if end > now]
+                if len(slave['busy']) == 0:
+                    slave['idle_start'] = max(done)
+        # First in first out, onto the free executors of the label:
+        for item in list(self.queue):
+            for instance_id in sorted(self.slaves.keys()):
+                slave = self.slaves[instance_id]
+                if slave['offline'] is False and item['label'] in slave['labels'] and len(slave['busy']) < slave['executors']:
+                    slave['busy'].append(now + item['duration'])
+                    self.waits.append(now - item['arrived'])
+                    self.queue.remove(item)
+                    break
+        for slave in self.slaves.values():
+            if slave['offline'] is True or len(slave['busy']) != 0:
+                continue
+            idle_secs = now - slave['idle_start']
+            if (idle_secs > self.idle_timeout_secs or
+                    (idle_secs > self.billing_idle_secs and now - slave['connected'] > self.billing_connect_secs)):
+                slave['offline'] = True
+
+    def getSlaveName(self, slave):
+        return 'sim-{}'.format(slave['ip'])
+
+    # The queue and the slaves, in the same format as the full output of get_queue_jobs.groovy:
+    def toJson(self):
+        now = self.clock.time()
+        build_queue = [{'queueId': str(item['id']), 'jobName': 'sim_job_{}'.format(item['id']), 'labels': item['label'],
+                        'lastBuiltOn': 'UNKNOWN', 'throttleEnabled': 'false', 'parameters': ''} for item in self.queue]
+        slave_queue = []
+        for instance_id, slave in sorted(self.slaves.items()):
+            slave_queue.append({'slaveName': self.getSlaveName(slave),
+                                'labels': '[{}]'.format(', '.join(slave['labels'] + ['swarm', self.getSlaveName(slave)])),
+                                'isOffLine': 'true' if slave['offline'] is True else 'false',
+                                'description': 'Created by Swarm InstanceID={} AmiId={} '.format(instance_id, slave['image_id']),
+                                'ami_id': slave['image_id'],
+                                'ope_idle_count': 0 if slave['offline'] is True else slave['executors'] - len(slave['busy']),
+                                'connectTime': int(slave['connected'] * 1000),
+                                'idle_seconds': int(now - slave['idle_start']) if len(slave['busy']) == 0 else 0,
+                                'terminate_me': 'true' if slave['offline'] is True and len(slave['busy']) == 0 else 'false'})
+        return {'build_queue': build_queue, 'slave_queue': slave_queue, 'messages': [], 'full': True}
+
+
+# Load a trace (one json per line: {"time": secs from the start, "label": ..., "duration": secs}):
+def readTrace(path):
+    with open(path, 'r') as fd:
+        trace = [json.loads(line) for line in fd if line.strip()]
+    return sorted([(float(job['time']), str(job['label']), float(job['duration'])) for job in trace])
+
+
+# Make up a trace: Poisson arrivals, spread over the labels by weight, with exponential durations:
+def makeTrace(hours, arrivals_per_hour, label_weights, job_secs):
+    trace = []
+    t = 0.0
+    total_weight = float(sum([weight for _, weight in label_weights]))
+    while arrivals_per_hour > 0:
+        t += random.expovariate(arrivals_per_hour / 3600.0)
+        if t >= hours * 3600:
+            break
+        pick = random.uniform(0, total_weight)
+        for label, weight in label_weights:
+            pick -= weight
+            if pick <= 0:
+                break
+        trace.append((t, label, random.expovariate(1.0 / job_secs)))
+    return trace
+
+
+class Simulation(object):
+    def __init__(self, sim_args, trace):
+        self.sim_args = sim_args
+        self.trace = trace
+        self.clock = SimClock(1500000000.0)
+        self.ec2 = FakeEc2(self.clock, boot_secs=sim_args.boot_secs, stop_secs=sim_args.stop_secs,
+                           spot_fulfill_secs=sim_args.spot_fulfill_secs, spot_capacity=sim_args.spot_capacity)
+        self.jenkins = FakeJenkins(self.clock, self.ec2, connect_secs=sim_args.connect_secs,
+                                   idle_timeout_secs=sim_args.idle_timeout_secs, billing_idle_secs=sim_args.billing_idle_secs,
+                                   billing_connect_secs=sim_args.billing_connect_secs)
+        # Per tick: the number of ec2 calls, and the cpu seconds of the reconcile:
+        self.calls_per_tick = []
+        self.cpu_per_tick = []
+
+    # Reset the state of the slave manager module, and point it at the fakes:
+    def setupSlaveManager(self):
+        sm.g_env_pool = None
+        sm.g_state = StateStore(':memory:')
+        sm.g_security_groups = None
+        sm.g_inventory = {}
+        sm.g_tick = 0
+        sm.g_queue_model = JenkinsQueueModel()
+        sm.g_instance_count = dict([(env, set()) for env in sm.g_env_map['environments'].keys()])
+        sm.g_spot_instance_count = dict([(env, set()) for env in sm.g_env_map['environments'].keys()])
+        sm.g_old_ami_check = dict([(env, []) for env in sm.g_env_map['environments'].keys()])
+        sm.ec2Call = self.ec2.call
+        sm.g_lifecycle = LifecycleBatch(self.ec2.call)
+        sm.g_forecaster = ArrivalForecaster(store=sm.g_state)
+
+    # Instances that are already there (stopped) when the simulation starts:
+    def addInitialInstances(self):
+        for initial in self.sim_args.initial_stopped:
+            label, count = initial.rsplit(':', 1)
+            profile = sm.g_label_parser.parse(label)
+            for i in range(int(count)):
+                tags = [{'Key': 'Name', 'Value': sm.args.slave_name},
+                        {'Key': 'slave_data', 'Value': sm.generateDataTag(target_env=profile.env, labels_string=label)}]
+                self.ec2.addInstance(profile.env, sm.g_env_map['environments'][profile.env]['ami_id'], profile.instance_type,
+                                     sm.g_env_map['environments'][profile.env]['vpcsubnet'][0]['id'], state='stopped',
+                                     tags=tags, is_spot=profile.is_spot)
+
+    # One pass, the same one reconcileQueue() runs on what it got from jenkins:
+    def tick(self):
+        sm.g_tick += 1
+        jenkins_json = self.jenkins.toJson()
+        calls_before = sum(self.ec2.calls.values())
+        cpu_before = g_cpu_time()
+        sm.applyQueuePass(jenkins_json, now=self.clock.time())
+        self.cpu_per_tick.append(g_cpu_time() - cpu_before)
+        self.calls_per_tick.append(sum(self.ec2.calls.values()) - calls_before)
+
+    def run(self):
+        start = self.clock.time()
+        end = start + self.sim_args.hours * 3600
+        arrivals = list(self.trace)
+        time.time, time.sleep = self.clock.time, self.clock.sleep
+        try:
+            self.setupSlaveManager()
+            self.addInitialInstances()
+            while self.clock.time() < end:
+                tick_start = self.clock.time()
+                while len(arrivals) != 0 and start + arrivals[0][0] <= tick_start:
+                    _, label, duration = arrivals.pop(0)
+                    self.jenkins.addJob(label, duration)
+                self.ec2.advance()
+                self.jenkins.advance()
+                self.tick()
+                # A spot wait (time.sleep) can make a tick take longer than the interval:
+                self.clock.now = max(self.clock.time(), tick_start + sm.args.queue_interval)
+            self.ec2.advance()
+            self.jenkins.advance()
+        finally:
+            time.time, time.sleep = g_real_time, g_real_sleep
+            sm.g_state.close()
+        return self.getReport()
+
+    def getReport(self):
+        now = self.clock.time()
+        waits = self.jenkins.waits
+        report = {'hours': self.sim_args.hours, 'ticks': len(self.cpu_per_tick), 'jobs_arrived': len(self.trace),
+                  'jobs_started': len(waits), 'jobs_done': self.jenkins.jobs_done,
+                  'jobs_still_queued': len(self.jenkins.queue),
+                  'time_to_slave_secs': dict([('p{}'.format(p), percentile(waits, p)) for p in [50, 95, 99]],
+                                             max=max(waits) if len(waits) != 0 else None),
+                  'still_queued_wait_secs_max': max([now - item['arrived'] for item in self.jenkins.queue] or [0]),
+                  'instance_hours': dict([(kind, round(secs / 3600.0, 2)) for kind, secs in self.ec2.billed_secs.items()]),
+                  'aws_calls': dict(self.ec2.calls),
+                  'aws_calls_per_tick': {'mean': round(sum(self.calls_per_tick) / float(max(1, len(self.calls_per_tick))), 2),
+                                         'p95': percentile(self.calls_per_tick, 95),
+                                         'max': max(self.calls_per_tick or [0])},
+                  'reconcile_cpu_secs': {'total': round(sum(self.cpu_per_tick), 3),
+                                         'mean': round(sum(self.cpu_per_tick) / max(1, len(self.cpu_per_tick)), 5),
+                                         'p95': round(percentile(self.cpu_per_tick, 95) or 0, 5),
+                                         'max': round(max(self.cpu_per_tick or [0]), 5)},
+                  'slave_manager': {'instance_stats': dict(sm.g_instance_stats), 'error_stats': dict(sm.g_error_stats),
+                                    'placement_stats': dict(sm.g_placement_stats), 'spot_stats': dict(sm.g_spot_stats),
+                                    'lifecycle_stats': dict(sm.g_lifecycle.stats)}}
+        for key in report['time_to_slave_secs'].keys():
+            if report['time_to_slave_secs'][key] is not None:
+                report['time_to_slave_secs'][key] = round(report['time_to_slave_secs'][key], 1)
+        return report
+
+
+# Parse the simulator args. What is left (after '--') goes to the slave manager:
+def parseArgs(argv):
+    sim_argv, sm_argv = (argv[:argv.index('--')], argv[argv.index('--') + 1:]) if '--' in argv else (argv, [])
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     epilog='Slave manager options go after --')
+    parser.add_argument('--hours', help='Hours of simulated time.', default=8.0, type=float)
+    parser.add_argument('--trace', help='Replay this trace (one json per line: {"time": secs, "label": ..., "duration": secs}).',
+                        default=None)
+    parser.add_argument('--write_trace', help='Write the (made up) trace to this file.', default=None)
+    parser.add_argument('--arrivals_per_hour', help='Made up trace: queue items per hour.', default=60.0, type=float)
+    parser.add_argument('--label', help='Made up trace: space delimited LABEL:WEIGHT. Defaults to each env, weight 1.',
+                        default=[], nargs='+')
+    parser.add_argument('--job_secs', help='Made up trace: mean job duration in seconds.', default=600.0, type=float)
+    parser.add_argument('--initial_stopped', help='Space delimited LABEL:COUNT of stopped slaves to start with.',
+                        default=[], nargs='+')
+    parser.add_argument('--boot_secs', help='Seconds from pending to running.', default=45.0, type=float)
+    parser.add_argument('--connect_secs', help='Seconds from running to the swarm slave being online.', default=60.0, type=float)
+    parser.add_argument('--stop_secs', help='Seconds to stop or terminate an instance.', default=30.0, type=float)
+    parser.add_argument('--spot_fulfill_secs', help='Mean seconds to fulfill a spot request.', default=20.0, type=float)
+    parser.add_argument('--spot_capacity', help='Share of the spot requests that are fulfilled at all.', default=0.9, type=float)
+    parser.add_argument('--idle_timeout_secs', help='Idle seconds before a slave is marked to die (g_TimeOutValue).',
+                        default=2700.0, type=float)
+    parser.add_argument('--billing_idle_secs', help='Idle seconds before a slave connected for --billing_connect_secs '
+                                                    'is marked to die.', default=300.0, type=float)
+    parser.add_argument('--billing_connect_secs', help='See --billing_idle_secs.', default=3000.0, type=float)
+    parser.add_argument('--seed', help='Random seed.', default=1, type=int)
+    parser.add_argument('--log', help='Where the output of the slave manager goes.', default=os.devnull)
+    parser.add_argument('--json', help='Also write the report to this file.', default=None)
+    sim_args = parser.parse_args(sim_argv)
+
+    # The slave manager only needs to be told what it can not make up:
+    envs = sorted(sm.g_env_map['environments'].keys())
+    if '--ami_ids' not in sm_argv:
+        sm_argv += ['--ami_ids', ','.join(['{}:ami-{:08x}'.format(env, i) for i, env in enumerate(envs)])]
+    sm_argv = ['--url', 'http://simulator', '--jenkins_user', 'simulator', '--jenkins_api_token', 'simulator',
+               '--owner_email', 'simulator@localhost', '--metrics_file', ''] + sm_argv
+    sys.argv = [sys.argv[0]] + sm_argv
+    sm.args = sm.parseArgs()
+    if len(sim_args.label) == 0:
+        sim_args.label = ['{}:1'.format(env) for env in envs]
+    return sim_args
+
+
+def main():
+    sim_args = parseArgs(sys.argv[1:])
+    random.seed(sim_args.seed)
+    if sim_args.trace is not None:
+        trace = readTrace(sim_args.trace)
+    else:
+        label_weights = [(label.rsplit(':', 1)[0], float(label.rsplit(':', 1)[1])) for label in sim_args.label]
+        trace = makeTrace(sim_args.hours, sim_args.arrivals_per_hour, label_weights, sim_args.job_secs)
+    if sim_args.write_trace is not None:
+        with open(sim_args.write_trace, 'wt') as fd:
+            for t, label, duration in trace:
+                fd.write(json.dumps({'time': round(t, 3), 'label': label, 'duration': round(duration, 3)}) + '\n')
+    start = g_real_time()
+    stdout = sys.stdout
+    with open(sim_args.log, 'wt') as log:
+        sys.stdout = log
+        try:
+            report = Simulation(sim_args, trace).run()
+        finally:
+            sys.stdout = stdout
+    report['wall_secs'] = round(g_real_time() - start, 2)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if sim_args.json is not None:
+        with open(sim_args.json, 'wt') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,28 +4,43 @@ import subprocess
 import json
 import argparse
 import random
+import math
 import datetime
 import dateutil.parser
 import time
 import glob
-import hashlib
 import base64
-import tempfile
 # Python 2 vs python 3:
 try:
     import urllib.request as urllib2
 except ImportError:
     import urllib2
 import csv
+import collections
 import traceback
 import ssl
-import boto
-from boto.sqs.message import Message
-import boto.sqs
-import boto.ec2
+import signal
+import threading
+from multiprocessing.pool import ThreadPool
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from common import *
+import aws_client
+from metrics import g_metrics
+from rate_limiter import g_rate_limiter
+from subnet_scorer import g_subnet_scorer, g_capacity_error_codes
+from jenkins_client import JenkinsClient
+from inventory import Inventory, getTags
+from scheduler import Scheduler
+from lifecycle import LifecycleBatch
+from labels import LabelParser
+from state_store import StateStore
+from queue_model import JenkinsQueueModel, parseCompactLines
+from forecast import ArrivalForecaster
+from planner import PlacementPlanner
+from profiler import TickProfiler
+from capture import TraceRecorder, TraceReplayer
+from security_groups import SecurityGroupReconciler
 
 
 # Valid Labels:
@@ -43,9 +58,24 @@ g_jenkins_instance_types = ['t2.small', 't2.medium', 't2.large',
                             'm3.medium', 'm3.large', 'm3.xlarge',
                             'm4.large', 'c3.large', 'c4.large', 'c4.xlarge',
                             'c4.2xlarge', 'c3.2xlarge', 'm4.2xlarge', 'm3.2xlarge']
+# Spot instance types that can stand in for the type of a label (at least as many vCPUs and as much memory):
+g_spot_equivalent_types = {'t2.small': ['t2.medium', 'm3.medium'],
+                           't2.medium': ['t2.large', 'm4.large', 'm3.large'],
+                           't2.large': ['m4.large'],
+                           'm3.medium': ['t2.medium'],
+                           'm3.large': ['m4.large', 't2.large'],
+                           'm4.large': ['t2.large'],
+                           'c3.large': ['c4.large', 'm4.large', 'm3.large'],
+                           'c4.large': ['c3.large', 'm4.large', 'm3.large'],
+                           'm3.xlarge': ['c4.2xlarge', 'c3.2xlarge'],
+                           'c4.xlarge': ['m3.xlarge', 'c4.2xlarge'],
+                           'c4.2xlarge': ['c3.2xlarge', 'm4.2xlarge'],
+                           'c3.2xlarge': ['c4.2xlarge', 'm4.2xlarge'],
+                           'm3.2xlarge': ['m4.2xlarge'],
+                           'm4.2xlarge': []}
 # Valid Node Labels:
-g_valid_labels = set(list(g_env_map['environments'].keys()) + [env + '_' + label for env in list(g_env_map['environments'].keys()) for label in list(g_label_map.keys())])
-g_valid_labels = set(list(g_valid_labels) + [l + '_' + t for l in list(g_valid_labels) for t in g_jenkins_instance_types])
+g_label_parser = LabelParser(env_names=g_env_map['environments'].keys(), instance_types=g_jenkins_instance_types,
+                             label_map=g_label_map)
 
 # The stats of what happened in a run:
 g_instance_stats = {'instances_created': 0, 'instances_started': 0, 'instances_terminated': 0,
@@ -55,35 +85,114 @@ g_error_stats = {'instance_stopped_state': 0, 'job_on_queue': 0, 'instance_not_s
                  'jobs_waited_too_long': 0, 'jar_file_error': 0, 'error_stopping_instance': 0}
 
 g_sqs_stats = {'sqs_handled': 0, 'sqs_dropped': 0, }
+g_sts_stats = {'sts_refreshes': 0, 'sts_refresh_errors': 0}
+# The wait is from the spot requests being sent to one of them having an instance id:
+g_spot_stats = {'spot_slaves_requested': 0, 'spot_requests': 0, 'spot_fulfilled': 0, 'spot_not_fulfilled': 0,
+                'spot_extra_terminated': 0, 'spot_wait_secs_total': 0.0, 'spot_wait_secs_last': 0.0, 'spot_wait_secs_max': 0.0}
+# A burst is a pass over the new queue items of one env. Launches are the instances started or created for them:
+g_placement_stats = {'bursts': 0, 'items': 0, 'placed': 0, 'launches': 0, 'launches_last_burst': 0,
+                     'launches_max_burst': 0, 'launches_per_burst': 0.0}
+
+# The stats are updated from the per-env worker threads:
+g_stats_lock = threading.Lock()
+
+# Continuous metrics (see metrics.py), written to --metrics_file every tick and served on --metrics_port:
+g_metrics.describe('slave_manager_phase_seconds', 'histogram', 'Seconds per phase of a queue pass.')
+g_metrics.describe('slave_manager_task_seconds', 'histogram', 'Seconds per run of a scheduled task.')
+g_metrics.describe('slave_manager_task_lateness_seconds', 'histogram', 'Seconds a scheduled task started after its deadline.')
+g_metrics.describe('slave_manager_task_errors_total', 'counter', 'Runs of a scheduled task that raised.')
+g_metrics.describe('slave_manager_time_to_slave_seconds', 'histogram', 'Seconds from creating/starting a slave for a queue '
+                   'item to the item leaving the queue.', buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 240, 300, 600, 900, 1800))
+g_metrics.describe('slave_manager_instances', 'gauge', 'Instances named --slave_name, by env, slave label and state.')
+g_metrics.describe('slave_manager_queue_items', 'gauge', 'Items on the build queue, by label.')
+g_metrics.describe('slave_manager_slaves', 'gauge', 'Slaves connected to jenkins, by label.')
+g_metrics.describe('slave_manager_stat', 'gauge', 'The stats of the properties_GROUP.csv files.')
 
 # Current instance count:
-g_instance_count = dict.fromkeys(g_env_map['environments'].keys(), set())
-g_spot_instance_count = dict.fromkeys(g_env_map['environments'].keys(), set())
+g_instance_count = dict([(env, set()) for env in g_env_map['environments'].keys()])
+g_spot_instance_count = dict([(env, set()) for env in g_env_map['environments'].keys()])
 
 # Current instance count based on shared or not shared:
 g_instance_details = {}
 
-# The original, unsullied env vars:
-g_os_environ_orig = dict(os.environ)
-
-# Instances that we have set termination policy (so we don't do it again)
-g_termination_policy = dict.fromkeys(g_env_map['environments'].keys(), [])
+# Instances that we set the termination policy on, and have not seen it stick yet (the ones that have are kept in
+# g_state). Key is instance id, value is (env, list of device names, when we set it, number of times we set it):
+g_termination_policy = {}
+g_termination_policy_lock = threading.Lock()
+g_termination_policy_stats = {'policy_already_set': 0, 'policy_modified': 0, 'policy_verified': 0, 'policy_retries': 0,
+                              'policy_errors': 0, 'policy_pruned': 0}
 
 # Instances that we have checked its AMI-ID (so we don't do it again)
-g_old_ami_check = dict.fromkeys(g_env_map['environments'].keys(), [])
+g_old_ami_check = dict([(env, []) for env in g_env_map['environments'].keys()])
+
+# The STS credentials of each env. Key is env, value is an aws_client.AwsCredentials:
+g_credentials = {}
+
+# Pool of threads to work on several environments at the same time (created in setup):
+g_env_pool = None
+
+# Snapshot of the instances in each env. Key is env, value is an Inventory that is re-loaded once per tick:
+g_inventory = {}
+
+# The current main loop iteration (pass over the queue):
+g_tick = 0
+
+# The latest queue and node info from Jenkins:
+g_jenkins_json = None
+# The model of the queue and nodes that the (incremental) output of get_queue_jobs.groovy is applied to:
+g_queue_model = JenkinsQueueModel()
+# Size of the get_queue_jobs.groovy output, and how long it took to get and parse it:
+g_queue_payload_stats = {'fetches': 0, 'bytes_total': 0, 'bytes_last': 0, 'bytes_max': 0,
+                         'fetch_secs_total': 0.0, 'parse_secs_total': 0.0, 'parse_secs_last': 0.0}
+
+# Only print the java command once, to save clutter in console output
+bHide_command = False
+
+# The long lived connection to the Jenkins master (created in setup):
+g_jenkins = None
+
+# The jobs we are working on and the instances we just started (opened in setup):
+g_state = None
+
+# Forecast of the queue items each label will get, from their arrival history (created in setup):
+g_forecaster = None
+
+# The ingress rules of the master's security group (the prod slaves and github):
+g_security_groups = None
+
+# Profiles the queue passes (--profile):
+g_profiler = None
+
+# Warm pools (--warm_pool). Key is label, value is (min, max) idle slaves to keep ready:
+g_warm_pools = {}
+g_warm_pool_stats = {'warm_pool_passes': 0, 'warm_pool_started': 0, 'warm_pool_created': 0, 'warm_pool_at_max': 0}
+
+# The groovy script that runs the garbage collector on the master:
+g_run_gc_groovy = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'run_gc.groovy')
+
+
+# Thread safe way to bump a stat:
+def addStat(stats_dict, key, value=1):
+    with g_stats_lock:
+        stats_dict[key] += value
+
+
+# Run func(env) for each env on the worker pool. Returns the results in the same order as envs:
+def forEachEnv(func, envs):
+    envs = list(envs)
+    if g_env_pool is None or len(envs) <= 1:
+        return [func(env) for env in envs]
+    if g_profiler is not None:
+        func = g_profiler.wrap(func)
+    return g_env_pool.map(func, envs)
 
 
 # Dynamically generate the user-data script:
 def generateDataTag(target_env=None, labels_string=None):
-    num_of_executors = 1
-    # Look for shared and deploy keywords:
     label_list = [str(labels_string).strip()]
-    for label in label_list:
-        for sub_label in label.split('_'):
-            if sub_label in g_label_map.keys():
-                if 'num_of_executors' in g_label_map[sub_label].keys():
-                    num_of_executors = g_label_map[sub_label]['num_of_executors']
-                    break
+    # Shared and spot slaves have their own number of executors:
+    profile = g_label_parser.parse(label_list[0])
+    num_of_executors = profile.num_of_executors if profile is not None else 1
     context = {
         'num_of_executors': num_of_executors,
         'environment': 'infra',
@@ -98,27 +207,122 @@ def generateDataTag(target_env=None, labels_string=None):
 def generateStsCredentials(target_env=None, session_name=None, account_id=None):
     say('Assuming the role of {} in {}...'.format(g_env_map['jenkins-master']['jenkins-master-sg-name'], target_env))
 
-    cmd = ('aws sts assume-role --role-arn "arn:aws:iam::{}:role/{}" '
-           '--role-session-name {} --region {}').format(account_id,
-                                                        g_env_map['jenkins-master']['jenkins-master-sg-name'],
-                                                        session_name,
-                                                        g_env_map['environments'][target_env]['region'])
-    output, returncode = run(cmd, retry_count=3)
-    j = json.loads(output)
-    SecretAccessKey = j['Credentials']['SecretAccessKey']
-    SessionToken = j['Credentials']['SessionToken']
-    AccessKeyId = j['Credentials']['AccessKeyId']
-
-    return AccessKeyId, SecretAccessKey, SessionToken
+    sts = aws_client.getClient('sts', g_env_map['environments'][target_env]['region'])
+    j = aws_client.call(sts, 'assume_role',
+                        RoleArn='arn:aws:iam::{}:role/{}'.format(account_id, g_env_map['jenkins-master']['jenkins-master-sg-name']),
+                        RoleSessionName=session_name)
+    return aws_client.AwsCredentials(env=str(target_env),
+                                     aws_access_key_id=j['Credentials']['AccessKeyId'],
+                                     aws_secret_access_key=j['Credentials']['SecretAccessKey'],
+                                     aws_session_token=j['Credentials']['SessionToken'],
+                                     expiration=dateutil.parser.parse(j['Credentials']['Expiration']),
+                                     account_id=account_id)
+
+
+# Assume the role of every env whose credentials expire within 'margin' seconds (or that has none yet):
+def refreshStsCredentials(margin=0):
+    def refreshEnv(env):
+        credentials = g_credentials.get(str(env))
+        if credentials is not None and credentials.secondsLeft() is not None and credentials.secondsLeft() > margin:
+            return
+        try:
+            new_credentials = generateStsCredentials(target_env=str(env), session_name='slave-manager-script',
+                                                     account_id=g_env_map['environments'][env]['account-id'])
+        except Exception:
+            say('***Error: Could not refresh the STS credentials of {}:\n{}'.format(env, traceback.format_exc()))
+            addStat(g_sts_stats, 'sts_refresh_errors')
+            if credentials is None:
+                raise
+            return
+        # Swap them in. Calls already in flight finish with the old (still valid) credentials:
+        g_credentials[new_credentials.env] = new_credentials
+        addStat(g_sts_stats, 'sts_refreshes')
+        say('STS credentials of {} are good until {}'.format(env, new_credentials.expiration))
+    forEachEnv(refreshEnv, g_env_map['environments'].keys())
+
+
+# Get the pooled ec2 client of an env (it uses the pre-cached STS credentials of that env):
+def getEc2Client(target_env):
+    credentials = g_credentials.get(str(target_env))
+    if credentials is None:
+        credentials = aws_client.AwsCredentials(env=str(target_env),
+                                                account_id=g_env_map['environments'][str(target_env)]['account-id'])
+    return credentials.getClient('ec2', g_env_map['environments'][str(target_env)]['region'])
+
+
+# Run an ec2 operation in an env. Returns the same json that the aws cli returns:
+def ec2Call(target_env, operation, **kwargs):
+    return aws_client.call(getEc2Client(target_env), operation, **kwargs)
+
+
+# Instance starts, stops and terminations are collected here during a tick, and sent with one call per env and action:
+g_lifecycle = LifecycleBatch(ec2Call)
+
+
+# Get the instance snapshot of an env. Only the first call in a tick lists the instances:
+def getInventory(target_env):
+    inventory = g_inventory.setdefault(str(target_env), Inventory(str(target_env)))
+    with inventory.lock:
+        if inventory.tick != g_tick:
+            # The queue pass waits on this, so it gives up sooner than the default. The next tick tries again:
+            inventory.load(ec2Call(target_env, 'describe_instances', retries=args.queue_api_retries), g_tick)
+            # See how the instances we launched are doing (and if AWS took back any spot instances):
+            g_subnet_scorer.observe(inventory.find())
+            # Instances per label and state:
+            instance_counts = collections.Counter([(label, i['State']['Name'])
+                                                   for i in inventory.find(name=args.slave_name)
+                                                   for label in inventory.getLabels(i['InstanceId']) or ['']])
+            g_metrics.setAll('slave_manager_instances', [({'label': label, 'state': state}, count)
+                                                         for (label, state), count in instance_counts.items()],
+                             env=str(target_env))
+            if isProdEnv(target_env) and g_security_groups is not None:
+                # The prod slaves need to be let into the master's security group:
+                g_security_groups.setSlaves(target_env,
+                                            dict([(str(i['InstanceId']), str(i['PublicIpAddress'])) for i in
+                                                  inventory.find(name=args.slave_name, states=['running'])
+                                                  if 'PublicIpAddress' in i]),
+                                            pending_ids=set([str(i['InstanceId']) for i in inventory.find(states=['pending'])]))
+    return inventory
+
+
+# Helper function to tell if the slaves of an env have to be let into the master's security group:
+def isProdEnv(target_env):
+    return 'prod' in str(target_env)
+
+
+# Remember we just created/started an instance (its tags may not be visible for a while):
+def rememberStartingInstance(target_env, instance_id, labels):
+    g_state.addStartingInstance(target_env, instance_id, labels)
+    if isProdEnv(target_env) and g_security_groups is not None:
+        # Let it into the master's security group as soon as it has a public ip:
+        g_security_groups.expectSlave(target_env, instance_id)
+
+
+# Get a single instance, from the snapshot if we can:
+def getInstance(target_env, instance_id):
+    inventory = getInventory(target_env)
+    instance = inventory.get(instance_id)
+    if instance is None:
+        # Not in the snapshot yet (created after it was taken by someone else?):
+        j = ec2Call(target_env, 'describe_instances', InstanceIds=[instance_id])
+        instance = j['Reservations'][0]['Instances'][0]
+        inventory.add(instance)
+    return instance
 
 
-# Switch Environments via STS:
-def switchEnvironments(target_env=None, session_name=None, account_id=None):
-    say('Getting pre-cached STS credentials for env: {}...'.format(target_env))
-    # Create the env vars needed by the aws cli commands:
-    os.environ['AWS_ACCESS_KEY_ID'] = g_env_map['environments'][str(target_env)]['AccessKeyId']
-    os.environ['AWS_SECRET_ACCESS_KEY'] = g_env_map['environments'][str(target_env)]['SecretAccessKey']
-    os.environ['AWS_SESSION_TOKEN'] = g_env_map['environments'][str(target_env)]['SessionToken']
+# Add tags to a new instance (Sometimes the instance doesn't quite exist yet, so retry):
+def tagInstance(target_env=None, instance_id=None, tags=None):
+    for i in range(10):
+        try:
+            ec2Call(target_env, 'create_tags', Resources=[str(instance_id)],
+                    Tags=[{'Key': k, 'Value': v} for k, v in tags])
+            return True
+        except aws_client.ClientError as err:
+            if aws_client.getErrorCode(err) != 'InvalidInstanceID.NotFound':
+                raise
+            say('Instance {} does not exist yet. Sleeping 1s before adding tags...'.format(instance_id), do_print=args.debug)
+        time.sleep(1)
+    return False
 
 
 # Create a spot instance:
@@ -131,122 +335,185 @@ def createSpotInstance(target_env=None, job_name=None, labels_string=None, slave
         return
 
     account_id = g_env_map['environments'][target_env]['account-id']
-    os_environ_orig = dict(os.environ)
-    # We need to Assume the Role in the target env to set the tags there:
-    switchEnvironments(target_env=str(target_env), session_name='run-an-instance', account_id=account_id)
     data_json = generateDataTag(target_env=target_env, labels_string=labels_string)
 
     # Get the instance_type:
     instance_type = getInstanceTypeFromLabelString(labels_string=labels_string)
 
-    # Generate a launch-specification json file:
-    launch_specification = {
-        "ImageId": ami_id,
-        "KeyName": "jenkins.cloud",
-        "InstanceType": instance_type,
-        "BlockDeviceMappings": [{
-            "DeviceName": "/dev/xvda",
-            "Ebs": {
-                "VolumeSize": 25,
-                "DeleteOnTermination": True,
-                "VolumeType": "standard"
+    # Generate the launch-specification of each (instance type, subnet) to ask for:
+    launch_specifications = []
+    for spot_instance_type, subnet_id in getSpotLaunchChoices(target_env, instance_type, args.spot_requests_per_slave,
+                                                              reason='{} for {}'.format(labels_string, job_name)):
+        launch_specifications.append({
+            "ImageId": ami_id,
+            "KeyName": "jenkins.cloud",
+            "InstanceType": spot_instance_type,
+            "BlockDeviceMappings": [{
+                "DeviceName": "/dev/xvda",
+                "Ebs": {
+                    "VolumeSize": 25,
+                    "DeleteOnTermination": True,
+                    "VolumeType": "standard"
+                }
+            }],
+            "NetworkInterfaces": [{
+                "DeviceIndex": 0,
+                "SubnetId": subnet_id,
+                "Groups": [g_env_map['environments'][target_env]['jenkins-sg']],
+                "AssociatePublicIpAddress": True
+            }],
+            "IamInstanceProfile": {
+                "Arn": 'arn:aws:iam::' + account_id + ':instance-profile/' + g_env_map['environments'][target_env]['instance-profile']
             }
-        }],
-        "NetworkInterfaces": [{
-            "DeviceIndex": 0,
-            "SubnetId": random.choice(g_env_map['environments'][target_env]['vpcsubnet'])['id'],
-            "Groups": [g_env_map['environments'][target_env]['jenkins-sg']],
-            "AssociatePublicIpAddress": True
-        }],
-        "IamInstanceProfile": {
-            "Arn": 'arn:aws:iam::' + account_id + ':instance-profile/' + g_env_map['environments'][target_env]['instance-profile']
-        }
-    }
-    os_fd, file_name = tempfile.mkstemp(prefix='temp_spot_', suffix='.json', text=True)
-    os.close(os_fd)
-    with open(file_name, 'w') as fd:
-        json.dump(launch_specification, fd)
+        })
     if args.debug is True:
-        with open(file_name, 'r') as fd:
-            say(fd.read())
-
-    # Request a spot instance:
-    cmd = ('aws ec2 request-spot-instances --spot-price "{}" --instance-count 1 '
-           '--type "one-time" --region {} --launch-specification file://{}').format(args.max_spot_price, g_env_map['environments'][target_env]['region'], file_name)
-    output, returncode = run(cmd, retry_count=3)
-    os.remove(file_name)
-    j = json.loads(output)
-    spotInstanceRequestId = j['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-
-    # Wait till we get an instance_id:
-    instance_id = None
-    for i in range(10):
-        cmd = ('aws ec2 describe-spot-instance-requests --region {} '
-               '--spot-instance-request-ids {}').format(g_env_map['environments'][target_env]['region'], spotInstanceRequestId)
-        output, returncode = run(cmd, retry_count=3, hide_command=args.debug is False)
-        j = json.loads(output)
-        if 'InstanceId' in j['SpotInstanceRequests'][0]:
-            instance_id = j['SpotInstanceRequests'][0]['InstanceId']
-            break
-        say('Waiting for spot intance to be available...', do_print=args.debug)
-        time.sleep(6)
-    if instance_id is None:
-        say('Could not get instance-id after 1m. Terminating the spot instance request: {}'.format(spotInstanceRequestId))
-        cmd = 'aws ec2 cancel-spot-instance-requests --spot-instance-request-ids {} --region {}'.format(spotInstanceRequestId, g_env_map['environments'][target_env]['region'])
-        output, returncode = run(cmd, retry_count=3)
-        return False
+        say(json.dumps(launch_specifications))
 
-    instance = None
-    for i in range(10):
+    # Request a spot instance of each kind. Whichever is fulfilled first is the one we keep:
+    addStat(g_spot_stats, 'spot_slaves_requested')
+    start = time.time()
+    spot_requests = {}  # Key is spot request id, value is (instance type, subnet id).
+    for launch_specification in launch_specifications:
         try:
-            # Add the tags (We need to use boto, since cli does not handle json values very well)
-            conn = connect(boto.ec2.connect_to_region, g_env_map['environments'][target_env]['region'])
-            reservations = conn.get_all_instances(instance_ids=instance_id)
-            instance = reservations[0].instances[0]
-            break
-        except boto.exception.EC2ResponseError:
-            pass
-        time.sleep(1)
-    if instance is None:
-        say('Could not get instance after 10s. Terminating the spot instance request: {}'.format(spotInstanceRequestId))
-        cmd = 'aws ec2 cancel-spot-instance-requests --spot-instance-request-ids {} --region {}'.format(spotInstanceRequestId, g_env_map['environments'][target_env]['region'])
-        output, returncode = run(cmd, retry_count=3)
+            j = ec2Call(target_env, 'request_spot_instances', SpotPrice=str(args.max_spot_price), InstanceCount=1,
+                        Type='one-time', LaunchSpecification=launch_specification)
+        except aws_client.ClientError as err:
+            say('***Error: Could not request a {} spot instance in {}: {}'.format(launch_specification['InstanceType'],
+                                                                                 launch_specification['NetworkInterfaces'][0]['SubnetId'],
+                                                                                 err))
+            g_subnet_scorer.recordLaunchError(launch_specification['NetworkInterfaces'][0]['SubnetId'],
+                                              launch_specification['InstanceType'], aws_client.getErrorCode(err))
+            continue
+        spot_requests[str(j['SpotInstanceRequests'][0]['SpotInstanceRequestId'])] = (
+            launch_specification['InstanceType'], launch_specification['NetworkInterfaces'][0]['SubnetId'])
+        addStat(g_spot_stats, 'spot_requests')
+    if len(spot_requests) == 0:
+        addStat(g_spot_stats, 'spot_not_fulfilled')
         return False
 
-    instance.add_tag('Name', slave_name)
-    instance.add_tag('slave_data', data_json)
-    instance.add_tag('owner', owner_email)
-    instance.add_tag('environment', 'infra')
-    instance.add_tag('role', slave_name)
-    instance.add_tag('is_spot', 'true')
-    instance.add_tag('is_asg', 'false')
-    instance.add_tag('jumpcloud_tags', 'admin,superadmin')
+    # Wait till we get an instance_id. All the open requests are looked at with one call:
+    spotInstanceRequestId, instance_id = waitForSpotRequests(target_env, spot_requests, start)
+    if instance_id is None:
+        say('Could not get instance-id after {}s. Cancelling the spot instance requests: {}'.format(args.spot_wait_secs,
+                                                                                                   sorted(spot_requests)))
+        addStat(g_spot_stats, 'spot_not_fulfilled')
+        cancelSpotRequests(target_env, sorted(spot_requests))
+        return False
+    g_subnet_scorer.recordLaunch(spot_requests[spotInstanceRequestId][1], spot_requests[spotInstanceRequestId][0],
+                                 instance_id=instance_id)
+    wait_secs = round(time.time() - start, 1)
+    say('Spot request {} ({} in {}) was fulfilled first, after {}s: {}'.format(spotInstanceRequestId,
+                                                                              spot_requests[spotInstanceRequestId][0],
+                                                                              spot_requests[spotInstanceRequestId][1],
+                                                                              wait_secs, instance_id))
+    addStat(g_spot_stats, 'spot_fulfilled')
+    addStat(g_spot_stats, 'spot_wait_secs_total', wait_secs)
+    with g_stats_lock:
+        g_spot_stats['spot_wait_secs_last'] = wait_secs
+        g_spot_stats['spot_wait_secs_max'] = max(g_spot_stats['spot_wait_secs_max'], wait_secs)
+    # We only need the one:
+    cancelSpotRequests(target_env, sorted(set(spot_requests) - set([spotInstanceRequestId])))
+
+    tags = [('Name', slave_name),
+            ('slave_data', data_json),
+            ('owner', owner_email),
+            ('environment', 'infra'),
+            ('role', slave_name),
+            ('is_spot', 'true'),
+            ('is_asg', 'false'),
+            ('jumpcloud_tags', 'admin,superadmin')]
+    if tagInstance(target_env=target_env, instance_id=instance_id, tags=tags) is False:
+        say('Could not tag instance after 10s. Terminating the spot instance request: {}'.format(spotInstanceRequestId))
+        ec2Call(target_env, 'cancel_spot_instance_requests', SpotInstanceRequestIds=[spotInstanceRequestId])
+        return False
 
+    getInventory(target_env).add({'InstanceId': instance_id, 'State': {'Name': 'pending'},
+                                  'Tags': [{'Key': k, 'Value': v} for k, v in tags]})
     g_spot_instance_count[str(target_env)].add(str(instance_id))
-    g_instance_stats['instances_created'] += 1
-    # Reset the env vars:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
-    # Write a file on disk to indicate we just started this instance:
-    label_list = [str(labels_string).strip()]
-
-    with open('{}__{}.start_instance'.format(target_env, instance_id), 'w') as fd:
-        fd.write('labels=' + ','.join(label_list) + '\n')
-        fd.write('instance_id={}\n'.format(instance_id))
+    addStat(g_instance_stats, 'instances_created')
+    # Remember we just started this instance:
+    rememberStartingInstance(target_env, instance_id, [str(labels_string).strip()])
     return True
 
 
+# The (instance type, subnet id) pairs to request spot instances with, for a label's instance type.
+# The label's own type comes first. The requests are spread over the subnets (AZs), best scored first:
+def getSpotLaunchChoices(target_env, instance_type, count, reason=None):
+    instance_types = [instance_type] + g_spot_equivalent_types.get(instance_type, [])
+    subnet_ids = [subnet['id'] for subnet in g_env_map['environments'][target_env]['vpcsubnet']]
+    choices = []
+    for i in range(min(max(count, 1), len(instance_types) * len(subnet_ids))):
+        choice_type = instance_types[i % len(instance_types)]
+        used_subnet_ids = [subnet_id for t, subnet_id in choices if t == choice_type]
+        unused_subnet_ids = [subnet_id for subnet_id in subnet_ids if subnet_id not in [c[1] for c in choices]]
+        choice_subnet_ids = [subnet_id for subnet_id in (unused_subnet_ids or subnet_ids) if subnet_id not in used_subnet_ids]
+        if len(choice_subnet_ids) == 0:
+            continue
+        choices.append((choice_type, g_subnet_scorer.choose(choice_subnet_ids, choice_type, reason=reason)))
+    return choices
+
+
+# Poll the spot requests until one of them has an instance. Returns (spot request id, instance id),
+# or (None, None) if none did in --spot_wait_secs:
+def waitForSpotRequests(target_env, spot_requests, start):
+    open_request_ids = set(spot_requests.keys())
+    delay = 1.0
+    while len(open_request_ids) != 0 and time.time() - start < args.spot_wait_secs:
+        time.sleep(delay)
+        delay = min(delay * 1.5, 6)
+        try:
+            j = ec2Call(target_env, 'describe_spot_instance_requests', SpotInstanceRequestIds=sorted(open_request_ids))
+        except aws_client.ClientError as err:
+            # New requests can take a few seconds to show up:
+            if aws_client.getErrorCode(err) != 'InvalidSpotInstanceRequestID.NotFound':
+                raise
+            continue
+        for request in j['SpotInstanceRequests']:
+            if 'InstanceId' in request:
+                return str(request['SpotInstanceRequestId']), str(request['InstanceId'])
+            if request['State'] in ['closed', 'cancelled', 'failed']:
+                say('Spot request {} ({}) is {}: {}'.format(request['SpotInstanceRequestId'],
+                                                            spot_requests[str(request['SpotInstanceRequestId'])][0],
+                                                            request['State'], request.get('Status', {}).get('Code')))
+                open_request_ids.discard(str(request['SpotInstanceRequestId']))
+                instance_type, subnet_id = spot_requests[str(request['SpotInstanceRequestId'])]
+                g_subnet_scorer.recordFailure(subnet_id, instance_type, error_code=request.get('Status', {}).get('Code'))
+            else:
+                say('Waiting for spot intance to be available... {}: {}'.format(request['SpotInstanceRequestId'],
+                                                                               request.get('Status', {}).get('Code')),
+                    do_print=args.debug)
+    # None of them came through in time:
+    for request_id in open_request_ids:
+        instance_type, subnet_id = spot_requests[request_id]
+        g_subnet_scorer.recordFailure(subnet_id, instance_type, error_code='timeout')
+    return None, None
+
+
+# Cancel spot requests. Any of them that were fulfilled in the meantime have their instance terminated:
+def cancelSpotRequests(target_env, request_ids):
+    if len(request_ids) == 0:
+        return
+    ec2Call(target_env, 'cancel_spot_instance_requests', SpotInstanceRequestIds=request_ids)
+    j = ec2Call(target_env, 'describe_spot_instance_requests', SpotInstanceRequestIds=request_ids)
+    for request in j['SpotInstanceRequests']:
+        if 'InstanceId' in request:
+            say('Terminating the instance of cancelled spot request {}: {}'.format(request['SpotInstanceRequestId'],
+                                                                                   request['InstanceId']))
+            addStat(g_spot_stats, 'spot_extra_terminated')
+            g_lifecycle.add(target_env, 'terminate', str(request['InstanceId']))
+
+
 # Helper function to get Instance Type from label string:
 def getInstanceTypeFromLabelString(labels_string):
-    # Get the instance_type:
-    instance_type = 't2.small'
-    label_list = [str(labels_string).strip()]
-    for label in label_list:
-        for sub_label in label.split('_'):
-            if sub_label in g_jenkins_instance_types:
-                instance_type = sub_label
-                break
-    return instance_type
+    profile = g_label_parser.parse(str(labels_string).strip())
+    if profile is None:
+        return g_label_parser.default_instance_type
+    return profile.instance_type
+
+
+# Helper function to tell if any of the labels is a spot label:
+def isSpotLabelSet(labels):
+    return any([profile.is_spot for profile in g_label_parser.parseAll(labels)])
 
 
 # Create a single instance:
@@ -259,229 +526,144 @@ def createInstance(target_env=None, job_name=None, labels_string=None, slave_nam
         return
 
     account_id = g_env_map['environments'][target_env]['account-id']
-    os_environ_orig = dict(os.environ)
-    # We need to Assume the Role in the target env to set the tags there:
-    switchEnvironments(target_env=str(target_env), session_name='run-an-instance', account_id=account_id)
     data_json = generateDataTag(target_env=target_env, labels_string=labels_string)
 
-    # Connect to ec2:
-    conn = connect(boto.ec2.connect_to_region, g_env_map['environments'][target_env]['region'])
-
-    # Create blockDeviceMapping for use in 'run_instances"
-    dev_sda1 = boto.ec2.blockdevicemapping.EBSBlockDeviceType()
-    # Size in Gigabytes
-    dev_sda1.size = 25
-    bdm = boto.ec2.blockdevicemapping.BlockDeviceMapping()
-    bdm['/dev/xvda'] = dev_sda1
+    # Size in Gigabytes:
+    block_device_mappings = [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 25}}]
     # Get the instance_type:
     instance_type = getInstanceTypeFromLabelString(labels_string=labels_string)
 
     # Create the new instance, and assign the output returned to "output"
     instance_profile_arn = 'arn:aws:iam::{}:instance-profile/{}'.format(account_id,
                                                                         g_env_map['environments'][target_env]['instance-profile'])
-    output = conn.run_instances(image_id=ami_id,
-                                key_name='jenkins.cloud',
-                                instance_type=instance_type,
-                                subnet_id=random.choice(g_env_map['environments'][target_env]['vpcsubnet'])['id'],
-                                block_device_map=bdm,
-                                security_group_ids=[g_env_map['environments'][target_env]['jenkins-sg']],
-                                instance_profile_arn=instance_profile_arn)
+    # Try the subnet our last launches came up the fastest in. If it has no room, try the next best:
+    subnet_ids = [subnet['id'] for subnet in g_env_map['environments'][target_env]['vpcsubnet']]
+    while True:
+        subnet_id = g_subnet_scorer.choose(subnet_ids, instance_type, reason='{} for {}'.format(labels_string, job_name))
+        say('Subnet decision: {}'.format(g_subnet_scorer.getLastDecision()), do_print=args.debug)
+        try:
+            output = ec2Call(target_env, 'run_instances',
+                             ImageId=ami_id,
+                             KeyName='jenkins.cloud',
+                             InstanceType=instance_type,
+                             SubnetId=subnet_id,
+                             BlockDeviceMappings=block_device_mappings,
+                             SecurityGroupIds=[g_env_map['environments'][target_env]['jenkins-sg']],
+                             IamInstanceProfile={'Arn': instance_profile_arn},
+                             MinCount=1, MaxCount=1)
+            break
+        except aws_client.ClientError as err:
+            g_subnet_scorer.recordLaunchError(subnet_id, instance_type, aws_client.getErrorCode(err))
+            subnet_ids.remove(subnet_id)
+            if aws_client.getErrorCode(err) not in g_capacity_error_codes or len(subnet_ids) == 0:
+                raise
+            say('No room for a {} in {} ({}). Trying another subnet.'.format(instance_type, subnet_id, aws_client.getErrorCode(err)))
     # Pull instance id out of the returned output
-    instance_id = output.instances[0].id
+    instance_id = output['Instances'][0]['InstanceId']
+    g_subnet_scorer.recordLaunch(subnet_id, instance_type, instance_id=instance_id)
     say('Instance is being created and tags are being added: {}'.format(instance_id))
 
-    # Sometimes the instance doesn't quite exist yet:
-    time.sleep(5)
-    output.instances[0].add_tag('Name', slave_name)
-    output.instances[0].add_tag('slave_data', data_json)
-    output.instances[0].add_tag('owner', owner_email)
-    output.instances[0].add_tag('environment', 'infra')
-    output.instances[0].add_tag('role', slave_name)
-    output.instances[0].add_tag('is_spot', 'false')
-    output.instances[0].add_tag('is_asg', 'false')
-    output.instances[0].add_tag('jumpcloud_tags', 'admin,superadmin')
-
+    tags = [('Name', slave_name),
+            ('slave_data', data_json),
+            ('owner', owner_email),
+            ('environment', 'infra'),
+            ('role', slave_name),
+            ('is_spot', 'false'),
+            ('is_asg', 'false'),
+            ('jumpcloud_tags', 'admin,superadmin')]
+    if tagInstance(target_env=target_env, instance_id=instance_id, tags=tags) is False:
+        say('***Error: Could not add tags to instance: {}'.format(instance_id))
+
+    instance = output['Instances'][0]
+    instance['Tags'] = [{'Key': k, 'Value': v} for k, v in tags]
+    getInventory(target_env).add(instance)
     say('adding0 {} to g_instance_count'.format(instance_id), do_print=args.debug)
     g_instance_count[str(target_env)].add(str(instance_id))
-    g_instance_stats['instances_created'] += 1
-    # Reset the env vars:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
-    # Write a file on disk to indicate we just started this instance:
-    label_list = [str(labels_string).strip()]
-    with open('{}__{}.start_instance'.format(target_env, instance_id), 'w') as fd:
-        fd.write('labels=' + ','.join(label_list) + '\n')
-        fd.write('instance_id={}\n'.format(instance_id))
+    addStat(g_instance_stats, 'instances_created')
+    # Remember we just started this instance:
+    rememberStartingInstance(target_env, instance_id, [str(labels_string).strip()])
 
 
 # Start a stopped intance:
-def startInstance(target_env=None, ip_preference=None, label_set=None, slave_name=None, jenkins_queue=None, job_name=None):
+def startInstance(target_env=None, ip_preference=None, label_set=None, slave_name=None, job_name=None):
     # Function returns: True|False (if we started an instance)
-    # Get the existing env vars:
-    account_id = g_env_map['environments'][target_env]['account-id']
-    os_environ_orig = dict(os.environ)
-    # We need to Assume the Role in the target env to set the tags there:
-    switchEnvironments(target_env=str(target_env), session_name='stop-an-instance', account_id=account_id)
-
     # Get a list of all non-terminated instances:
-    cmd = ('aws ec2 describe-instances --region {}'
-           ' --filters "Name=instance-state-name,Values=[stopped,stopping,pending,running]"').format(g_env_map['environments'][target_env]['region'])
-    output, returncode = run(cmd, retry_count=3)
-    j = json.loads(output)
+    inventory = getInventory(target_env)
+    instances = inventory.find(states=['stopped', 'stopping', 'pending', 'running'])
 
     stopped_instances = []
-    shared_pending_instances = []
-    soon_to_be_off_queue = []
-    # Read any "start_instance" files to see if we are recently starting one up
+    # See if we are recently starting one up
     # (tags on recently started instances do not exist...) (we call str because InstanceId is unicode)
-    all_instance_ids_in_env = map(str, [i['InstanceId'] for r in j['Reservations'] for i in r['Instances']])
+    all_instance_ids_in_env = set([str(i['InstanceId']) for i in instances])
     recently_started_instances = {}  # Key is intance_id, Value is list of labels.
-    for fname in glob.glob('{}__*.start_instance'.format(target_env)):
-        # Read the labels on this instance:
-        instance_id = None
-        starting_instance_labels = None
-        with open(fname, 'r') as fd:
-            for line in fd.readlines():
-                if line.startswith('labels='):
-                    starting_instance_labels = line[len('labels='):].strip().split(',')
-                if line.startswith('instance_id='):
-                    instance_id = line[len('instance_id='):].strip()
+    for instance_id, starting_instance_labels in g_state.getStartingInstances(target_env).items():
         if instance_id not in all_instance_ids_in_env:
-            # Delete the file on disk. It's an old file:
-            say('Instance ID: {} obtained from file: {} does not exist. Deleting file.'.format(instance_id, fname))
-            os.remove(fname)
+            # It's an old record:
+            say('Instance ID: {} that we recently started does not exist. Forgetting it.'.format(instance_id))
+            g_state.removeStartingInstance(instance_id)
         else:
             recently_started_instances[instance_id] = starting_instance_labels
 
     # Now lets go through all instances to see if can start a stopped one or wait for one
     # that is already starting.
-    for r in j['Reservations']:
-        for i in r['Instances']:
-            # Get the Name and slave_labels of the instance:
-            instance_label_set = set()
-            instance_id = str(i['InstanceId'])
-            tags = getTags(i)
-            instance_name = tags.get('Name')
-            is_asg = True if tags.get('is_asg') == 'true' else False
-            try:
-                j = json.loads(tags.get('slave_data'))
-                instance_label_set = set(map(str, j['slave_labels'].split(' ')))
-            except (ValueError, TypeError):
-                say('Could not parse slave_data json from instance {}. slave_data: {}'.format(instance_id,
-                                                                                              tags.get('slave_data')), do_print=args.debug)
-
-            # If this instance is in the list of recently created instances,
-            # and this instance has the tags, lets delete the file and remove it from the dict.
-            # (It is now detectable via its tags)
-            if str(instance_id) in recently_started_instances.keys():
-                if instance_name == slave_name:
-                    # We already have the name and instance_id, so if it has labels,
-                    # we don't care what they are as long it has them:
-                    if len(instance_label_set) != 0:
-                        fname = '{}__{}.start_instance'.format(target_env, instance_id)
-                        say('This recently created instance, {} is now detectable via tags. Deleting file: {}'.format(instance_id, fname))
-                        del recently_started_instances[instance_id]
-                        if os.path.exists(fname):
-                            os.remove(fname)
-
-            # Now update the global counter:
-            # Both recently_started_instances[k] and instance_label_set have value like this:
-            # eod-us-west-2_spot_c4.xlarge
-            for k in recently_started_instances.keys():
-                if not any(['spot' in l for l in recently_started_instances[k]]):
-                    g_instance_count[str(target_env)].add(k)
-                else:
-                    g_spot_instance_count[str(target_env)].add(k)
-            if instance_name == slave_name and is_asg is False:
-                if not any(['spot' in l for l in instance_label_set]):
-                    g_instance_count[str(target_env)].add(instance_id)
-                else:
-                    g_spot_instance_count[str(target_env)].add(instance_id)
-
-            # OK. Now lets examine this instance:
-            if i['State']['Name'] != 'stopping':
-                # Filter out instances that do not have the necessary labels:
-                # If the instance's slave_labels Tag contains the job tag, we can use this instance:
-                bIsLabelSubset = (instance_name == slave_name and label_set.issubset(instance_label_set))
-                bIsInstanceRecentlyStarted = instance_id in recently_started_instances.keys()
-                bIsLabelRecentlyStarted = False
-                if instance_id in recently_started_instances:
-                    bIsLabelRecentlyStarted = label_set.issubset(set(recently_started_instances[instance_id]))
-
-                if bIsLabelSubset is True or (bIsInstanceRecentlyStarted is True and bIsLabelRecentlyStarted is True):
-                    say('Found instance, {}, that has jobs labels.  Checking if pending. Current state: {}'.format(instance_id,
-                                                                                                                   i['State']['Name']))
-                    if instance_id in recently_started_instances.keys():
-                        say('This is a running instance just created. It may or may not be a slave yet.')
-                    if i['State']['Name'] == 'stopped':
-                        if instance_id in recently_started_instances.keys():
-                            say('***Error: Recently started instance is in stopped state: {}'.format(instance_id))
-                            g_error_stats['instance_stopped_state'] += 1
-                        stopped_instances.append(i)
-                    else:
-                        # This is a tricky scenario, but it happens often:
-                        # job1-needs-shared-dev gets put on the queue and this script starts or creates an instance.
-                        # instance is running but not connected to master yet.
-                        # job2-needs-shared-dev gets put on the queue.
-                        # We should not start or create an instance in this scenario.
-                        # BUT: if we have an instance that is running AND is a slave BUT is completely busy,
-                        # lets start|create a new one.
-                        # Final scenario: Sometimes a slave exists, has the executors, but for whatever reason the job
-                        # is still on the queue. The groovy script should not have put it in the json to begin with.
-                        if i['State']['Name'] == 'running' or i['State']['Name'] == 'pending':
-                            # Check to see if the label_set of the queue item is a special "shared" label:
-                            if any([label.endswith(special_tag) for label in list(label_set) for special_tag in g_label_map.keys()]):
-                                # If the shared instance is running AND is already a slave AND all the exectors are full,
-                                # then this is completely busy slave and is not "pending".
-                                if i['State']['Name'] == 'running':
-                                    # Check if this instance is registered slave:
-                                    say('Instance is running. PrivateIpAddress: {}. Scanning slaves...'.format(i['PrivateIpAddress']))
-                                    bIsSlave = False
-                                    for slave in jenkins_queue['slave_queue']:
-                                        slave_labels_list = map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(',')))
-                                        say('slave_labels_list: {}'.format(slave_labels_list))
-                                        if any(label.endswith(str(i['PrivateIpAddress'])) for label in slave_labels_list):
-                                            say('This instance is a slave! Slave ope_idle_count: {}'.format(slave['ope_idle_count']))
-                                            bIsSlave = True
-                                            if slave['ope_idle_count'] != '0' and slave['isOffLine'] == 'false':
-                                                s = ('WTF. Instance has free executors and is online! ',
-                                                     'This job should not have been on our list to begin with: {}').format(job_name)
-                                                say(s)
-                                                soon_to_be_off_queue.append(i)
-                                            break
-                                    if bIsSlave is False:
-                                        say('Wierd. Instance is running, but is not a slave.')
-                                else:
-                                    # Instance must be pending:
-                                    # This is pending/shared instance that is about to become a slave that this job will able to run on:
-                                    say('This is pending/shared instance that this job will be able to run on...')
-                                    shared_pending_instances.append(i)
-
-    if len(soon_to_be_off_queue) != 0:
-        # There is an edge case where a job is on the queue and there is a free executor for it.
-        # Lets not create an instance for this.  We should be trapping this in the groovy script,
-        # but I have not been able to reproduce this reliably.
-        say('***Error: This job should not even be on the queue: {}'.format(job_name))
-        g_error_stats['job_on_queue'] += 1
-        # Reset the env vars:
-        os.environ.clear()
-        os.environ.update(os_environ_orig)
-        # Return true so that we don't create a brand new instance:
-        return True
-
-    if len(shared_pending_instances) != 0:
-        say('There are pending/shared instances that this job will run on. No instances should be created or started.')
-        # Reset the env vars:
-        os.environ.clear()
-        os.environ.update(os_environ_orig)
-        # Return true so that we don't create a brand new instance:
-        return True
+    for i in instances:
+        # Get the Name and slave_labels of the instance:
+        instance_label_set = set()
+        instance_id = str(i['InstanceId'])
+        tags = getTags(i)
+        instance_name = tags.get('Name')
+        is_asg = True if tags.get('is_asg') == 'true' else False
+        if inventory.getLabels(instance_id) is not None:
+            instance_label_set = set(inventory.getLabels(instance_id))
+        else:
+            say('Could not parse slave_data json from instance {}. slave_data: {}'.format(instance_id,
+                                                                                          tags.get('slave_data')), do_print=args.debug)
+
+        # If this instance is in the list of recently created instances,
+        # and this instance has the tags, lets delete the file and remove it from the dict.
+        # (It is now detectable via its tags)
+        if str(instance_id) in recently_started_instances.keys():
+            if instance_name == slave_name:
+                # We already have the name and instance_id, so if it has labels,
+                # we don't care what they are as long it has them:
+                if len(instance_label_set) != 0:
+                    say('This recently created instance, {} is now detectable via tags.'.format(instance_id))
+                    del recently_started_instances[instance_id]
+                    g_state.removeStartingInstance(instance_id)
+
+        # Now update the global counter:
+        # Both recently_started_instances[k] and instance_label_set have value like this:
+        # eod-us-west-2_spot_c4.xlarge
+        for k in recently_started_instances.keys():
+            if not isSpotLabelSet(recently_started_instances[k]):
+                g_instance_count[str(target_env)].add(k)
+            else:
+                g_spot_instance_count[str(target_env)].add(k)
+        if instance_name == slave_name and is_asg is False:
+            if not isSpotLabelSet(instance_label_set):
+                g_instance_count[str(target_env)].add(instance_id)
+            else:
+                g_spot_instance_count[str(target_env)].add(instance_id)
+
+        # OK. Now lets examine this instance. Running and pending ones are already in the placement plan (see planEnv):
+        if i['State']['Name'] == 'stopped':
+            # Filter out instances that do not have the necessary labels:
+            # If the instance's slave_labels Tag contains the job tag, we can use this instance:
+            bIsLabelSubset = (instance_name == slave_name and label_set.issubset(instance_label_set))
+            bIsInstanceRecentlyStarted = instance_id in recently_started_instances.keys()
+            bIsLabelRecentlyStarted = False
+            if instance_id in recently_started_instances:
+                bIsLabelRecentlyStarted = label_set.issubset(set(recently_started_instances[instance_id]))
+
+            if bIsLabelSubset is True or (bIsInstanceRecentlyStarted is True and bIsLabelRecentlyStarted is True):
+                say('Found stopped instance, {}, that has jobs labels.'.format(instance_id))
+                if instance_id in recently_started_instances.keys():
+                    say('***Error: Recently started instance is in stopped state: {}'.format(instance_id))
+                    addStat(g_error_stats, 'instance_stopped_state')
+                stopped_instances.append(i)
 
     if len(stopped_instances) == 0:
         say('There are no stopped instances to start up.  If we did not hit a limit, we will have to create brand new instance.')
-        # Reset the env vars:
-        os.environ.clear()
-        os.environ.update(os_environ_orig)
         # Return false so that we attempt to create a brand new instance:
         return False
 
@@ -506,20 +688,22 @@ def startInstance(target_env=None, ip_preference=None, label_set=None, slave_nam
             instance = random.choice(stopped_instances)
 
     say('Starting this instance: {}'.format(instance['InstanceId']), banner='>')
-    cmd = ('aws ec2 start-instances --region {}'
-           ' --instance-ids {}').format(g_env_map['environments'][target_env]['region'], instance['InstanceId'])
-    output, returncode = run(cmd, retry_count=3)
-    say(output)
-    g_instance_stats['instances_started'] += 1
-
-    # Write a file on disk to indicate we just started this instance:
-    with open('{}__{}.start_instance'.format(target_env, instance_id), 'w') as fd:
-        fd.write('labels=' + ','.join(list(label_set)) + '\n')
-        fd.write('instance_id={}\n'.format(instance['InstanceId']))
-
-    # We started an instance. Reset the env vars:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
+    # So that the next queue item in this tick does not try to start it again:
+    inventory.setState(instance['InstanceId'], 'pending')
+
+    # The start is sent along with all the other starts of this tick. If it fails, forget we are working on this job:
+    def onStarted(instance_id, error):
+        if error is None:
+            addStat(g_instance_stats, 'instances_started')
+            return
+        inventory.setState(instance_id, 'stopped')
+        g_state.removeStartingInstance(instance_id)
+        g_state.removeWorking(job_name)
+    g_lifecycle.add(target_env, 'start', instance['InstanceId'], on_done=onStarted)
+
+    # Remember we just started this instance:
+    rememberStartingInstance(target_env, instance['InstanceId'], list(label_set))
+
     # Return true so that we don't create a brand new instance:
     return True
 
@@ -527,49 +711,185 @@ def startInstance(target_env=None, ip_preference=None, label_set=None, slave_nam
 # Get env from label:
 def getEnvStringFromLabelSet(labels_set=None):
     say('Getting env label from the set: {}'.format(labels_set))
-    # If the user specified labels: (dev, foo), get 'dev':
-    if len(labels_set & g_valid_labels) == 0:
+    # If the user specified labels: (dev, foo), get 'dev'. If they specified (ENV_shared), get 'ENV':
+    env_label = g_label_parser.getEnv(labels_set)
+    if env_label is None:
         say('These labels, {}, are not a valid label.'.format(labels_set))
-        return None
-    # If the user specified labels: (ENV_shared), get 'ENV':
-    env_label = labels_set & set(g_env_map['environments'].keys())
-    if len(env_label) == 0:
-        for item_label in list(labels_set):
-            for i in item_label.split('_'):
-                env_label = set([i]) & set(g_env_map['environments'].keys())
-                if len(env_label) == 1:
-                    return list(env_label)[0]
-    elif len(env_label) == 1:
-        return list(env_label)[0]
-    return None
-
-
-# Create or Start any needed slaves:
-def createOrStartSlaves(jenkins_queue, max_spot_slaves, max_slaves, slave_name, owner_email):
+    return env_label
+
+
+# Helper function to tell if a running instance that is not a slave yet may still be booting (now is epoch secs):
+def isBooting(instance, now=None):
+    now = time.time() if now is None else now
+    try:
+        launch_time = dateutil.parser.parse(str(instance['LaunchTime']))
+    except (KeyError, ValueError):
+        return False
+    return (datetime.datetime.fromtimestamp(now, launch_time.tzinfo) - launch_time).total_seconds() < args.boot_grace_secs
+
+
+# Build the placement plan of one env: the free executors of each label, on online slaves and on the instances
+# that are still booting, less what the queue items we already launched for (waiting_labels) will take:
+def planEnv(target_env, labels, waiting_labels, jenkins_queue, now=None):
+    planner = PlacementPlanner()
+    inventory = getInventory(target_env)
+    starting_instances = g_state.getStartingInstances(target_env)
+    slaves = [(list(map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(',')))), slave)
+              for slave in jenkins_queue['slave_queue']]
+    online_slave_ids = set()
+    for i in inventory.find(states=['pending', 'running']):
+        instance_id = str(i['InstanceId'])
+        # Tags of an instance we just created may not be visible yet:
+        instance_labels = set(starting_instances.get(instance_id, []))
+        if getTags(i).get('Name') == args.slave_name:
+            instance_labels |= set(inventory.getLabels(instance_id) or [])
+        instance_labels &= labels
+        if len(instance_labels) == 0:
+            continue
+        slave = None
+        if i['State']['Name'] == 'running' and 'PrivateIpAddress' in i:
+            for slave_labels_list, s in slaves:
+                if any(label.endswith(str(i['PrivateIpAddress'])) for label in slave_labels_list):
+                    slave = s
+                    break
+        for label in instance_labels:
+            if slave is not None:
+                if slave['isOffLine'] == 'false':
+                    planner.addInstance(label, instance_id, int(slave['ope_idle_count']))
+                    online_slave_ids.add(instance_id)
+            elif i['State']['Name'] == 'pending' or instance_id in starting_instances or isBooting(i, now=now):
+                planner.addInstance(label, instance_id, g_label_parser.parse(label).num_of_executors)
+    for label in labels:
+        planner.reserve(label, waiting_labels.get(label, 0))
+    return planner, online_slave_ids
+
+
+# Create or Start the slaves needed by the queue items of one env:
+def createOrStartSlavesInEnv(target_env, env_items, waiting_labels, jenkins_queue, max_spot_slaves, max_slaves, slave_name,
+                             owner_email, now=None):
+    planner, online_slave_ids = planEnv(target_env, set([str(item['labels']).strip() for item, _, _ in env_items]),
+                                        waiting_labels, jenkins_queue, now=now)
+    try:
+        createOrStartPlannedSlavesInEnv(target_env, env_items, planner, online_slave_ids, max_spot_slaves, max_slaves,
+                                        slave_name, owner_email)
+    finally:
+        with g_stats_lock:
+            g_placement_stats['bursts'] += 1
+            for key in ['items', 'placed', 'launches']:
+                g_placement_stats[key] += planner.stats[key]
+            g_placement_stats['launches_last_burst'] = planner.stats['launches']
+            g_placement_stats['launches_max_burst'] = max(g_placement_stats['launches_max_burst'], planner.stats['launches'])
+            g_placement_stats['launches_per_burst'] = round(g_placement_stats['launches'] / float(g_placement_stats['bursts']), 3)
+        say('Placement in {}: {} queue item(s), {} placed on free executors, {} launch(es).'.format(target_env,
+                                                                                                 planner.stats['items'],
+                                                                                                 planner.stats['placed'],
+                                                                                                 planner.stats['launches']))
+
+
+def createOrStartPlannedSlavesInEnv(target_env, env_items, planner, online_slave_ids, max_spot_slaves, max_slaves, slave_name,
+                                    owner_email):
+    for item, job_name, item_labels in env_items:
+        label = str(item['labels']).strip()
+        # Pack the item onto a free executor we already have, or will soon have:
+        instance_id = planner.place(label)
+        if instance_id is not None:
+            if instance_id in online_slave_ids:
+                # There is an edge case where a job is on the queue and there is a free executor for it.
+                # We should be trapping this in the groovy script, but I have not been able to reproduce this reliably.
+                say('***Error: This job should not even be on the queue: {}'.format(job_name))
+                addStat(g_error_stats, 'job_on_queue')
+            else:
+                say('Instance {} is still booting and has a free executor for: {}. Not launching another.'.format(instance_id,
+                                                                                                              job_name))
+            g_state.addWorking(job_name)
+            continue
+        # Check if an AWS Node exists that is stopped that can be turned on:
+        private_ip_address = None
+        if item['lastBuiltOn'] != 'UNKNOWN':
+            private_ip_address = item['lastBuiltOn'][len(target_env) + 1:]
+        bDidStartInstance = startInstance(target_env=target_env,
+                                          ip_preference=private_ip_address,
+                                          label_set=item_labels,
+                                          slave_name=slave_name,
+                                          job_name=job_name)
+        say('Total number of regular slaves in env: {} : {}/{}'.format(target_env,
+                                                                       len(g_instance_count[str(target_env)]),
+                                                                       max_slaves))
+        say('Regular Slaves: {}'.format(g_instance_count), do_print=args.debug)
+        say('Total number of spot slaves in env   : {} : {}/{}'.format(target_env,
+                                                                       len(g_spot_instance_count[str(target_env)]),
+                                                                       max_spot_slaves))
+        say('Spot Slaves: {}'.format(g_spot_instance_count), do_print=args.debug)
+        bDidCreateInstance = False
+        if bDidStartInstance is False:
+            current_slave_count = len(g_instance_count[str(target_env)])
+            max_allows_slaves = max_slaves
+            isSpot = isSpotLabelSet(item_labels)
+            if isSpot is True:
+                max_allows_slaves = max_spot_slaves
+                current_slave_count = len(g_spot_instance_count[str(target_env)])
+
+            # Create an instance:
+            if current_slave_count < max_allows_slaves:
+                if isSpot is True:
+                    bsuccess = createSpotInstance(target_env=target_env, job_name=job_name, labels_string=item['labels'],
+                                                  slave_name=slave_name, owner_email=owner_email)
+                    if bsuccess is False:
+                        return
+                else:
+                    createInstance(target_env=target_env, job_name=job_name, labels_string=item['labels'],
+                                   slave_name=slave_name, owner_email=owner_email)
+                bDidCreateInstance = True
+            else:
+                say('Sorry, we have reached the max number of slaves: {} in: {}'.format(max_slaves, item['labels']))
+                say('Attempting to terminate a randomly stopped instance...')
+                # Search for any stopped instances and kill them:
+                stopped_instances = [i['InstanceId'] for i in getInventory(target_env).find(name=slave_name,
+                                                                                             states=['stopped'])]
+                if len(stopped_instances) == 0:
+                    say('Sorry again, no stopped instances to termiante.')
+                    say('You will have to wait your turn, or increate number of allowable slaves in this env.')
+                else:
+                    terminate_instance(instance_id=random.choice(stopped_instances), target_env=target_env)
+
+        if bDidCreateInstance is True or bDidStartInstance is True:
+            # Remember this queue item has been handled:
+            g_state.addWorking(job_name)
+            # The next items with this label can use the rest of the executors of the new instance:
+            planner.addLaunch(label, 'launch_' + job_name, g_label_parser.parse(label).num_of_executors)
+
+
+# Create or Start any needed slaves (now is the epoch secs the instances are judged at, default time.time()):
+def createOrStartSlaves(jenkins_queue, max_spot_slaves, max_slaves, slave_name, owner_email, now=None):
     # [u'slave_queue', u'build_queue', u'messages']
-    # Look at the build_queue for anything we need to create:
+    # Look at the build_queue for anything we need to create. Key is env, value is a list of (item, job_name, labels):
+    items_by_env = {}
+    # Key is env, value is a dict of label -> number of queue items we already started/created an instance for:
+    waiting_labels_by_env = {}
+    queued_job_names = set()
     for item in jenkins_queue['build_queue']:
         # TODO: Handle ||.
-        try:
-            p = str(item['parameters'].encode('ascii', 'replace').strip().replace(' ', '_'))
-            hash_params = hashlib.md5(p).hexdigest()
-        except UnicodeEncodeError:
+        # The key is worked out once, when the item is added to g_queue_model:
+        job_name = item['job_key']
+        if job_name is None:
             say('Caught UnicodeEncodeError Exception in parameters to build.')
             print(item['parameters'])
             continue
-        job_name = str(item['jobName']).replace('/', '_CHILD_') + '___' + hash_params
-        if len(job_name) > (255 - len('.working') - len('working_on_')):
-            say('job_name too long: {}'.format(job_name))
-            job_name = job_name[:255 - len('.working') - len('working_on_')]
         # Only create/start a new instance if we are not already working on it:
         say('We may need to create a slave of type: {}. For this job: {}'.format(item['labels'], job_name))
         bWorkingOn = False
-        for fname in glob.glob('*.working'):
-            working_job_name = fname[len('working_on_'):-len('.working')]
-            if job_name == working_job_name:
-                say('We are already working on: {}'.format(job_name))
-                bWorkingOn = True
-                break
+        if g_state.isWorking(job_name):
+            say('We are already working on: {}'.format(job_name))
+            bWorkingOn = True
+            env_label = g_label_parser.getEnv([str(item['labels']).strip()])
+            if env_label is not None and job_name not in queued_job_names:
+                waiting_labels = waiting_labels_by_env.setdefault(env_label, {})
+                waiting_labels[str(item['labels']).strip()] = waiting_labels.get(str(item['labels']).strip(), 0) + 1
+        # The same job can be on the queue more than once:
+        if job_name in queued_job_names:
+            say('We are already working on: {}'.format(job_name))
+            bWorkingOn = True
+        queued_job_names.add(job_name)
         if bWorkingOn is False:
             # We only know how to create certain types of slaves: $ENV, $ENV_[shared||spot]
             item_labels = set([str(item['labels']).strip()])
@@ -578,192 +898,157 @@ def createOrStartSlaves(jenkins_queue, max_spot_slaves, max_slaves, slave_name,
             say('Env from this label set: {} is: {}'.format(item_labels, env_label))
             # Only handle valid/known ENV labels:
             if env_label is not None:
-                # Check if an AWS Node exists that is stopped that can be turned on:
-                target_env = env_label
-                private_ip_address = None
-                if item['lastBuiltOn'] != 'UNKNOWN':
-                    private_ip_address = item['lastBuiltOn'][len(target_env) + 1:]
-                bDidStartInstance = startInstance(target_env=target_env,
-                                                  ip_preference=private_ip_address,
-                                                  label_set=item_labels,
-                                                  slave_name=slave_name,
-                                                  jenkins_queue=jenkins_queue,
-                                                  job_name=job_name)
-                say('Total number of regular slaves in env: {} : {}/{}'.format(target_env,
-                                                                               len(g_instance_count[str(target_env)]),
-                                                                               max_slaves))
-                say('Regular Slaves: {}'.format(g_instance_count), do_print=args.debug)
-                say('Total number of spot slaves in env   : {} : {}/{}'.format(target_env,
-                                                                               len(g_spot_instance_count[str(target_env)]),
-                                                                               max_spot_slaves))
-                say('Spot Slaves: {}'.format(g_spot_instance_count), do_print=args.debug)
-                bDidCreateInstance = False
-                if bDidStartInstance is False:
-                    current_slave_count = len(g_instance_count[str(target_env)])
-                    max_allows_slaves = max_slaves
-                    isSpot = False
-                    if 'spot' in item['labels']:
-                        isSpot = True
-                        max_allows_slaves = max_spot_slaves
-                        current_slave_count = len(g_spot_instance_count[str(target_env)])
-
-                    # Create an instance:
-                    if current_slave_count < max_allows_slaves:
-                        # TODO: We need a better way of determining if spot is a label:
-                        if isSpot is True:
-                            bsuccess = createSpotInstance(target_env=target_env, job_name=job_name, labels_string=item['labels'],
-                                                          slave_name=slave_name, owner_email=owner_email)
-                            if bsuccess is False:
-                                return
-                        else:
-                            createInstance(target_env=target_env, job_name=job_name, labels_string=item['labels'],
-                                           slave_name=slave_name, owner_email=owner_email)
-                        bDidCreateInstance = True
-                    else:
-                        say('Sorry, we have reached the max number of slaves: {} in: {}'.format(max_slaves, item['labels']))
-                        say('Attempting to terminate a randomly stopped instance...')
-                        # Search for any stopped instances and kill them:
-                        cmd = ('aws ec2 describe-instances --region {}'
-                               ' --filters "Name=tag:Name,Values={}" '
-                               '"Name=instance-state-name,Values=[stopped]"').format(g_env_map['environments'][env]['region'], slave_name)
-                        output, returncode = run(cmd, retry_count=3)
-                        j = json.loads(output)
-                        stopped_instances = [i['InstanceId'] for r in j['Reservations'] for i in r['Instances']]
-                        if len(stopped_instances) == 0:
-                            say('Sorry again, no stopped instances to termiante.')
-                            say('You will have to wait your turn, or increate number of allowable slaves in this env.')
-                        else:
-                            terminate_instance(instance_id=random.choice(stopped_instances), region=g_env_map['environments'][env]['region'])
-
-                if bDidCreateInstance is True or bDidStartInstance is True:
-                    # Create a file to indicate this queue item has been handled:
-                    with open('working_on_{}.working'.format(job_name), 'w') as fd:
-                        fd.write('')
+                items_by_env.setdefault(env_label, []).append((item, job_name, item_labels))
             else:
                 say('I do not know how to create a slave for this job: {} with labels: {}'.format(item['jobName'], item['labels']))
 
-    # Remove any working_on_ files if job is off the queue or we waited too long:
-    for fname in glob.glob('*.working'):
-        working_job_name = fname[len('working_on_'):-1 * len('.working')]
-        bOffQueue = True
-        for item in jenkins_queue['build_queue']:
-            p = str(item['parameters'].encode('ascii', 'replace').strip().replace(' ', '_'))
-            hash_params = hashlib.md5(p).hexdigest()
-            job_name = str(item['jobName']).replace('/', '_CHILD_') + '___' + hash_params
-            if working_job_name == job_name:
-                bOffQueue = False
-                break
-        if bOffQueue is True:
+    # Each env has its own account, instances and limits, so they can be worked on at the same time:
+    forEachEnv(lambda env: createOrStartSlavesInEnv(env, items_by_env[env], waiting_labels_by_env.get(env, {}),
+                                                    jenkins_queue=jenkins_queue,
+                                                    max_spot_slaves=max_spot_slaves, max_slaves=max_slaves,
+                                                    slave_name=slave_name, owner_email=owner_email, now=now),
+               items_by_env.keys())
+
+    # Forget the jobs that are off the queue, or that we waited too long for:
+    for working_job_name, created_at in g_state.getWorking().items():
+        if working_job_name not in queued_job_names:
             say('The following job is off the queue: ' + working_job_name)
-            say('Deleting the working on file: ' + fname)
-            os.remove(fname)
+            g_state.removeWorking(working_job_name)
+            g_metrics.observe('slave_manager_time_to_slave_seconds', time.time() - created_at)
         else:
             seconds = 60 * 5
-            seconds_working = time.time() - os.path.getctime(fname)
-            say('We have been working on {}, for the following seconds: {}/{}'.format(fname, round(seconds_working), seconds))
-            # Delete any working on files that have been around too long:
-
+            seconds_working = time.time() - created_at
+            say('We have been working on {}, for the following seconds: {}/{}'.format(working_job_name, round(seconds_working), seconds))
             if seconds_working > seconds:
-                say('We have been working on this file for too long (over ' + str(seconds) + ' seconds). Deleting this file and trying again: ' + str(fname))
-                g_error_stats['jobs_waited_too_long'] += 1
-                os.remove(fname)
+                say('We have been working on this job for too long (over ' + str(seconds) + ' seconds). Trying again: ' + str(working_job_name))
+                addStat(g_error_stats, 'jobs_waited_too_long')
+                g_state.removeWorking(working_job_name)
 
 
 # Stop an instance:
-def stopInstance(instance_id, target_env=None):
+def stopInstance(instance_id, target_env=None, on_done=None):
     say('Stopping Instance in ENV: ' + str(target_env), banner='<')
-    # Get the existing env vars:
-    account_id = g_env_map['environments'][target_env]['account-id']
-    os_environ_orig = dict(os.environ)
-    # We need to Assume the Role in the target env to set the tags there:
-    switchEnvironments(target_env=str(target_env), session_name='stop-an-instance', account_id=account_id)
-
     # Rather than stopping this instance, lets see if we can just terminate it right now:
     bDidTerminateInstance = terminateOldAmiInstance(instance_id=instance_id, environment=target_env)
 
     if bDidTerminateInstance is False:
         # Only stop this instance if it is "running":
-        cmd = 'aws ec2 describe-instances --region {} --instance-ids {}'.format(g_env_map['environments'][target_env]['region'], instance_id)
-        output, returncode = run(cmd, hide_command=True, retry_count=3)
-        instance_state = json.loads(output)['Reservations'][0]['Instances'][0]['State']['Name']
+        instance_state = getInstance(target_env, instance_id)['State']['Name']
         if instance_state == 'running':
-            cmd = 'aws ec2 stop-instances --region {} --instance-ids {}'.format(g_env_map['environments'][target_env]['region'], instance_id)
-            output, returncode = run(cmd, hide_command=True, retry_count=3)
-            say(output)
-            g_instance_stats['instances_stopped'] += 1
+            getInventory(target_env).setState(instance_id, 'stopping')
+            if g_security_groups is not None:
+                g_security_groups.removeSlave(target_env, instance_id)
+
+            def onStopped(instance_id, error):
+                if error is None:
+                    addStat(g_instance_stats, 'instances_stopped')
+                else:
+                    addStat(g_error_stats, 'error_stopping_instance')
+                if on_done is not None:
+                    on_done(instance_id, error)
+            g_lifecycle.add(target_env, 'stop', instance_id, on_done=onStopped)
     else:
         say('Instance was not stopped; It was terminated because it was created from an old ami-id.')
 
-    # Reset the env vars:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
     say('<<<<-Done trying to stop instance.')
 
 
-# Set Termination Policy on an Instance:
+# Set Termination Policy on an Instance (make all its EBS volumes DeleteOnTermination).
+# Returns True if we know it is set. If we had to set it, it is checked later by verifyTerminationPolicies:
 def setTerminationPolicy(instance=None, region=None, environment=None):
+    instance_id = str(instance['InstanceId'])
     # Only set the termination policy if we have never done it before:
-    if str(instance['InstanceId']) not in g_termination_policy[environment]:
-        # Before terminating, make sure all block devices are set to DeleteOnTermination is true:
-        for block_device in instance['BlockDeviceMappings']:
-            if 'Ebs' in block_device.keys():
-                if block_device['Ebs']['DeleteOnTermination'] is False:
-                    # Flip the bit to true:
-                    device_name = block_device['DeviceName']
-                    say('InstanceId of instance to modify: {}'.format(instance['InstanceId']), do_print=args.debug)
-                    say('block_device: \n{}'.format(block_device), do_print=args.debug)
-                    say(device_name, do_print=args.debug)
-                    cmd_modify = ('aws ec2 modify-instance-attribute'
-                                  ' --region {}'
-                                  ' --instance-id {}'
-                                  ' --block-device-mappings '
-                                  '\'[{{"DeviceName": "{}","Ebs":{{"DeleteOnTermination":true}}}}]\'').format(region,
-                                                                                                              instance['InstanceId'],
-                                                                                                              device_name)
-                    output, returncode = run(cmd_modify, hide_command=True, retry_count=3)
-                    # Wait for it to stick:
-                    bHasStuck = False
-                    say('Waiting for termination policy to stick...')
-                    for i in range(30):
-                        cmd = ('aws ec2 describe-instance-attribute --instance-id {}'
-                               ' --attribute blockDeviceMapping --region {}').format(instance['InstanceId'], region)
-                        output, returncode = run(cmd, hide_command=True, retry_count=3)
-                        # We have to loop (again) to find the block device that we just set :(
-                        say('InstanceId of instance: {}'.format(instance['InstanceId']), do_print=args.debug)
-                        for bd in json.loads(output)['BlockDeviceMappings']:
-                            if bd['DeviceName'] == device_name:
-                                if bd['Ebs']['DeleteOnTermination'] is True:
-                                    bHasStuck = True
-                                    break
-                        if bHasStuck is True:
-                            say('DeleteOnTermination has stuck! Ready for instance termination!')
-                            break
-                        else:
-                            say('Block device DeleteOnTermination has not stuck yet. Sleeping for 2 seconds...')
-                            time.sleep(2)
-                    if bHasStuck is False:
-                        say('***Error: We set the launch perm, but it did not stick. Error!')
-                        sys.exit(1)
-        say('All block devices on instance, {}, are set to terminate on deletion.'.format(instance['InstanceId']), do_print=args.debug)
-        g_termination_policy[environment].append(str(instance['InstanceId']))
-
-
-# Terminate an instance by id:
-def terminate_instance(instance_id, region):
-    say('Terminating instance...', banner='%')
-    cmd_terminate = ('aws ec2 terminate-instances --region {}'
-                     ' --instance-ids {}').format(region, instance_id)
-    output, returncode = run(cmd_terminate, retry_count=3)
-    say(output)
-    g_instance_stats['instances_terminated'] += 1
+    if g_state.hasTerminationPolicy(instance_id):
+        return True
+    with g_termination_policy_lock:
+        if instance_id in g_termination_policy:
+            return False
+    device_names = [str(block_device['DeviceName']) for block_device in instance.get('BlockDeviceMappings', [])
+                    if 'Ebs' in block_device.keys() and block_device['Ebs']['DeleteOnTermination'] is False]
+    if len(device_names) == 0:
+        say('All block devices on instance, {}, are set to terminate on deletion.'.format(instance_id), do_print=args.debug)
+        addStat(g_termination_policy_stats, 'policy_already_set')
+        g_state.addTerminationPolicy(environment, instance_id)
+        return True
+    # Flip the bit to true, on all of them at once:
+    say('Setting DeleteOnTermination on {} of instance {}'.format(device_names, instance_id), do_print=args.debug)
+    modifyTerminationPolicy(environment, instance_id, device_names, attempts=1)
+    addStat(g_termination_policy_stats, 'policy_modified')
+    return False
+
+
+def modifyTerminationPolicy(environment, instance_id, device_names, attempts):
+    ec2Call(environment, 'modify_instance_attribute', InstanceId=instance_id,
+            BlockDeviceMappings=[{'DeviceName': device_name, 'Ebs': {'DeleteOnTermination': True}}
+                                 for device_name in device_names])
+    with g_termination_policy_lock:
+        g_termination_policy[instance_id] = (environment, device_names, time.time(), attempts)
+
+
+# Check that the termination policies we set have stuck (one describe-instances per env), off the queue path.
+# The ones that have not stuck after --termination_policy_verify_secs are set again:
+def verifyTerminationPolicies():
+    with g_termination_policy_lock:
+        pending = dict(g_termination_policy)
+    pending_by_env = {}
+    for instance_id, (env, device_names, modified_at, attempts) in pending.items():
+        pending_by_env.setdefault(env, {})[instance_id] = (device_names, modified_at, attempts)
+    forEachEnv(lambda env: verifyTerminationPoliciesInEnv(env, pending_by_env[env]), pending_by_env.keys())
+
+
+def verifyTerminationPoliciesInEnv(env, pending):
+    try:
+        j = ec2Call(env, 'describe_instances', InstanceIds=sorted(pending.keys()))
+        instances = dict([(str(i['InstanceId']), i) for r in j['Reservations'] for i in r['Instances']])
+    except aws_client.ClientError as err:
+        if aws_client.getErrorCode(err) != 'InvalidInstanceID.NotFound':
+            raise
+        # One of them is gone. Look at them one at a time:
+        instances = {}
+        for instance_id in pending.keys():
+            try:
+                instances[instance_id] = getInstance(env, instance_id)
+            except aws_client.ClientError:
+                pass
+    for instance_id, (device_names, modified_at, attempts) in pending.items():
+        instance = instances.get(instance_id)
+        if instance is None or instance['State']['Name'] in ['shutting-down', 'terminated']:
+            with g_termination_policy_lock:
+                g_termination_policy.pop(instance_id, None)
+            continue
+        not_stuck = [str(bd['DeviceName']) for bd in instance.get('BlockDeviceMappings', [])
+                     if str(bd['DeviceName']) in device_names and bd['Ebs']['DeleteOnTermination'] is not True]
+        if len(not_stuck) == 0:
+            say('DeleteOnTermination has stuck on instance {}! Ready for instance termination!'.format(instance_id))
+            addStat(g_termination_policy_stats, 'policy_verified')
+            g_state.addTerminationPolicy(env, instance_id)
+            with g_termination_policy_lock:
+                g_termination_policy.pop(instance_id, None)
+        elif time.time() - modified_at > args.termination_policy_verify_secs:
+            say('***Error: We set DeleteOnTermination on {} of instance {}, but it did not stick. '
+                'Setting it again (attempt {}).'.format(not_stuck, instance_id, attempts + 1))
+            addStat(g_termination_policy_stats, 'policy_errors' if attempts >= 3 else 'policy_retries')
+            modifyTerminationPolicy(env, instance_id, not_stuck, attempts=attempts + 1)
+
+
+# Terminate an instance by id (it is sent along with the other terminations of this tick):
+def terminate_instance(instance_id, target_env, on_done=None):
+    say('Terminating instance: {}'.format(instance_id), banner='%')
+    getInventory(target_env).setState(instance_id, 'shutting-down')
+    if g_security_groups is not None:
+        g_security_groups.removeSlave(target_env, instance_id)
+
+    def onTerminated(instance_id, error):
+        if error is None:
+            addStat(g_instance_stats, 'instances_terminated')
+        if on_done is not None:
+            on_done(instance_id, error)
+    g_lifecycle.add(target_env, 'terminate', instance_id, on_done=onTerminated)
 
 
 # Delete any old instances that does not match the ami that you want:
 def terminateOldAmiInstance(instance_id, environment):
     # Get the ami-id of this instance:
-    account_id = g_env_map['environments'][environment]['account-id']
-    os_environ_orig = dict(os.environ)
-    os_environ_orig = dict(os.environ)
     ami_id = g_env_map['environments'][environment]['ami_id']
     bDidTerminateInstance = False
 
@@ -774,19 +1059,8 @@ def terminateOldAmiInstance(instance_id, environment):
             say('ami_id is unknown.  not terminating this instance: {}'.format(instance_id))
             return bDidTerminateInstance
 
-        # Reset the env vars to an unsullied state:
-        os.environ.clear()
-        os.environ.update(g_os_environ_orig)
-
-        # We need to Assume the Role in the target env to set the tags there:
-        switchEnvironments(target_env=str(environment), session_name='terminate-an-instance', account_id=account_id)
-
         # Examine this instance:
-        cmd_describe = ('aws ec2 describe-instances --region {}'
-                        ' --instance-ids {}').format(g_env_map['environments'][environment]['region'], instance_id)
-        output, returncode = run(cmd_describe, retry_count=3)
-        j = json.loads(output)
-        instance = j['Reservations'][0]['Instances'][0]
+        instance = getInstance(environment, instance_id)
         instance_state = str(instance['State']['Name'])
 
         # Only terminate it if instance is not termated or terminating:
@@ -796,10 +1070,12 @@ def terminateOldAmiInstance(instance_id, environment):
                 say('ami that this instance is using: {}'.format(instance['ImageId']))
                 say('ami that we are supposed to be using: {}'.format(ami_id))
                 # Before terminating, make sure all block devices are set to DeleteOnTermination is true:
-                setTerminationPolicy(instance=instance, region=g_env_map['environments'][environment]['region'],
-                                     environment=environment)
+                if setTerminationPolicy(instance=instance, region=g_env_map['environments'][environment]['region'],
+                                        environment=environment) is False:
+                    say('Waiting for the termination policy of {} to stick before terminating it.'.format(instance_id))
+                    return bDidTerminateInstance
 
-                terminate_instance(instance_id=instance_id, region=g_env_map['environments'][environment]['region'])
+                terminate_instance(instance_id=instance_id, target_env=environment)
                 # Remove the instance from the count:
                 g_instance_count[str(environment)].discard(str(instance_id))
                 bDidTerminateInstance = True
@@ -808,18 +1084,18 @@ def terminateOldAmiInstance(instance_id, environment):
                 g_old_ami_check[environment].append(str(instance_id))
         else:
             say('This instance,{}, was not terminated because current state is: {}'.format(instance_id, instance_state))
-        # Reset the env vars:
-        os.environ.clear()
-        os.environ.update(os_environ_orig)
     return bDidTerminateInstance
 
 
 # Stop any idle Slaves:
-def stopSlaves(jenkins_queue):
+# Only the slaves in slave_names are looked at (all of them if it is None):
+def stopSlaves(jenkins_queue, slave_names=None):
     for slave in jenkins_queue['slave_queue']:
+        if slave_names is not None and str(slave['slaveName']) not in slave_names:
+            continue
         # Groovy is currently setting the nodes offline. Now tell AWS to Stop these instances:
         # strip any new spaces in labels, and convert unicode to ascii:
-        slave_labels_list = map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(',')))
+        slave_labels_list = list(map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(','))))
 
         if slave['isOffLine'] == 'true' and 'swarm' in slave_labels_list and slave['terminate_me'] == 'true':
             say('We need to stop this instance: {}'.format(slave))
@@ -833,124 +1109,43 @@ def stopSlaves(jenkins_queue):
                 say('***Error: Could not determine which env this slave is for. Not stopping instance.')
                 say('g_env_map keys: {}'.format(g_env_map['environments'].keys()))
                 say('slave labels  : {}'.format(slave_labels_list))
-                g_error_stats['error_stopping_instance'] += 1
+                addStat(g_error_stats, 'error_stopping_instance')
             else:
-                if any(['spot' in label for label in slave_labels_list]):
-                    terminate_instance(instance_id=instance_id, region=g_env_map['environments'][env]['region'])
+                # This slave may not change again, so if we could not stop it, look at it again next time:
+                def onDone(instance_id, error, slave_name=slave['slaveName']):
+                    if error is not None:
+                        g_queue_model.retrySlave(slave_name)
+                if isSpotLabelSet(slave_labels_list):
+                    terminate_instance(instance_id=instance_id, target_env=env, on_done=onDone)
                 else:
-                    stopInstance(instance_id, target_env=env)
-
-
-# Get a list of public IP addresses:
-def getAllProdSlaveIPAddress(slave_name=None):
-    os_environ_orig = dict(os.environ)
-    instance_ips = []
-    for env in g_env_map['environments'].keys():
-        if 'prod' in env:
-            account_id = g_env_map['environments'][env]['account-id']
-            # Assume the role in that environment and get the IP address:
-            switchEnvironments(target_env=str(env), session_name='get-ip-addresses', account_id=account_id)
-
-            # Get a list of stopped instances:
-            cmd = ('aws ec2 describe-instances --region {}'
-                   ' --filters "Name=tag:Name,Values={}" '
-                   '"Name=instance-state-name,Values=[running]"').format(g_env_map['environments'][env]['region'], slave_name)
-            output, returncode = run(cmd, retry_count=3)
-            j = json.loads(output)
-            for r in j['Reservations']:
-                for i in r['Instances']:
-                    # While we are here, lets print out the running instances:
-                    say('Running jslave: {}-{}'.format(env, i['PrivateIpAddress']))
-                    if 'PublicIpAddress' in i.keys():
-                        instance_ips.append(i['PublicIpAddress'])
-                    else:
-                        say('Warning: running jslave does not have a public ip address.')
-            # Reset the env vars in each loop:
-            os.environ.clear()
-            os.environ.update(os_environ_orig)
-    # Reset the env vars upon leaving the function:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
-    return instance_ips
-
-
-# Open up the SG for intances in prod and apse2:
-def updateSecurityGroups(security_group_to_tweak=None, required_ip_list=[], slave_name=None, jenkins_master_region=None):
-    prefix = '-' * 15
-    say(prefix + 'Checking to see if the proper Security Groups are set...')
-    prod_ip_addresses = getAllProdSlaveIPAddress(slave_name=slave_name)
-    # Now get your security group:
-    cmd = 'aws ec2 describe-security-groups --region {} --group-ids {}'.format(jenkins_master_region, security_group_to_tweak)
-    output, returncode = run(cmd, retry_count=3)
-    j = json.loads(output)
-    sg = j['SecurityGroups'][0]
-
-    # The required_ip_list is a list of PORT:IP/CID.  Lets massage the prod ip addresses by adding port and cid:
-    all_required_ip_list = required_ip_list + ['30001:' + ip + '/32' for ip in prod_ip_addresses]
-
-    # Now lets get a list of IP addresses from bitbucket:
-    say('Checking IP address of github.com to make sure it can talk to Jenkins...')
-    output, returncode = run('dig +short github.com', retry_count=3)
-    current_bitbucket_ip_list = list(set([x.strip()[:x.strip().rfind('.')] + '.0' for x in output.split('\n') if x != '']))
-    current_bitbucket_ip_list = ['443:' + ip + '/24' for ip in current_bitbucket_ip_list]
-
-    # Now we have the complete of IP addresses that we need:
-    all_required_ip_list = all_required_ip_list + current_bitbucket_ip_list
-
-    # OK. Now lets add the ones that are missing:
-    for required_ip in all_required_ip_list:
-        bAddIp = False
-        required_port = str(required_ip.split(':')[0])
-        required_cid = str(required_ip.split(':')[1])
-        for perm in sg['IpPermissions']:
-            if str(perm['ToPort']) == required_port:
-                for ipRange in perm['IpRanges']:
-                    if required_cid == str(ipRange['CidrIp']):
-                        bAddIp = True
-                        break
-                if bAddIp is True:
-                    break
+                    stopInstance(instance_id, target_env=env, on_done=onDone)
 
-        if bAddIp is False:
-            say('We need to add this: {}:{}'.format(required_port, required_cid))
-            jenkins_master_region
-            cmd = ('aws ec2 authorize-security-group-ingress --region {} '
-                   '--group-id {} --protocol tcp --port {} '
-                   '--cidr {}').format(jenkins_master_region,
-                                       security_group_to_tweak,
-                                       required_port, required_cid)
-            run(cmd, retry_count=3)
-    # Now that we added everything, lets remove everything that is not on the list:
-    for perm in sg['IpPermissions']:
-        for ipRange in perm['IpRanges']:
-            bRemoveIp = True
-            # Check to see if this range should be deleted:
-            for required_ip in all_required_ip_list:
-                required_port = str(required_ip.split(':')[0])
-                required_cid = str(required_ip.split(':')[1])
-                if str(perm['ToPort']) == required_port and str(ipRange['CidrIp']) == required_cid:
-                    bRemoveIp = False
-                    break
-            if bRemoveIp is True:
-                say('We need to remove this ingress rule: {}:{}'.format(perm['ToPort'], ipRange['CidrIp']))
-                cmd = ('aws ec2 revoke-security-group-ingress --region {}'
-                       ' --group-id {}'
-                       ' --protocol tcp --port {}'
-                       ' --cidr {}').format(jenkins_master_region, security_group_to_tweak,
-                                            perm['ToPort'], ipRange['CidrIp'])
-                run(cmd, retry_count=3)
-    say(prefix + 'Done checking security groups!')
+
+# Open up the SG of the master for the slaves in prod (and for github). Only what changed is sent:
+def updateSecurityGroups():
+    prefix = '-' * 15
+    say(prefix + 'Checking to see if the proper Security Groups are set...', do_print=args.debug)
+    # The public ips of the prod slaves are picked up when their env is loaded. Load the envs where we are waiting
+    # for a new slave to get one (all of them when we describe the security group again):
+    prod_envs = [env for env in g_env_map['environments'].keys() if isProdEnv(env)]
+    if g_security_groups.needsResync() is False:
+        prod_envs = [env for env in prod_envs if env in g_security_groups.getExpectedEnvs()]
+    forEachEnv(getInventory, prod_envs)
+    if g_security_groups.reconcile() is False:
+        say(prefix + 'No security group changes.', do_print=args.debug)
+    else:
+        say(prefix + 'Done updating security groups!')
 
 
 # For some reason we need to run the garbage collector periodically:
 def runGc():
     say('Running Jenkins GC...', do_print=args.debug)
-    cmd = ('java -jar jenkins-cli.jar -remoting -noCertificateCheck -i {} -s {}'
-           ' build util-slave-manager-garbage-collector -s -v').format(args.id_rsa, args.url)
-    output, returncode = run(cmd=cmd,
-                             hide_command=bHide_command,
-                             retry_count=3,
-                             raise_on_failure=True)
+    if g_jenkins.usesHttp() is True:
+        # No need to go through the garbage collector job. Just run its script in the script console:
+        output, stderr, returncode = g_jenkins.runGroovy(g_run_gc_groovy, name='gc', hide_command=bHide_command)
+    else:
+        output, returncode = g_jenkins.runCli('gc', 'build util-slave-manager-garbage-collector -s -v',
+                                              hide_command=bHide_command)
     if 'Garbage collector executed' in output:
         for el in output.split('\n'):
             if 'Garbage collector executed' in el:
@@ -962,10 +1157,13 @@ def runGc():
 # Write out a file with the stats:
 def writeStats(output_file=None, stats_dict=None):
     say('Writing {} with the stats of this run.'.format(output_file))
-    with open(output_file, 'wt') as fd:
+    # The stats may be updated by other threads while we write them (--daemon):
+    stats_dict = dict(stats_dict)
+    with open(output_file + '.tmp', 'wt') as fd:
         writer = csv.writer(fd)
         writer.writerow(sorted(stats_dict.keys()))
         writer.writerow([stats_dict[key] for key in sorted(stats_dict.keys())])
+    os.rename(output_file + '.tmp', output_file)
 
 
 # Run groovy script to get jenkins info:
@@ -973,110 +1171,125 @@ def getJenkinsQueues(bHide_command=True, current_counter=0, max_loop=0):
     jenkins_json = None
     say(' ')
     say('===== Running jar file to get jenkins queue and node info: {}/{}'.format(current_counter, max_loop))
-    all_amis = ' '.join([g_env_map['environments'][k]['ami_id'] for k in g_env_map['environments'].keys()])
-    cmd = ('java -jar jenkins-cli.jar -remoting -noCertificateCheck -i {} -s {}'
-           ' groovy {} {}').format(args.id_rsa, args.url, args.groovy, all_amis)
-    stdout, stderr, returncode = run(cmd=cmd,
-                                     hide_command=bHide_command,
-                                     separate_std_out_err=True,
-                                     retry_count=3)
-    # Jenkins sometimes puts a benign exception message, so lets ignore that:
+    all_amis = [g_env_map['environments'][k]['ami_id'] for k in g_env_map['environments'].keys()]
+    script_args = all_amis + ['--session={}'.format(args.slave_name), '--compact']
+    if args.verbose_queue is True:
+        script_args.append('--verbose')
+    # Have the idle-kill rules leave the warm pools alone:
+    for label, (pool_min, pool_max) in sorted(g_warm_pools.items()):
+        script_args.append('--pool={}:{}'.format(label, pool_min))
+    # Ask for just the changes since last time, except every so often, when we ask for everything:
+    if g_queue_model.revision is not None and args.full_queue_every > 1 and current_counter % args.full_queue_every != 0:
+        script_args.append('--since={}'.format(g_queue_model.revision))
+    start = time.time()
+    # Keep the last lines, so that we can show them if something goes wrong:
+    last_lines = collections.deque(maxlen=20)
+
+    def keepLines(lines):
+        for line in lines:
+            last_lines.append(line)
+            yield line
+
+    def getLines():
+        return g_jenkins.runGroovyLines(args.groovy, script_args=script_args, name='get_queue_jobs', hide_command=bHide_command)
     try:
-        ignore_warning = 'Skipping HTTPS certificate checks altogether. Note that this is not secure at all.'
-        if ignore_warning in stdout:
-            stdout = stdout.replace(ignore_warning, '')
-        jenkins_json = json.loads(stdout)
-    except:
-        say('***Error: Something went wrong. Here is the output from jenkins: \n{}\n{}'.format(stdout, stderr))
-        g_error_stats['jar_file_error'] += 1
+        if aws_client.g_trace is not None:
+            lines = aws_client.g_trace.lines('jenkins', ['get_queue_jobs'], script_args, getLines)
+        else:
+            lines = getLines()
+        jenkins_json, payload = parseCompactLines(keepLines(lines))
+    except Exception:
+        say('***Error: Something went wrong. Here is the end of the output from jenkins: \n{}\n{}'.format('\n'.join(last_lines),
+                                                                                                     traceback.format_exc()))
+        addStat(g_error_stats, 'jar_file_error')
+        return None
+    fetch_secs = time.time() - start
+    addStat(g_queue_payload_stats, 'fetches')
+    addStat(g_queue_payload_stats, 'bytes_total', payload['bytes'])
+    addStat(g_queue_payload_stats, 'fetch_secs_total', fetch_secs)
+    addStat(g_queue_payload_stats, 'parse_secs_total', payload['parse_secs'])
+    with g_stats_lock:
+        g_queue_payload_stats['bytes_last'] = payload['bytes']
+        g_queue_payload_stats['bytes_max'] = max(g_queue_payload_stats['bytes_max'], payload['bytes'])
+        g_queue_payload_stats['parse_secs_last'] = round(payload['parse_secs'], 4)
+    say('Queue payload: {} bytes in {} lines. Fetched in {:.3f}s, of which {:.3f}s parsing.'.format(payload['bytes'], payload['lines'],
+                                                                                                   fetch_secs, payload['parse_secs']))
+    for message in jenkins_json['messages']:
+        say(message)
     return jenkins_json
 
 
-# Helper function to return a dict of instance's keys:
-def getTags(instance):
-    tags = {}
-    if 'Tags' in instance.keys():
-        for tag in instance['Tags']:
-            tags[tag['Key']] = tag['Value']
-    return tags
+# Set termination policy on the existing instances of one env. Returns the number of instances per label:
+def setTerminationPolicyInEnv(env, slave_name=None, jenkins_queue=None):
+    instance_details = {}
+    # Get a list of all instances:
+    inventory = getInventory(env)
+
+    all_instance_ids_in_env = set()
+    for i in inventory.find():
+        if i['State']['Name'] not in ['shutting-down', 'terminated']:
+            all_instance_ids_in_env.add(str(i['InstanceId']))
+        else:
+            # remove it from global counters (doesn't matter what counter it is in):
+            g_instance_count[env].discard(str(i['InstanceId']))
+            g_spot_instance_count[env].discard(str(i['InstanceId']))
+
+        # Only set termination policy on slaves:
+        bIsSlave = False
+        instance_label_set = inventory.getLabels(i['InstanceId'])
+        tags = getTags(i)
+        if tags.get('Name') == str(slave_name):
+            bIsSlave = True
+        if instance_label_set is None and tags.get('slave_data') is not None:
+            say('Error parsing slave_data tag: {}'.format(tags.get('slave_data')), do_print=args.debug)
+
+        if bIsSlave is True:
+            # If this is a running jslave and it has been running for 1 hour and is NOT a slave, log an error:
+            if jenkins_queue is not None:
+                # When the slave manager first runs, we don't have the jenkins_queue, so skip this code.
+                if i['State']['Name'] == 'running':
+                    launch_time = dateutil.parser.parse(i['LaunchTime'])
+                    current_time = datetime.datetime.now(launch_time.tzinfo)
+                    (d, h, m, s) = timeDiff(launch_time, current_time)
+                    if d > 0 or (d == 0 and h >= 1):
+                        # Long running instance. Check if it is a registered slave:
+                        for slave in jenkins_queue['slave_queue']:
+                            slave_labels_list = map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(',')))
+                            if any(label.endswith(str(i['PrivateIpAddress'])) for label in slave_labels_list) is False:
+                                say(('***Error: This instance, {}, in {} is NOT a '
+                                     'jenkins slave and '
+                                     'it has been running for too long: {}').format(i['PrivateIpAddress'],
+                                                                                    env,
+                                                                                    str((d, h, m, s))))
+                                addStat(g_error_stats, 'instance_not_slave')
+                                break
+            if i['State']['Name'] in ['stopped', 'stopping', 'pending', 'running']:
+                setTerminationPolicy(instance=i, region=g_env_map['environments'][env]['region'], environment=env)
+                env_key = env + '_None' if instance_label_set is None else '_'.join(list(instance_label_set))
+                if env_key in instance_details.keys():
+                    instance_details[env_key] = instance_details[env_key] + 1
+                else:
+                    instance_details[env_key] = 1
+            if i['State']['Name'] == 'stopped':
+                # If the instance is stopped, lets see if we should just kill it now:
+                terminateOldAmiInstance(instance_id=i['InstanceId'], environment=env)
+    # Forget the instances that are gone:
+    addStat(g_termination_policy_stats, 'policy_pruned', g_state.pruneTerminationPolicy(env, all_instance_ids_in_env))
+    return instance_details
 
 
 # Set termination policy on existing instances:
 def setTerminationPolicyOnAllExistingInstances(slave_name=None, jenkins_queue=None):
     say('Setting Termination policy on all instances in all environments whose name tag is: {}'.format(slave_name))
-    os_environ_orig = dict(os.environ)
     # Reset the contents of this global dict of instances:
     # Since we are cycling through all instances in all environments, let get a snapshot of all instances:
     global g_instance_details
-    g_instance_details = {}
-    for env in g_env_map['environments'].keys():
-        account_id = g_env_map['environments'][env]['account-id']
-        switchEnvironments(target_env=str(env), session_name='set-termination-policy', account_id=account_id)
-        # Get a list of all non-terminated instances:
-        cmd = 'aws ec2 describe-instances --region ' + g_env_map['environments'][env]['region']
-        output, returncode = run(cmd, retry_count=3)
-        j = json.loads(output)
-
-        all_instance_ids_in_env = set()
-        for r in j['Reservations']:
-            for i in r['Instances']:
-                if i['State']['Name'] not in ['shutting-down', 'terminated']:
-                    all_instance_ids_in_env.add(str(i['InstanceId']))
-                else:
-                    # remove it from global counters (doesn't matter what counter it is in):
-                    g_instance_count[env].discard(str(i['InstanceId']))
-                    g_spot_instance_count[env].discard(str(i['InstanceId']))
-
-                # Only set termination policy on slaves:
-                bIsSlave = False
-                instance_label_set = None
-                tags = getTags(i)
-                if tags.get('Name') == str(slave_name):
-                    bIsSlave = True
-                try:
-                    if tags.get('slave_data') is not None:
-                        j = json.loads(tags.get('slave_data'))
-                        instance_label_set = set(map(str, j['slave_labels'].split(' ')))
-                except:
-                    say('Error parsing slave_data tag: {}'.format(tags.get('slave_data')), do_print=args.debug)
-
-                if bIsSlave is True:
-                    # If this is a running jslave and it has been running for 1 hour and is NOT a slave, log an error:
-                    if jenkins_queue is not None:
-                        # When the slave manager first runs, we don't have the jenkins_queue, so skip this code.
-                        if i['State']['Name'] == 'running':
-                            launch_time = dateutil.parser.parse(i['LaunchTime'])
-                            current_time = datetime.datetime.now(launch_time.tzinfo)
-                            (d, h, m, s) = timeDiff(launch_time, current_time)
-                            if d > 0 or (d == 0 and h >= 1):
-                                # Long running instance. Check if it is a registered slave:
-                                for slave in jenkins_queue['slave_queue']:
-                                    slave_labels_list = map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(',')))
-                                    if any(label.endswith(str(i['PrivateIpAddress'])) for label in slave_labels_list) is False:
-                                        say(('***Error: This instance, {}, in {} is NOT a '
-                                             'jenkins slave and '
-                                             'it has been running for too long: {}').format(i['PrivateIpAddress'],
-                                                                                            env,
-                                                                                            str((d, h, m, s))))
-                                        g_error_stats['instance_not_slave'] += 1
-                                        break
-                    if i['State']['Name'] in ['stopped', 'stopping', 'pending', 'running']:
-                        setTerminationPolicy(instance=i, region=g_env_map['environments'][env]['region'], environment=env)
-                        env_key = env + '_None' if instance_label_set is None else '_'.join(list(instance_label_set))
-                        if env_key in g_instance_details.keys():
-                            g_instance_details[env_key] = g_instance_details[env_key] + 1
-                        else:
-                            g_instance_details[env_key] = 1
-                    if i['State']['Name'] == 'stopped':
-                        # If the instance is stopped, lets see if we should just kill it now:
-                        terminateOldAmiInstance(instance_id=i['InstanceId'], environment=env)
-
-        # Reset the env vars:
-        os.environ.clear()
-        os.environ.update(os_environ_orig)
-    # Reset the env vars:
-    os.environ.clear()
-    os.environ.update(os_environ_orig)
+    instance_details = {}
+    for env_instance_details in forEachEnv(lambda env: setTerminationPolicyInEnv(env, slave_name=slave_name,
+                                                                                   jenkins_queue=jenkins_queue),
+                                           g_env_map['environments'].keys()):
+        instance_details.update(env_instance_details)
+    g_instance_details = instance_details
     say('Done setting termination policy on all instances in all environments!')
 
 
@@ -1089,35 +1302,33 @@ def processSqsQueue(jenkis_url=None, aws_sqs_account_id=None, aws_sqs_region=Non
         say('SQS account id not specified. Not doing anything with processing SQS queue...')
         return
     # Connect to the queue depending on where your environment variables are held
-    conn = connect(boto.sqs.connect_to_region, aws_sqs_region)
-
-    q = conn.get_queue(queue_name=sqs_queue_name, owner_acct_id=aws_sqs_account_id)
-    # Receive a message:
-    if q is None:
+    sqs = aws_client.getClient('sqs', aws_sqs_region)
+    try:
+        queue_url = aws_client.call(sqs, 'get_queue_url', QueueName=sqs_queue_name,
+                                    QueueOwnerAWSAccountId=aws_sqs_account_id)['QueueUrl']
+    except aws_client.ClientError:
         say('Could not find SQS queue: {} in account: {}'.format(sqs_queue_name, aws_sqs_account_id))
         return
-    retrievedMessage = q.get_messages()
+    # Receive a message:
+    retrievedMessage = aws_client.call(sqs, 'receive_message', QueueUrl=queue_url).get('Messages', [])
     if len(retrievedMessage) == 0:
         say('No Messages Found in Queue')
     else:
-        message = json.loads(str(retrievedMessage[0].get_body()))
+        message = json.loads(str(retrievedMessage[0]['Body']))
         try:
             job_name = message['name']
-            job_parameters = ' '.join([str('-p ' + str(k) + '=' + str(v)) for k, v in message['parameters'].items()])
+            job_parameters = dict([(str(k), str(v)) for k, v in message['parameters'].items()])
             action = 'build' if 'action' not in message.keys() else str(message['action'])
             if any([not_allowed in action.lower() for not_allowed in ['delete', 'groovy', 'install', 'node']]):
                 raise Exception('Invalid action: {}'.format(action))
             say('Processing message from SQS queue.', banner='SSSS')
-            output, returncode = run('java -jar jenkins-cli.jar -remoting -noCertificateCheck -i {} '
-                                     '-s {} {} {} {}'
-                                     .format(args.id_rsa, jenkis_url, action, job_name, job_parameters),
-                                     hide_command=False, retry_count=3)
-            g_sqs_stats['sqs_handled'] += 1
+            say(g_jenkins.runCommand(action, job_name, job_parameters))
+            addStat(g_sqs_stats, 'sqs_handled')
         except Exception as err:
             say(traceback.format_exc())
-            g_sqs_stats['sqs_dropped'] += 1
+            addStat(g_sqs_stats, 'sqs_dropped')
         # No matter what delete the message
-        q.delete_message(retrievedMessage[0])
+        aws_client.call(sqs, 'delete_message', QueueUrl=queue_url, ReceiptHandle=retrievedMessage[0]['ReceiptHandle'])
 
 
 # Print out some interesting information:
@@ -1130,32 +1341,299 @@ def printStats(jenkins_queue=None):
                                                                             slave['labels']), do_print=args.debug)
 
 
-# Pre-run setup:
-def setup(args=None):
-    global g_env_map
+# One pass over the build queue and the slaves:
+def reconcileQueue():
+    global g_tick
+    global bHide_command
+    # New tick. The instance snapshots are re-loaded the first time they are used in this tick:
+    g_tick += 1
+    if aws_client.g_trace is not None:
+        aws_client.g_trace.markTick(g_tick)
+    # Get the list of items and nodes on the queue:
+    with g_metrics.timer('slave_manager_phase_seconds', phase='queue_fetch'):
+        jenkins_json = getJenkinsQueues(bHide_command=bHide_command, current_counter=g_tick, max_loop=args.loop_counter)
+    bHide_command = True
+    if jenkins_json is not None:
+        applyQueuePass(jenkins_json)
+    exportMetrics()
+
+
+# Act on one get_queue_jobs.groovy payload: update the queue model with it, create/start the slaves the queue
+# needs, stop the idle ones and send the lifecycle actions. now (epoch secs, default time.time()) is the clock the
+# instances are judged by (the simulator passes its own):
+def applyQueuePass(jenkins_json, now=None):
+    global g_jenkins_json
+    now = time.time() if now is None else now
+    with g_metrics.timer('slave_manager_phase_seconds', phase='queue_apply'):
+        changed_items, changed_slaves = g_queue_model.apply(jenkins_json)
+    say('Queue update: full={}, {} queue item(s) and {} slave(s) added/changed.'.format(jenkins_json.get('full', True),
+                                                                                    len(changed_items),
+                                                                                    len(changed_slaves)))
+    jenkins_json = g_queue_model.toJson()
+    g_jenkins_json = jenkins_json
+    # Keep the arrival history of each label, to forecast what is coming:
+    arrived_labels = [str(g_queue_model.build_queue[key]['labels']).strip() for key in g_queue_model.added_items]
+    g_forecaster.recordArrivals([label for label in arrived_labels if g_label_parser.parse(label) is not None], now=now)
+    updateQueueMetrics(jenkins_json)
+    try:
+        with g_metrics.timer('slave_manager_phase_seconds', phase='reconcile'):
+            createOrStartSlaves(jenkins_queue=jenkins_json, max_slaves=args.max_num_of_slaves_in_env,
+                                max_spot_slaves=args.max_num_of_spot_slaves_in_env,
+                                slave_name=args.slave_name, owner_email=args.owner_email, now=now)
+    finally:
+        try:
+            # Only slaves that changed can need stopping. The queue model has moved past them, so they are
+            # looked at even if creating/starting failed:
+            with g_metrics.timer('slave_manager_phase_seconds', phase='stop_slaves'):
+                stopSlaves(jenkins_queue=jenkins_json, slave_names=changed_slaves)
+        except Exception:
+            # Have the next delta bring them up again:
+            for slave_name in changed_slaves:
+                g_queue_model.retrySlave(slave_name)
+            raise
+        finally:
+            # Send all the starts/stops/terminations of this tick:
+            with g_metrics.timer('slave_manager_phase_seconds', phase='lifecycle_flush'):
+                g_lifecycle.flush()
+
+
+# One queue pass, profiled (--profile):
+def profileQueuePass():
+    # Named after when it ran, so a restart (where the ticks start from 0 again) does not overwrite older ones:
+    g_profiler.run(reconcileQueue, lambda: '{}_tick_{:06d}'.format(time.strftime('%Y%m%d-%H%M%S'), g_tick))
+
+
+# Queue items and connected slaves per label, as gauges:
+def updateQueueMetrics(jenkins_queue):
+    queue_items = collections.Counter([str(item['labels']).strip() for item in jenkins_queue['build_queue']])
+    g_metrics.setAll('slave_manager_queue_items', [({'label': label}, count) for label, count in queue_items.items()])
+    slaves = collections.Counter([label.strip() for slave in jenkins_queue['slave_queue']
+                                  for label in str(slave['labels']).strip('[').strip(']').split(',')])
+    g_metrics.setAll('slave_manager_slaves', [({'label': label}, count) for label, count in slaves.items()])
+
+
+# The stats dicts, by the GROUP of their properties_GROUP.csv file:
+def getStatsGroups():
+    groups = [('run', g_instance_stats), ('sqs', g_sqs_stats), ('error', g_error_stats),
+              ('instance_count', g_instance_details), ('jenkins_latency', g_jenkins.getLatencyStats()),
+              ('lifecycle', g_lifecycle.stats), ('sts', g_sts_stats), ('queue_model', g_queue_model.stats),
+              ('queue_payload', g_queue_payload_stats), ('forecast', g_forecaster.getStats()),
+              ('placement', g_placement_stats), ('spot', g_spot_stats), ('termination_policy', g_termination_policy_stats),
+              ('security_groups', g_security_groups.getStats()), ('subnet_scorer', g_subnet_scorer.getStats())]
+    if len(g_warm_pools) != 0:
+        groups.append(('warm_pool', g_warm_pool_stats))
+    groups.append(('rate_limiter', g_rate_limiter.getStats()))
+    if aws_client.g_trace is not None:
+        groups.append(('trace', aws_client.g_trace.getStats()))
+    return groups
+
+
+# Bring the stat gauges up to date, and write the metrics text file (once per tick):
+def exportMetrics():
+    for group, stats_dict in getStatsGroups():
+        g_metrics.setStats(group, stats_dict)
+    if args.metrics_file is not None:
+        g_metrics.writeTextFile(args.metrics_file)
+
+
+# Number of executors that are (or will soon be) free for a label: idle executors of online slaves
+# with the label, plus the executors of the instances with the label that are still starting:
+def countIdleExecutors(profile, jenkins_queue):
+    idle_executors = 0
+    for slave in jenkins_queue['slave_queue']:
+        slave_labels_list = list(map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(','))))
+        if slave['isOffLine'] == 'false' and profile.label in slave_labels_list:
+            idle_executors += int(slave['ope_idle_count'])
+    inventory = getInventory(profile.env)
+    starting_instances = g_state.getStartingInstances(profile.env)
+    for i in inventory.find(name=args.slave_name, states=['pending', 'running'], label_set=[profile.label]):
+        if i['State']['Name'] == 'pending' or str(i['InstanceId']) in starting_instances:
+            idle_executors += profile.num_of_executors
+    return idle_executors
+
+
+# Start up to 'count' stopped instances of a label (ie ahead of the queue items we expect for it).
+# on_started(instance_id) is called for each start we send. Returns the number started:
+def startStoppedInstances(profile, count, reason, on_started=None, on_failed=None):
+    inventory = getInventory(profile.env)
+    started = 0
+    for instance in inventory.find(name=args.slave_name, states=['stopped'], label_set=[profile.label])[:count]:
+        instance_id = str(instance['InstanceId'])
+        say('Starting instance {} for label {} ({})'.format(instance_id, profile.label, reason), banner='>')
+        inventory.setState(instance_id, 'pending')
+
+        def onStarted(instance_id, error):
+            if error is None:
+                addStat(g_instance_stats, 'instances_started')
+                return
+            inventory.setState(instance_id, 'stopped')
+            g_state.removeStartingInstance(instance_id)
+            if on_failed is not None:
+                on_failed(instance_id)
+        g_lifecycle.add(profile.env, 'start', instance_id, on_done=onStarted)
+        rememberStartingInstance(profile.env, instance_id, [profile.label])
+        if on_started is not None:
+            on_started(instance_id)
+        started += 1
+    return started
+
+
+# Start stopped instances of a label ahead of the queue items we expect for it. Returns the number started:
+def prewarmLabel(profile, count):
+    return startStoppedInstances(profile, count, 'pre-warm',
+                                 on_started=lambda instance_id: g_forecaster.recordPrewarm(profile.label, instance_id),
+                                 on_failed=g_forecaster.forgetPrewarm)
+
+
+# Start stopped instances for the labels that are forecast to get more queue items than they have free executors:
+def prewarmSlaves():
+    if g_jenkins_json is None:
+        return
+    for label, expected in sorted(g_forecaster.forecastAll(args.prewarm_horizon).items()):
+        profile = g_label_parser.parse(label)
+        # Spot instances are terminated rather than stopped, so there is nothing to start for them:
+        if profile is None or profile.is_spot or expected < args.prewarm_min_arrivals:
+            continue
+        missing_executors = expected - countIdleExecutors(profile, g_jenkins_json)
+        count = min(int(math.ceil(missing_executors / float(profile.num_of_executors))), args.prewarm_max_per_label)
+        say('Label {}: {:.1f} queue item(s) expected in the next {}s. Instances to pre-warm: {}'.format(label, expected,
+                                                                                                     args.prewarm_horizon,
+                                                                                                     max(count, 0)))
+        if profile.label in g_warm_pools:
+            # Do not pre-warm a warm pool past its max:
+            count = min(count, g_warm_pools[profile.label][1] - countWarmSlaves(profile, g_jenkins_json))
+        if count > 0:
+            prewarmLabel(profile, count)
+    g_lifecycle.flush()
+
+
+# Number of slaves of a label that can take a queue item right away, or soon: online slaves with the label
+# and a free executor, plus the instances with the label that are still starting:
+def countWarmSlaves(profile, jenkins_queue):
+    warm_slaves = 0
+    for slave in jenkins_queue['slave_queue']:
+        slave_labels_list = list(map(str.strip, map(str, slave['labels'].strip('[').strip(']').split(','))))
+        if slave['isOffLine'] == 'false' and profile.label in slave_labels_list and int(slave['ope_idle_count']) > 0:
+            warm_slaves += 1
+    inventory = getInventory(profile.env)
+    starting_instances = g_state.getStartingInstances(profile.env)
+    for i in inventory.find(name=args.slave_name, states=['pending', 'running'], label_set=[profile.label]):
+        if i['State']['Name'] == 'pending' or str(i['InstanceId']) in starting_instances:
+            warm_slaves += 1
+    return warm_slaves
+
+
+# Create a new slave for a warm pool, if the env has room for it. Returns True if we created one:
+def createWarmSlave(profile):
+    if profile.is_spot is True:
+        if len(g_spot_instance_count[profile.env]) >= args.max_num_of_spot_slaves_in_env:
+            return False
+        return createSpotInstance(target_env=profile.env, job_name='warm_pool_' + profile.label, labels_string=profile.label,
+                                  slave_name=args.slave_name, owner_email=args.owner_email) is True
+    if len(g_instance_count[profile.env]) >= args.max_num_of_slaves_in_env:
+        return False
+    if g_env_map['environments'][profile.env]['ami_id'] == 'UNKNOWN':
+        return False
+    createInstance(target_env=profile.env, job_name='warm_pool_' + profile.label, labels_string=profile.label,
+                   slave_name=args.slave_name, owner_email=args.owner_email)
+    return True
 
-    # Delete existing jenkins.jar files (it looks like jenkins-cli.jar.NUM):
-    for old_jenkins_cli in glob.glob('jenkins-cli.jar.*'):
-        os.remove(old_jenkins_cli)
 
-    # Download a fresh jenkins-cli.jar file:
-    url = args.url if args.url[-1] == '/' else args.url + '/'
-    run('wget --connect-timeout 15 --tries 3 --output-document jenkins-cli.jar '
-        '--no-check-certificate {}jnlpJars/jenkins-cli.jar'.format(url), hide_command=False, retry_count=3)
+# Keep at least the min (and at most the max) of idle, swarm ready slaves up for each warm pool label.
+# Stopped instances are started first, new ones are only created if there are not enough of them.
+# get_queue_jobs.groovy (--pool) makes sure the idle-kill rules never take a pool below its min:
+def refillWarmPools():
+    if g_jenkins_json is None:
+        return
+    addStat(g_warm_pool_stats, 'warm_pool_passes')
+    for label, (pool_min, pool_max) in sorted(g_warm_pools.items()):
+        profile = g_label_parser.parse(label)
+        warm_slaves = countWarmSlaves(profile, g_jenkins_json)
+        with g_stats_lock:
+            g_warm_pool_stats['warm_{}'.format(label)] = warm_slaves
+        count = pool_min - warm_slaves
+        if count <= 0:
+            continue
+        say('Warm pool {}: {} slave(s) ready or starting, min {}, max {}. Refilling {}.'.format(label, warm_slaves, pool_min,
+                                                                                           pool_max, count))
+        started = startStoppedInstances(profile, count, 'warm pool')
+        addStat(g_warm_pool_stats, 'warm_pool_started', started)
+        for i in range(count - started):
+            if createWarmSlave(profile) is False:
+                say('Warm pool {}: could not create a slave (env {} is at its max?).'.format(label, profile.env))
+                addStat(g_warm_pool_stats, 'warm_pool_at_max')
+                break
+            addStat(g_warm_pool_stats, 'warm_pool_created')
+    g_lifecycle.flush()
+
+
+# Print the stats and re-set termination policy on all instances:
+def setTerminationPolicyTask():
+    if g_jenkins_json is not None:
+        printStats(jenkins_queue=g_jenkins_json)
+    setTerminationPolicyOnAllExistingInstances(slave_name=args.slave_name)
+
 
-    if not os.path.exists('jenkins-cli.jar'):
-        say('***Error: Could not find jenkins-cli.jar. Exiting with error...')
-        sys.exit(1)
+# Pre-run setup:
+def setup(args=None):
+    global g_env_map
+    global g_jenkins
+    global g_env_pool
+    global g_state
+    global g_forecaster
+    global g_security_groups
+    global g_profiler
+
+    g_env_pool = ThreadPool(processes=args.max_env_workers)
+    g_rate_limiter.max_retries = args.api_retries
+    g_rate_limiter.max_backoff_secs = args.api_max_backoff_secs
+
+    # Record (or replay) every AWS response and queue payload. Set before anything talks to AWS:
+    if args.capture is not None:
+        aws_client.g_trace = TraceRecorder(args.capture)
+        say('Recording AWS responses and queue payloads to {}'.format(args.capture))
+    elif args.replay is not None:
+        aws_client.g_trace = TraceReplayer(args.replay)
+        say('Replaying AWS responses and queue payloads from {}. Nothing is sent to AWS or jenkins.'.format(args.replay))
+
+    if args.profile is True:
+        g_profiler = TickProfiler(args.profile_dir, keep=args.profile_keep, top=args.profile_top, every=args.profile_every)
+
+    if args.metrics_port is not None:
+        g_metrics.serve(args.metrics_port)
+        say('Serving metrics on http://127.0.0.1:{}/metrics'.format(args.metrics_port))
+
+    g_state = StateStore(args.state_file)
+    # Pick up where an older version of this script left off:
+    g_state.migrateMarkerFiles('.')
+    g_forecaster = ArrivalForecaster(cold_start_secs=args.prewarm_cold_start_secs, store=g_state)
+
+    # The master's own account, so no STS credentials:
+    g_security_groups = SecurityGroupReconciler(aws_client.getClient('ec2', args.jenkins_master_region),
+                                                g_env_map['jenkins-master']['jenkins-master-sg-id'],
+                                                required_ip_list=args.required_ip_list,
+                                                resync_secs=args.security_group_resync_secs, debug=args.debug)
+
+    g_jenkins = JenkinsClient(args.url, user=args.jenkins_user, api_token=args.jenkins_api_token,
+                              id_rsa=args.id_rsa, debug=args.debug)
+
+    # jenkins-cli.jar is only needed if we can not use http, or for SQS actions other than 'build':
+    if args.id_rsa is not None and args.replay is None:
+        # Delete existing jenkins.jar files (it looks like jenkins-cli.jar.NUM):
+        for old_jenkins_cli in glob.glob('jenkins-cli.jar.*'):
+            os.remove(old_jenkins_cli)
+
+        # Download a fresh jenkins-cli.jar file:
+        url = args.url if args.url[-1] == '/' else args.url + '/'
+        run('wget --connect-timeout 15 --tries 3 --output-document jenkins-cli.jar '
+            '--no-check-certificate {}jnlpJars/jenkins-cli.jar'.format(url), hide_command=False, retry_count=3)
+
+        if not os.path.exists('jenkins-cli.jar'):
+            say('***Error: Could not find jenkins-cli.jar. Exiting with error...')
+            sys.exit(1)
 
     # Save the STS crentials so that we don't have to call them each time we need to switch envs:
-    for env in g_env_map['environments'].keys():
-        account_id = g_env_map['environments'][env]['account-id']
-        AccessKeyId, SecretAccessKey, SessionToken = generateStsCredentials(target_env=str(env),
-                                                                            session_name='slave-manager-script',
-                                                                            account_id=account_id)
-        g_env_map['environments'][env]['AccessKeyId'] = AccessKeyId
-        g_env_map['environments'][env]['SecretAccessKey'] = SecretAccessKey
-        g_env_map['environments'][env]['SessionToken'] = SessionToken
+    refreshStsCredentials()
 
     # Set termination policy on all instances:
     setTerminationPolicyOnAllExistingInstances(slave_name=args.slave_name)
@@ -1166,79 +1644,205 @@ def parseArgs():
     default_groovy = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'get_queue_jobs.groovy')
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--url', help='URL to Jenkins master (http://jenkins.foo.com:8080).', required=True)
-    parser.add_argument('--id_rsa', help='Location of id_rsa file to talk with Jenkins Master.', required=True)
+    parser.add_argument('--id_rsa', help='Location of id_rsa file to talk with Jenkins Master via jenkins-cli.jar.', default=None)
+    parser.add_argument('--jenkins_user', help='Jenkins user to talk with Jenkins Master over http.', default=None)
+    parser.add_argument('--jenkins_api_token', help='API token of --jenkins_user. Defaults to env var JENKINS_API_TOKEN.',
+                        default=os.environ.get('JENKINS_API_TOKEN'))
     parser.add_argument('--groovy', help='Location of groovy file.', default=default_groovy)
     parser.add_argument('--ami_ids', help='Comma separated list of slave ENV:ami-id.', required=True)
     parser.add_argument('--max_num_of_slaves_in_env', help='The total number of slaves to create in env.', default=10, type=int)
     parser.add_argument('--max_num_of_spot_slaves_in_env', help='The total number of spot slaves to create in env.', default=50, type=int)
     parser.add_argument('--loop_counter', help='The number of times to run main loop.', default=300, type=int)
+    parser.add_argument('--daemon', help='Run until stopped (SIGTERM/SIGINT) instead of --loop_counter times or ~55 minutes. '
+                                         'STS credentials are refreshed in the background.', action='store_true')
+    parser.add_argument('--sts_refresh_interval', help='Seconds between checks of the STS credentials expiration.',
+                        default=60, type=float)
+    parser.add_argument('--sts_refresh_margin', help='Refresh STS credentials that expire within this many seconds.',
+                        default=600, type=float)
+    parser.add_argument('--stats_interval', help='In --daemon mode, seconds between writes of the stats csv files.',
+                        default=300, type=float)
+    parser.add_argument('--metrics_file', help='Prometheus text file with the metrics, written every queue pass '
+                                               '(ie for the node exporter textfile collector). "" to not write it.',
+                        default='slave_manager.prom')
+    parser.add_argument('--metrics_port', help='Serve the metrics on http://127.0.0.1:PORT/metrics.', default=None, type=int)
+    parser.add_argument('--profile', help='Profile the queue passes. Each profile has the top functions by cumulative time, '
+                                          'and the time spent in commands (by family), AWS calls and jenkins calls.',
+                        action='store_true')
+    parser.add_argument('--profile_dir', help='Where to write the --profile files.', default='profiles')
+    parser.add_argument('--profile_keep', help='Number of --profile files to keep.', default=100, type=int)
+    parser.add_argument('--profile_top', help='Number of functions in each --profile.', default=30, type=int)
+    parser.add_argument('--profile_every', help='Profile every this many queue passes.', default=20, type=int)
+    parser.add_argument('--capture', help='Record every AWS response and get_queue_jobs.groovy payload, with timestamps, '
+                                          'to this gzipped trace file (ie slave_manager.trace.gz).', default=None)
+    parser.add_argument('--replay', help='Feed a --capture trace back in, instead of calling AWS and jenkins. Runs the queue '
+                                         'passes until the queue payloads in it run out.', default=None)
+    parser.add_argument('--api_retries', help='Max retries of a throttled or failed AWS/jenkins call (with a jittered '
+                                              'exponential backoff from 50ms).', default=4, type=int)
+    parser.add_argument('--api_max_backoff_secs', help='Max total seconds one AWS/jenkins call backs off for.',
+                        default=10, type=float)
+    parser.add_argument('--queue_api_retries', help='Max retries of the calls that the queue pass waits on.', default=2, type=int)
+    parser.add_argument('--queue_interval', help='Seconds between the start of each pass over the build queue.', default=5, type=float)
+    parser.add_argument('--verbose_queue', help='Have get_queue_jobs.groovy send (and print) its diagnostic messages.',
+                        action='store_true')
+    parser.add_argument('--full_queue_every', help='Get the whole queue and node list every this many passes. In between, only '
+                                                   'what changed is returned. 1 always gets everything.', default=60, type=int)
+    parser.add_argument('--security_group_interval', help='Seconds between security group updates.', default=15, type=float)
+    parser.add_argument('--security_group_resync_secs', help='Seconds between re-reading the security group and all prod '
+                                                             'slaves from AWS (in between, only what changed is sent).',
+                        default=900, type=float)
+    parser.add_argument('--gc_interval', help='Seconds between runs of the Jenkins garbage collector.', default=30, type=float)
+    parser.add_argument('--termination_policy_interval', help='Seconds between setting termination policy on all instances.',
+                        default=75, type=float)
+    parser.add_argument('--termination_policy_verify_interval', help='Seconds between checks that the termination policies we '
+                                                                    'set have stuck.', default=10, type=float)
+    parser.add_argument('--termination_policy_verify_secs', help='Seconds to wait for a termination policy to stick before '
+                                                                'setting it again.', default=60, type=float)
+    parser.add_argument('--sqs_interval', help='Seconds between reads of the SQS queue.', default=75, type=float)
     parser.add_argument('--slave_name', help='The AWS Name tag of the slaves.', default='jslave-in-house')
+    parser.add_argument('--prewarm', help='Start stopped instances ahead of the queue items forecast for their label.',
+                        action='store_true')
+    parser.add_argument('--prewarm_interval', help='Seconds between pre-warm passes.', default=60, type=float)
+    parser.add_argument('--prewarm_horizon', help='Seconds ahead to forecast queue items for.', default=600, type=int)
+    parser.add_argument('--prewarm_min_arrivals', help='Only pre-warm labels forecast to get at least this many queue items.',
+                        default=1.0, type=float)
+    parser.add_argument('--prewarm_max_per_label', help='Max instances to pre-warm per label in one pass.', default=2, type=int)
+    parser.add_argument('--prewarm_cold_start_secs', help='Seconds a queue item waits for a stopped instance to start. '
+                                                          'Used to score how much wait pre-warming saved.', default=180, type=int)
+    parser.add_argument('--boot_grace_secs', help='Seconds a running instance has to connect as a slave. Until then, its executors '
+                                                  'count as free for the queue items of its label.', default=600, type=int)
+    parser.add_argument('--warm_pool', help='Space delimited LABEL:MIN:MAX. Keep at least MIN (and start at most MAX) idle, '
+                                            'swarm ready slaves of LABEL at all times.', default=[], nargs='+')
+    parser.add_argument('--warm_pool_interval', help='Seconds between warm pool refills.', default=30, type=float)
     parser.add_argument('--aws_sqs_account_id', help='The AWS Account ID of the SQS queue.', default=None)
     parser.add_argument('--aws_sqs_region', help='The AWS region where the SQS queue lives.', default=None)
     parser.add_argument('--jenkins_master_region', help='The AWS region where the Jenkins master lives.', default='us-west-2')
     parser.add_argument('--owner_email', help='The email address to add to the owner tag.', required=True)
     parser.add_argument('--max_spot_price', help='The maximum spot price to use.', default="0.2")
+    parser.add_argument('--spot_requests_per_slave', help='Number of spot requests (of equivalent instance types, in different '
+                                                          'subnets) to send for each spot slave. The first fulfilled wins.',
+                        default=3, type=int)
+    parser.add_argument('--spot_wait_secs', help='Seconds to wait for one of the spot requests of a slave to be fulfilled.',
+                        default=60, type=float)
+    parser.add_argument('--max_env_workers', help='The number of environments to work on at the same time.', default=4, type=int)
+    parser.add_argument('--state_file', help='The sqlite file to keep the jobs we are working on, and the instances we just started.',
+                        default='slave_manager_state.db')
     parser.add_argument('--debug', help='Add verbosity.', action='store_true')
     parser.add_argument('--required_ip_list',
                         help='List of space delimited PORT:IP/CID to ignore when examining security group',
                         default=[], nargs='+')
     args = parser.parse_args()
+    if args.metrics_file == '':
+        args.metrics_file = None
+    if args.capture is not None and args.replay is not None:
+        parser.error('--capture and --replay can not be used together.')
+    if args.id_rsa is None and (args.jenkins_user is None or args.jenkins_api_token is None):
+        parser.error('Either --id_rsa, or --jenkins_user and --jenkins_api_token are required.')
     # Slip the args into g_env_map:
     for amis in args.ami_ids.split(','):
         env, ami_id = amis.split(':')
         g_env_map['environments'][env]['ami_id'] = ami_id
+    for warm_pool in args.warm_pool:
+        try:
+            label, pool_min, pool_max = warm_pool.rsplit(':', 2)
+            pool_min, pool_max = int(pool_min), int(pool_max)
+        except ValueError:
+            parser.error('--warm_pool {} is not LABEL:MIN:MAX.'.format(warm_pool))
+        if g_label_parser.parse(label) is None:
+            parser.error('--warm_pool {}: {} is not a valid label.\n{}'.format(warm_pool, label, g_label_parser.describe()))
+        if pool_min < 0 or pool_max < pool_min:
+            parser.error('--warm_pool {}: MIN has to be between 0 and MAX.'.format(warm_pool))
+        g_warm_pools[label] = (pool_min, pool_max)
     return args
 
 
 if __name__ == '__main__':
-    # TODO: Convert to boto.
     # TODO: Print out time left before termination.
     # TODO: Handle 'thrashing' launching instances that do not connect, and re-creating.
 
     args = parseArgs()
     start_time = datetime.datetime.now()
     setup(args)
-    say('Valid Labels: \n{}'.format('\n'.join(sorted(list(g_valid_labels)))))
-    # Only print the java command once, to save clutter in console output
-    bHide_command = False
-    for i in range(args.loop_counter):
-        # Get the list of items and nodes on the queue:
-        jenkins_json = getJenkinsQueues(bHide_command=bHide_command, current_counter=i + 1, max_loop=args.loop_counter)
-        bHide_command = True
-        if jenkins_json is not None:
-            createOrStartSlaves(jenkins_queue=jenkins_json, max_slaves=args.max_num_of_slaves_in_env,
-                                max_spot_slaves=args.max_num_of_spot_slaves_in_env,
-                                slave_name=args.slave_name, owner_email=args.owner_email)
-            stopSlaves(jenkins_queue=jenkins_json)
-
-        # Every 15 seconds update your SG for prod instances:
-        if i % 3 == 0:
-            updateSecurityGroups(security_group_to_tweak=g_env_map['jenkins-master']['jenkins-master-sg-id'],
-                                 required_ip_list=args.required_ip_list,
-                                 slave_name=args.slave_name,
-                                 jenkins_master_region=args.jenkins_master_region)
-
-        # Every 30 seconds or so, run the garbage collector:
-        if i % 6 == 0:
-            runGc()
-
-        # Every few minutes or so, re-set termination policy and check SQS:
-        if i % 15 == 0:
-            if jenkins_json is not None:
-                printStats(jenkins_queue=jenkins_json)
-            setTerminationPolicyOnAllExistingInstances(slave_name=args.slave_name)
-            processSqsQueue(jenkis_url=args.url,
-                            aws_sqs_account_id=args.aws_sqs_account_id,
-                            aws_sqs_region=args.aws_sqs_region)
+    say('Valid Labels: \n{}'.format(g_label_parser.describe()))
+
+    # Every queue pass starts as soon as its deadline comes up. Tasks that start, stop or terminate instances, or
+    # change the instance counts, run in the foreground between passes. The rest run in the background:
+    scheduler = Scheduler(debug=args.debug, metrics=g_metrics)
+    scheduler.addTask('queue', profileQueuePass if args.profile is True else reconcileQueue, interval=args.queue_interval)
+    # Update your SG for prod instances:
+    scheduler.addTask('security_groups', updateSecurityGroups, interval=args.security_group_interval, jitter=1, background=True)
+    # For some reason we need to run the garbage collector periodically (it talks to jenkins, so not in a replay):
+    if args.replay is None:
+        scheduler.addTask('gc', runGc, interval=args.gc_interval, jitter=2, background=True)
+    # Start instances ahead of the queue items we expect. It runs between queue passes, so they do not pick the same instance:
+    if args.prewarm is True:
+        scheduler.addTask('prewarm', prewarmSlaves, interval=args.prewarm_interval, delay=args.prewarm_interval)
+    # Keep the warm pools topped up. Also between queue passes, for the same reason:
+    if len(g_warm_pools) != 0:
+        scheduler.addTask('warm_pool', refillWarmPools, interval=args.warm_pool_interval, delay=args.warm_pool_interval)
+    # Every few minutes or so, re-set termination policy. It terminates old AMI instances and rebuilds the instance
+    # counts, so it runs between queue passes too:
+    scheduler.addTask('termination_policy', setTerminationPolicyTask,
+                      interval=args.termination_policy_interval, jitter=5)
+    # The termination policies that were set are checked here, rather than waited on:
+    scheduler.addTask('termination_policy_verify', verifyTerminationPolicies,
+                      interval=args.termination_policy_verify_interval, background=True, delay=args.termination_policy_verify_interval)
+    # SQS messages start jenkins jobs, so not in a replay either:
+    if args.replay is None:
+        scheduler.addTask('sqs',
+                          lambda: processSqsQueue(jenkis_url=args.url,
+                                                  aws_sqs_account_id=args.aws_sqs_account_id,
+                                                  aws_sqs_region=args.aws_sqs_region),
+                          interval=args.sqs_interval, jitter=5, background=True)
+
+    # Write all the stats to csv files:
+    def writeAllStats():
+        for group, stats_dict in getStatsGroups():
+            writeStats(output_file='properties_{}.csv'.format(group), stats_dict=stats_dict)
+        writeStats(output_file='properties_scheduler.csv', stats_dict=scheduler.getStats())
+        # What the subnet scorer knows, and why it picked the subnets it did:
+        with open('subnet_scorer.json', 'wt') as fd:
+            json.dump(g_subnet_scorer.describe(), fd, indent=2, sort_keys=True)
+
+    # Assume the roles again before the STS credentials run out, so the queue never waits on it:
+    scheduler.addTask('sts_refresh', lambda: refreshStsCredentials(margin=args.sts_refresh_margin),
+                      interval=args.sts_refresh_interval, jitter=5, background=True, delay=args.sts_refresh_interval)
+
+    stop_requested = threading.Event()
+    if args.daemon is True:
+        scheduler.addTask('stats', writeAllStats, interval=args.stats_interval, background=True, delay=args.stats_interval)
+
+        def onSignal(signum, frame):
+            say('Got signal {}. Stopping loop now.'.format(signum))
+            stop_requested.set()
+        signal.signal(signal.SIGTERM, onSignal)
+        signal.signal(signal.SIGINT, onSignal)
+
+    def shouldStop():
+        if stop_requested.is_set():
+            return True
+        if aws_client.g_trace is not None and aws_client.g_trace.isExhausted():
+            say('Replayed all the queue payloads of {}. Stopping loop now.'.format(args.replay))
+            return True
+        if args.daemon is True:
+            return False
+        if g_tick >= args.loop_counter:
+            return True
         (d, h, m, s) = timeDiff(start_time, datetime.datetime.now())
         if m > 55:
             say('Reaching STS limition of 1 hour. Stopping loop now.')
-            break
-        time.sleep(5)
-
-    # Write all the stats to csv files:
-    writeStats(output_file='properties_run.csv', stats_dict=g_instance_stats)
-    writeStats(output_file='properties_sqs.csv', stats_dict=g_sqs_stats)
-    writeStats(output_file='properties_error.csv', stats_dict=g_error_stats)
-    writeStats(output_file='properties_instance_count.csv', stats_dict=g_instance_details)
+            return True
+        return False
+    scheduler.run(shouldStop)
+    # Let any background task finish:
+    still_running = scheduler.join(timeout=120)
+
+    writeAllStats()
+    if aws_client.g_trace is not None:
+        aws_client.g_trace.close()
+        say('Trace: {}'.format(aws_client.g_trace.getStats()))
+    if len(still_running) == 0:
+        g_state.close()
+    else:
+        # They may still write to the state store. Every write is already committed, so leave it open:
+        say('***Warning: Tasks still running after 120s: {}. Not closing the state store.'.format(', '.join(still_running)))
     say('all done!')
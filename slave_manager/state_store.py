@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Local state of the slave manager that has to survive a restart:
+# - working: the queue items (job keys) we already created/started a slave for, and since when.
+# - start_instance: instances we just created/started, and their labels (their tags may not be visible yet).
+# - arrival_history: the seasonal queue arrival profile of each label (see forecast.py).
+# - termination_policy: instances we know delete all their EBS volumes on termination, so we never look at them again.
+# It used to be one marker file per record (working_on_*.working, ENV__ID.start_instance) that was globbed
+# and re-read on every lookup. Now all records are held in dicts (O(1) lookups), and every change is written
+# through to an sqlite file in WAL mode, so a crash never leaves a half written record behind.
+import glob
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import say
+
+
+class StateStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Key is the job key, value is when we started working on it (epoch seconds):
+        self.working = {}
+        # Key is instance id, value is (env, list of labels, created_at):
+        self.start_instance = {}
+        # Key is instance id, value is env:
+        self.termination_policy = {}
+        self.db = self.connect()
+        self.load()
+
+    def connect(self):
+        try:
+            db = self.openDb()
+            row = db.execute('PRAGMA integrity_check').fetchone()
+            if row[0] == 'ok':
+                return db
+            say('***Error: State store {} is corrupt: {}'.format(self.path, row[0]))
+            db.close()
+        except sqlite3.DatabaseError as err:
+            say('***Error: Could not open state store {}: {}'.format(self.path, err))
+        # Everything in here can be worked out again from jenkins and ec2, so start from scratch:
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                shutil.move(self.path + suffix, self.path + suffix + '.corrupt')
+        return self.openDb()
+
+    def openDb(self):
+        # The env worker threads share this connection. self.lock serializes access to it:
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS working (job_key TEXT PRIMARY KEY, created_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS start_instance (instance_id TEXT PRIMARY KEY, env TEXT NOT NULL, '
+                   'labels TEXT NOT NULL, created_at REAL NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS arrival_history (label TEXT NOT NULL, slot INTEGER NOT NULL, '
+                   'value REAL NOT NULL, PRIMARY KEY (label, slot))')
+        db.execute('CREATE TABLE IF NOT EXISTS termination_policy (instance_id TEXT PRIMARY KEY, env TEXT NOT NULL, '
+                   'verified_at REAL NOT NULL)')
+        return db
+
+    def load(self):
+        with self.lock:
+            self.working = dict(self.db.execute('SELECT job_key, created_at FROM working').fetchall())
+            self.start_instance = dict([(str(instance_id), (str(env), labels.split(','), created_at)) for
+                                        instance_id, env, labels, created_at in
+                                        self.db.execute('SELECT instance_id, env, labels, created_at FROM start_instance')])
+            self.termination_policy = dict([(str(instance_id), str(env)) for instance_id, env in
+                                            self.db.execute('SELECT instance_id, env FROM termination_policy')])
+
+    # Import (and delete) the marker files that older versions of the slave manager left in 'directory':
+    def migrateMarkerFiles(self, directory='.'):
+        for fname in glob.glob(os.path.join(directory, 'working_on_*.working')):
+            job_key = os.path.basename(fname)[len('working_on_'):-len('.working')]
+            self.addWorking(job_key, created_at=os.path.getctime(fname))
+            os.remove(fname)
+        for fname in glob.glob(os.path.join(directory, '*__*.start_instance')):
+            target_env = os.path.basename(fname).split('__')[0]
+            instance_id = None
+            labels = []
+            with open(fname, 'r') as fd:
+                for line in fd.readlines():
+                    if line.startswith('labels='):
+                        labels = line[len('labels='):].strip().split(',')
+                    if line.startswith('instance_id='):
+                        instance_id = line[len('instance_id='):].strip()
+            if instance_id:
+                self.addStartingInstance(target_env, instance_id, labels, created_at=os.path.getctime(fname))
+            os.remove(fname)
+
+    def addWorking(self, job_key, created_at=None):
+        created_at = time.time() if created_at is None else created_at
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO working (job_key, created_at) VALUES (?, ?)', (job_key, created_at))
+            self.working[job_key] = created_at
+
+    def isWorking(self, job_key):
+        return job_key in self.working
+
+    def removeWorking(self, job_key):
+        with self.lock:
+            self.db.execute('DELETE FROM working WHERE job_key = ?', (job_key,))
+            self.working.pop(job_key, None)
+
+    # Returns a dict of job key -> when we started working on it:
+    def getWorking(self):
+        with self.lock:
+            return dict(self.working)
+
+    def addStartingInstance(self, target_env, instance_id, labels, created_at=None):
+        created_at = time.time() if created_at is None else created_at
+        labels = [str(label) for label in labels]
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO start_instance (instance_id, env, labels, created_at) VALUES (?, ?, ?, ?)',
+                            (str(instance_id), str(target_env), ','.join(labels), created_at))
+            self.start_instance[str(instance_id)] = (str(target_env), labels, created_at)
+
+    def removeStartingInstance(self, instance_id):
+        with self.lock:
+            self.db.execute('DELETE FROM start_instance WHERE instance_id = ?', (str(instance_id),))
+            self.start_instance.pop(str(instance_id), None)
+
+    # Returns a dict of instance id -> list of labels, of the instances we just created/started in an env:
+    def getStartingInstances(self, target_env):
+        with self.lock:
+            return dict([(instance_id, list(labels)) for instance_id, (env, labels, _) in self.start_instance.items()
+                         if env == str(target_env)])
+
+    # Returns a dict of (label, slot) -> arrivals:
+    def getArrivalHistory(self):
+        with self.lock:
+            return dict([((str(label), slot), value) for label, slot, value in
+                         self.db.execute('SELECT label, slot, value FROM arrival_history')])
+
+    def setArrivalHistory(self, label, slot, value):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO arrival_history (label, slot, value) VALUES (?, ?, ?)',
+                            (str(label), slot, value))
+
+    def hasTerminationPolicy(self, instance_id):
+        return str(instance_id) in self.termination_policy
+
+    def addTerminationPolicy(self, target_env, instance_id, verified_at=None):
+        verified_at = time.time() if verified_at is None else verified_at
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO termination_policy (instance_id, env, verified_at) VALUES (?, ?, ?)',
+                            (str(instance_id), str(target_env), verified_at))
+            self.termination_policy[str(instance_id)] = str(target_env)
+
+    # Forget the instances of an env that are gone (not in instance_ids):
+    def pruneTerminationPolicy(self, target_env, instance_ids):
+        instance_ids = set(map(str, instance_ids))
+        with self.lock:
+            gone = [instance_id for instance_id, env in self.termination_policy.items()
+                    if env == str(target_env) and instance_id not in instance_ids]
+            for instance_id in gone:
+                self.db.execute('DELETE FROM termination_policy WHERE instance_id = ?', (instance_id,))
+                del self.termination_policy[instance_id]
+        return len(gone)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# Pick the subnet (AZ) to launch an instance in, from what happened to the last launches there.
+# For each (subnet, instance type) we keep, decayed so that an AZ that was out of capacity an hour ago is
+# tried again:
+# - launches that worked, and launches that failed for lack of capacity (or that never came up),
+# - how long the launched instances took to be running,
+# - how many of the spot instances were taken back by AWS.
+# The score of a subnet is the expected seconds to a running instance there: the average time to running,
+# divided by the odds that the launch works, and made worse by the spot interruptions. The lowest wins.
+# Every decision is kept (the last few of them), so describe() shows why a subnet was picked.
+import collections
+import random
+import threading
+import time
+
+# Error codes (run-instances) and spot request status codes that mean the subnet/AZ has no room right now:
+g_capacity_error_codes = frozenset(['InsufficientInstanceCapacity', 'InsufficientCapacity', 'InsufficientHostCapacity',
+                                    'InsufficientFreeAddressesInSubnet', 'Unsupported',
+                                    'capacity-not-available', 'capacity-oversubscribed', 'az-group-constraint',
+                                    'constraint-not-fulfillable'])
+# The StateReason code of a spot instance that AWS took back:
+g_spot_interruption_code = 'Server.SpotInstanceTermination'
+
+
+class SubnetScorer(object):
+    def __init__(self, half_life_secs=1800, default_running_secs=60, pending_timeout_secs=1800, max_decisions=50):
+        self.half_life_secs = half_life_secs
+        # What we expect, until we have seen an instance come up:
+        self.default_running_secs = default_running_secs
+        self.pending_timeout_secs = pending_timeout_secs
+        self.lock = threading.Lock()
+        # Key is (subnet id, instance type). Value is a dict of the decayed counts, and when they were last decayed:
+        self.outcomes = {}
+        # Key is instance id. Value is (subnet id, instance type, when it was launched):
+        self.pending = {}
+        # Spot instances we already counted as taken back:
+        self.interrupted = collections.deque(maxlen=1000)
+        self.decisions = collections.deque(maxlen=max_decisions)
+        self.stats = {'decisions': 0, 'launches': 0, 'capacity_failures': 0, 'failures': 0, 'running': 0,
+                      'spot_interruptions': 0}
+
+    def getOutcome(self, subnet_id, instance_type, now):
+        outcome = self.outcomes.setdefault((str(subnet_id), str(instance_type)),
+                                           {'launched': 0.0, 'failed': 0.0, 'running': 0.0, 'running_secs': 0.0,
+                                            'interrupted': 0.0, 'updated': now})
+        decay = 0.5 ** (max(now - outcome['updated'], 0) / float(self.half_life_secs))
+        for key in ['launched', 'failed', 'running', 'running_secs', 'interrupted']:
+            outcome[key] *= decay
+        outcome['updated'] = now
+        return outcome
+
+    # Expected seconds to a running instance of this type in this subnet (lower is better):
+    def score(self, subnet_id, instance_type, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return self.getScore(self.getOutcome(subnet_id, instance_type, now))
+
+    def getScore(self, outcome):
+        # One launch that worked, and the default time to running, are assumed to start with:
+        p_success = (outcome['launched'] + 1.0) / (outcome['launched'] + outcome['failed'] + 1.0)
+        running_secs = (outcome['running_secs'] + self.default_running_secs) / (outcome['running'] + 1.0)
+        p_interrupted = outcome['interrupted'] / (outcome['launched'] + 1.0)
+        return running_secs / p_success * (1.0 + p_interrupted)
+
+    # The subnets, best first. Ties are broken at random, so that launches are spread while we know nothing:
+    def rank(self, subnet_ids, instance_type, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            scored = [(self.getScore(self.getOutcome(subnet_id, instance_type, now)), random.random(), str(subnet_id))
+                      for subnet_id in subnet_ids]
+        return [subnet_id for _, _, subnet_id in sorted(scored)]
+
+    # Pick the subnet to launch an instance of this type in. 'reason' is kept with the decision:
+    def choose(self, subnet_ids, instance_type, reason=None, now=None):
+        now = time.time() if now is None else now
+        ranked = self.rank(subnet_ids, instance_type, now=now)
+        with self.lock:
+            self.stats['decisions'] += 1
+            decision = {'time': round(now, 3), 'instance_type': str(instance_type), 'reason': reason, 'chosen': ranked[0],
+                        'scores': dict([(subnet_id, round(self.getScore(self.getOutcome(subnet_id, instance_type, now)), 1))
+                                        for subnet_id in ranked])}
+            self.decisions.append(decision)
+        return ranked[0]
+
+    # The last decision, for logging:
+    def getLastDecision(self):
+        with self.lock:
+            return dict(self.decisions[-1]) if len(self.decisions) != 0 else None
+
+    # An instance was launched (or a spot request was fulfilled) in this subnet:
+    def recordLaunch(self, subnet_id, instance_type, instance_id=None, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.getOutcome(subnet_id, instance_type, now)['launched'] += 1
+            self.stats['launches'] += 1
+            if instance_id is not None:
+                self.pending[str(instance_id)] = (str(subnet_id), str(instance_type), now)
+
+    # A launch in this subnet failed. error_code is the aws error code (or spot request status code):
+    def recordFailure(self, subnet_id, instance_type, error_code=None, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.getOutcome(subnet_id, instance_type, now)['failed'] += 1
+            if error_code in g_capacity_error_codes:
+                self.stats['capacity_failures'] += 1
+            else:
+                self.stats['failures'] += 1
+
+    # A run-instances/request-spot-instances call in this subnet failed with this aws error code. Only a lack of
+    # capacity (or addresses) says something about the subnet. Anything else (ie auth, a bad AMI, a malformed
+    # request) would fail in every subnet, so it is only counted:
+    def recordLaunchError(self, subnet_id, instance_type, error_code, now=None):
+        if error_code in g_capacity_error_codes:
+            self.recordFailure(subnet_id, instance_type, error_code=error_code, now=now)
+            return
+        with self.lock:
+            self.stats['failures'] += 1
+
+    # An instance we launched is running (or ready), 'secs' after it was launched:
+    def recordRunning(self, subnet_id, instance_type, secs, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            outcome = self.getOutcome(subnet_id, instance_type, now)
+            outcome['running'] += 1
+            outcome['running_secs'] += secs
+            self.stats['running'] += 1
+
+    # Look at the instances of an env (describe-instances json): the ones we launched that are now running,
+    # the ones that died before they got there, and the spot instances that AWS took back:
+    def observe(self, instances, now=None):
+        now = time.time() if now is None else now
+        for instance in instances:
+            instance_id = str(instance['InstanceId'])
+            state = instance['State']['Name']
+            with self.lock:
+                pending = self.pending.get(instance_id)
+            if pending is not None:
+                subnet_id, instance_type, launched = pending
+                if state == 'running':
+                    self.recordRunning(subnet_id, instance_type, now - launched, now=now)
+                elif state in ['shutting-down', 'terminated']:
+                    self.recordFailure(subnet_id, instance_type, now=now)
+                if state != 'pending':
+                    with self.lock:
+                        self.pending.pop(instance_id, None)
+            if (instance.get('StateReason', {}).get('Code') == g_spot_interruption_code and
+                    'SubnetId' in instance and instance_id not in self.interrupted):
+                with self.lock:
+                    self.interrupted.append(instance_id)
+                    self.getOutcome(instance['SubnetId'], instance['InstanceType'], now)['interrupted'] += 1
+                    self.stats['spot_interruptions'] += 1
+        # Instances that never showed up as running:
+        with self.lock:
+            expired = [(instance_id, p) for instance_id, p in self.pending.items() if now - p[2] > self.pending_timeout_secs]
+        for instance_id, (subnet_id, instance_type, launched) in expired:
+            with self.lock:
+                self.pending.pop(instance_id, None)
+            self.recordFailure(subnet_id, instance_type, now=now)
+
+    # Everything we know, and the last decisions, for a human to look at:
+    def describe(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            outcomes = []
+            for (subnet_id, instance_type) in sorted(self.outcomes.keys()):
+                outcome = self.getOutcome(subnet_id, instance_type, now)
+                outcomes.append(dict([(k, round(v, 2)) for k, v in outcome.items() if k != 'updated'],
+                                     subnet_id=subnet_id, instance_type=instance_type,
+                                     expected_secs_to_running=round(self.getScore(outcome), 1)))
+            return {'outcomes': outcomes, 'decisions': list(self.decisions), 'pending': len(self.pending),
+                    'stats': dict(self.stats)}
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+# The scorer of this process. Every launch path picks its subnet with it:
+g_subnet_scorer = SubnetScorer()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# common.py reads environment.json from the current directory when it is imported (and exits without it).
+# The tests run in a scratch directory with a small one, and import the modules of the repo root and slave_manager/.
+import json
+import os
+import sys
+import tempfile
+
+g_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(g_root, 'slave_manager'))
+sys.path.insert(0, g_root)
+
+g_env_map = {
+    'environments': {
+        'dev-us-west-2': {
+            'ami_id': 'ami-12345678',
+            'account-id': '111111111111',
+            'region': 'us-west-2',
+            'vpcid': 'vpc-12345678',
+            'jenkins-sg': 'sg-12345678',
+            'jenkins-master-sg': 'sg-abcdefgh',
+            'instance-profile': 'jenkins-cloud-ope',
+            'vpcsubnet': [{'id': 'subnet-a', 'az': 'us-west-2a'},
+                          {'id': 'subnet-b', 'az': 'us-west-2b'}],
+            'jenkins_url': 'https://jenkins.example.com/'}},
+    'jenkins-master': {'jenkins-master-sg-name': 'jenkins-master', 'jenkins-master-iam-role': 'jenkins-master'}
+}
+
+g_work_dir = tempfile.mkdtemp(prefix='slave_manager_tests_')
+with open(os.path.join(g_work_dir, 'environment.json'), 'w') as fd:
+    json.dump(g_env_map, fd)
+os.chdir(g_work_dir)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import pytest
+import requests
+
+import jenkins_client
+from jenkins_client import JenkinsClient
+from rate_limiter import RateLimiter
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = ''
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+
+# Hands out the responses (or raises the exceptions) of 'posts' in order, and a new crumb on every crumb request:
+class FakeSession(object):
+    def __init__(self, posts):
+        self.posts = list(posts)
+        self.post_headers = []
+        self.crumbs = 0
+
+    def get(self, url, timeout=None):
+        self.crumbs += 1
+        return FakeResponse(200, {'crumbRequestField': 'Jenkins-Crumb', 'crumb': 'crumb-{}'.format(self.crumbs)})
+
+    def post(self, url, data=None, params=None, headers=None, timeout=None, stream=False):
+        self.post_headers.append(headers)
+        response = self.posts.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+
+@pytest.fixture(autouse=True)
+def noBackoff(monkeypatch):
+    monkeypatch.setattr(jenkins_client, 'g_rate_limiter', RateLimiter(base_secs=0.0))
+
+
+def getClient(posts):
+    client = JenkinsClient('https://jenkins.example.com', user='user', api_token='token', retry_count=3)
+    client.session = FakeSession(posts)
+    return client
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def testThrottlesAndServerErrorsAreRetried(status_code):
+    client = getClient([status_code, 200])
+    assert client.post('scriptText', 'groovy').status_code == 200
+    assert client.session.posts == []
+
+
+def testConnectionErrorsAreRetried():
+    client = getClient([requests.exceptions.ConnectionError('reset'), 200])
+    assert client.post('scriptText', 'groovy').status_code == 200
+
+
+def testRetriesStopWhenTheBudgetIsSpent():
+    client = getClient([503] * 4 + [200])
+    with pytest.raises(Exception, match='Jenkins_Error'):
+        client.post('scriptText', 'groovy')
+    assert client.session.posts == [200]
+
+
+@pytest.mark.parametrize('status_code', [400, 404])
+def testOtherClientErrorsAreNotRetried(status_code):
+    client = getClient([status_code, 200])
+    with pytest.raises(Exception, match='Jenkins_Error'):
+        client.post('scriptText', 'groovy')
+    assert client.session.posts == [200]
+
+
+def testExpiredCrumbIsRenewedOnce():
+    client = getClient([403, 200])
+    assert client.post('scriptText', 'groovy').status_code == 200
+    assert client.session.post_headers == [{'Jenkins-Crumb': 'crumb-1'}, {'Jenkins-Crumb': 'crumb-2'}]
+
+    client = getClient([403, 403, 200])
+    with pytest.raises(Exception, match='Jenkins_Error'):
+        client.post('scriptText', 'groovy')
+    assert client.session.posts == [200]
+
+
+@pytest.mark.parametrize('failure', [503, requests.exceptions.ConnectionError('reset')])
+def testBuildIsNotRepeatedAfterAFailure(failure):
+    # The master may have queued the build before it failed:
+    client = getClient([failure, 201])
+    with pytest.raises(Exception, match='Jenkins_Error'):
+        client.build('folder/job', {'A': '1'})
+    assert client.session.posts == [201]
+
+
+def testThrottledBuildIsRetried():
+    # A 429 means the master did not run it:
+    client = getClient([429, 201])
+    assert client.build('job').startswith('Queued build of job')
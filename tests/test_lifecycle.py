@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import pytest
+from botocore.exceptions import ClientError
+
+import lifecycle
+from lifecycle import LifecycleBatch
+
+g_response_keys = dict(lifecycle.g_actions.values())
+
+
+# Stands in for ec2Call. Instances in 'bad' fail any call they are in, like IncorrectInstanceState does:
+class FakeEc2(object):
+    def __init__(self, bad=(), missing=()):
+        self.bad = set(bad)
+        self.missing = set(missing)
+        self.calls = []
+
+    def __call__(self, target_env, operation, InstanceIds=None):
+        self.calls.append((target_env, operation, list(InstanceIds)))
+        if self.bad & set(InstanceIds):
+            raise ClientError({'Error': {'Code': 'IncorrectInstanceState', 'Message': 'bad'}}, operation)
+        return {g_response_keys[operation]: [{'InstanceId': instance_id, 'PreviousState': {'Name': 'running'},
+                                              'CurrentState': {'Name': 'stopping'}}
+                                             for instance_id in InstanceIds if instance_id not in self.missing]}
+
+
+def testOneCallPerEnvAndAction():
+    ec2 = FakeEc2()
+    batch = LifecycleBatch(ec2)
+    done = []
+    for instance_id in ['i-2', 'i-1']:
+        batch.add('dev', 'stop', instance_id, on_done=lambda i, error: done.append((i, error)))
+    batch.add('dev', 'start', 'i-3', on_done=lambda i, error: done.append((i, error)))
+    batch.add('prod', 'stop', 'i-4', on_done=lambda i, error: done.append((i, error)))
+    assert batch.hasPending() is True
+    assert batch.flush() == 0
+    assert sorted(ec2.calls) == [('dev', 'start_instances', ['i-3']), ('dev', 'stop_instances', ['i-1', 'i-2']),
+                                 ('prod', 'stop_instances', ['i-4'])]
+    assert sorted(done) == [('i-1', None), ('i-2', None), ('i-3', None), ('i-4', None)]
+    assert batch.hasPending() is False
+    assert batch.stats == {'calls': 3, 'instances': 4, 'errors': 0}
+
+
+def testSameInstanceIsSentOnceAndEveryCallbackIsCalled():
+    ec2 = FakeEc2()
+    batch = LifecycleBatch(ec2)
+    done = []
+    batch.add('dev', 'terminate', 'i-1', on_done=lambda i, error: done.append('first'))
+    batch.add('dev', 'terminate', 'i-1', on_done=lambda i, error: done.append('second'))
+    batch.add('dev', 'terminate', 'i-1')
+    batch.flush()
+    assert ec2.calls == [('dev', 'terminate_instances', ['i-1'])]
+    assert done == ['first', 'second']
+
+
+def testFailedBatchIsRetriedOneAtATime():
+    ec2 = FakeEc2(bad=['i-2'])
+    batch = LifecycleBatch(ec2)
+    errors = {}
+    for instance_id in ['i-1', 'i-2', 'i-3']:
+        batch.add('dev', 'stop', instance_id, on_done=lambda i, error: errors.__setitem__(i, error))
+    assert batch.flush() == 1
+    assert ec2.calls[0] == ('dev', 'stop_instances', ['i-1', 'i-2', 'i-3'])
+    assert sorted(ec2.calls[1:]) == [('dev', 'stop_instances', ['i-1']), ('dev', 'stop_instances', ['i-2']),
+                                     ('dev', 'stop_instances', ['i-3'])]
+    assert errors['i-1'] is None and errors['i-3'] is None
+    assert isinstance(errors['i-2'], ClientError)
+    assert batch.stats['errors'] == 1
+
+
+def testInstanceMissingFromTheResponseFails():
+    batch = LifecycleBatch(FakeEc2(missing=['i-2']))
+    errors = {}
+    for instance_id in ['i-1', 'i-2']:
+        batch.add('dev', 'start', instance_id, on_done=lambda i, error: errors.__setitem__(i, error))
+    assert batch.flush() == 1
+    assert errors['i-1'] is None
+    assert errors['i-2'] is not None
+
+
+def testCallbackThatRaisesDoesNotStopTheOthers():
+    batch = LifecycleBatch(FakeEc2())
+    done = []
+
+    def broken(instance_id, error):
+        raise RuntimeError('callback failed')
+    batch.add('dev', 'stop', 'i-1', on_done=broken)
+    batch.add('dev', 'stop', 'i-1', on_done=lambda i, error: done.append(i))
+    batch.add('dev', 'stop', 'i-2', on_done=lambda i, error: done.append(i))
+    assert batch.flush() == 0
+    assert sorted(done) == ['i-1', 'i-2']
+
+
+def testLargeBatchesAreSplit(monkeypatch):
+    monkeypatch.setattr(lifecycle, 'g_max_batch_size', 2)
+    ec2 = FakeEc2()
+    batch = LifecycleBatch(ec2)
+    for instance_id in ['i-1', 'i-2', 'i-3', 'i-4', 'i-5']:
+        batch.add('dev', 'terminate', instance_id)
+    batch.flush()
+    assert [ids for _, _, ids in ec2.calls] == [['i-1', 'i-2'], ['i-3', 'i-4'], ['i-5']]
+
+
+def testUnknownAction():
+    with pytest.raises(ValueError):
+        LifecycleBatch(FakeEc2()).add('dev', 'reboot', 'i-1')
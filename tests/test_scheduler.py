@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import threading
+import time
+
+from scheduler import Scheduler, Task
+
+
+def testNextDeadlineIsFromThePreviousDeadline():
+    task = Task('queue', lambda: None, interval=10)
+    task.next_deadline = 100.0
+    # It ran late, and took a while. That does not push the next run back:
+    task.reschedule(now=104.0)
+    assert task.next_deadline == 110.0
+
+
+def testNoBurstOfRunsAfterFallingBehind():
+    task = Task('queue', lambda: None, interval=10)
+    task.next_deadline = 100.0
+    task.reschedule(now=135.0)
+    assert task.next_deadline == 135.0
+
+
+def testOnlyDueTasksRun():
+    runs = []
+    scheduler = Scheduler()
+    scheduler.addTask('due', lambda: runs.append('due'), interval=60)
+    scheduler.addTask('later', lambda: runs.append('later'), interval=60, delay=60)
+    scheduler.runPending()
+    assert runs == ['due']
+    stats = scheduler.getStats()
+    assert stats['due_runs'] == 1
+    assert stats['later_runs'] == 0
+
+
+def testLatenessAndErrorsAreCounted():
+    def fail():
+        raise RuntimeError('task failed')
+    scheduler = Scheduler()
+    task = scheduler.addTask('fail', fail, interval=60)
+    task.next_deadline = time.time() - 5
+    scheduler.runPending()
+    assert task.stats['errors'] == 1
+    assert task.stats['runs'] == 1
+    assert task.stats['lateness_last'] >= 5
+    # The next deadline is one interval after the one it ran for:
+    assert 50 <= task.next_deadline - time.time() <= 55
+
+
+def testRunStopsWhenAsked():
+    runs = []
+    scheduler = Scheduler()
+    scheduler.addTask('queue', lambda: runs.append(1), interval=0.01)
+    scheduler.run(lambda: len(runs) >= 3)
+    assert len(runs) == 3
+
+
+def testBackgroundTaskStillRunningIsSkipped():
+    release = threading.Event()
+    scheduler = Scheduler()
+    task = scheduler.addTask('slow', release.wait, interval=60, background=True)
+    scheduler.runPending()
+    task.next_deadline = time.time() - 1
+    scheduler.runPending()
+    assert task.stats['skipped'] == 1
+    # join() says which tasks did not finish in time:
+    assert scheduler.join(timeout=0.1) == ['slow']
+    release.set()
+    assert scheduler.join(timeout=5) == []
+    assert task.stats['runs'] == 1
+
+
+def testJoinTimeoutIsForAllTheTasks():
+    release = threading.Event()
+    scheduler = Scheduler()
+    for name in ['a', 'b', 'c']:
+        scheduler.addTask(name, release.wait, interval=60, background=True)
+    scheduler.runPending()
+    start = time.time()
+    assert sorted(scheduler.join(timeout=0.2)) == ['a', 'b', 'c']
+    assert time.time() - start < 0.5
+    release.set()
+    assert scheduler.join(timeout=5) == []
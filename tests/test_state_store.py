@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+
+from state_store import StateStore
+
+
+def testRecordsSurviveARestart(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    store = StateStore(path)
+    store.addWorking('job_a', created_at=10.0)
+    store.addWorking('job_b', created_at=20.0)
+    store.addStartingInstance('dev', 'i-1', ['dev', 'dev_spot'], created_at=30.0)
+    store.addStartingInstance('prod', 'i-2', ['prod'], created_at=40.0)
+    store.addTerminationPolicy('dev', 'i-3', verified_at=50.0)
+    store.setArrivalHistory('dev', 7, 1.5)
+    store.close()
+
+    store = StateStore(path)
+    assert store.getWorking() == {'job_a': 10.0, 'job_b': 20.0}
+    assert store.isWorking('job_a') is True
+    assert store.getStartingInstances('dev') == {'i-1': ['dev', 'dev_spot']}
+    assert store.getStartingInstances('prod') == {'i-2': ['prod']}
+    assert store.hasTerminationPolicy('i-3') is True
+    assert store.getArrivalHistory() == {('dev', 7): 1.5}
+    store.close()
+
+
+def testRemovalsSurviveARestart(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    store = StateStore(path)
+    store.addWorking('job_a')
+    store.addStartingInstance('dev', 'i-1', ['dev'])
+    store.addTerminationPolicy('dev', 'i-2')
+    store.addTerminationPolicy('dev', 'i-3')
+    store.removeWorking('job_a')
+    store.removeStartingInstance('i-1')
+    assert store.pruneTerminationPolicy('dev', ['i-3']) == 1
+    store.close()
+
+    store = StateStore(path)
+    assert store.getWorking() == {}
+    assert store.getStartingInstances('dev') == {}
+    assert store.hasTerminationPolicy('i-2') is False
+    assert store.hasTerminationPolicy('i-3') is True
+    store.close()
+
+
+def testCorruptStoreStartsOver(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    with open(path, 'wb') as fd:
+        fd.write(b'this is not an sqlite file' * 100)
+    store = StateStore(path)
+    assert store.getWorking() == {}
+    store.addWorking('job_a', created_at=10.0)
+    store.close()
+    assert os.path.exists(path + '.corrupt')
+    assert StateStore(path).getWorking() == {'job_a': 10.0}
+
+
+def testMarkerFilesAreMigrated(tmpdir):
+    tmpdir.join('working_on_job_a.working').write('')
+    tmpdir.join('dev__i-1.start_instance').write('instance_id=i-1\nlabels=dev,dev_spot\n')
+    store = StateStore(str(tmpdir.join('state.db')))
+    store.migrateMarkerFiles(str(tmpdir))
+    assert store.isWorking('job_a') is True
+    assert store.getStartingInstances('dev') == {'i-1': ['dev', 'dev_spot']}
+    assert tmpdir.listdir(lambda p: p.ext in ['.working', '.start_instance']) == []
+    store.close()
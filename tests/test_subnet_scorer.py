@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+from subnet_scorer import SubnetScorer
+
+
+def testCapacityErrorsCountAgainstTheSubnet():
+    scorer = SubnetScorer()
+    scorer.recordLaunchError('subnet-a', 'c4.xlarge', 'InsufficientInstanceCapacity', now=0)
+    assert scorer.rank(['subnet-a', 'subnet-b'], 'c4.xlarge', now=0) == ['subnet-b', 'subnet-a']
+    assert scorer.stats['capacity_failures'] == 1
+
+
+def testOtherErrorsOnlyCount():
+    scorer = SubnetScorer()
+    for code in ['UnauthorizedOperation', 'InvalidAMIID.NotFound', None]:
+        scorer.recordLaunchError('subnet-a', 'c4.xlarge', code, now=0)
+    assert scorer.score('subnet-a', 'c4.xlarge', now=0) == scorer.score('subnet-b', 'c4.xlarge', now=0)
+    assert scorer.stats['failures'] == 3
+    assert scorer.stats['capacity_failures'] == 0
+
+
+def testFasterSubnetWins():
+    scorer = SubnetScorer()
+    for subnet_id, secs in [('subnet-a', 120), ('subnet-b', 30)]:
+        scorer.recordLaunch(subnet_id, 'c4.xlarge', now=0)
+        scorer.recordRunning(subnet_id, 'c4.xlarge', secs, now=0)
+    assert scorer.choose(['subnet-a', 'subnet-b'], 'c4.xlarge', now=0) == 'subnet-b'